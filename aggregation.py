@@ -0,0 +1,175 @@
+"""
+Time-bucket aggregation of lf values and hf samples.
+
+Every block read is reduced to partial aggregates per (source_id, type_id, bucket) which are merged into the
+running ones, so memory is bounded by the number of buckets rather than by the raw data:
+- count, min, max, and the mean and sum of squared deviations (m2) merged with Chan's parallel formula, which
+  stays accurate where sum/sum of squares would cancel out
+- percentiles from a log-bucketed histogram of the values (DDSketch): a returned percentile is within
+  relative_accuracy of an actual value of the bucket, and histograms merge by adding their counts.
+"""
+import numpy as np
+
+import blocks
+
+STATS = ['count', 'min', 'max', 'mean', 'std']
+
+# Histogram keys: positive values get key K + ceil(log_gamma(v)), negative ones its opposite and 0 the key 0,
+# so that keys sort in the order of the values
+_KEY_OFFSET = 2 ** 30
+
+
+def _groups(keys):
+    """
+    Returns (order, starts) of the rows sharing the same keys (last key primary), see blocks.group_rollup.
+    """
+    order = np.lexsort(keys)
+    change = np.zeros(len(order), dtype=bool)
+    change[0] = True
+    for k in keys:
+        k = k[order]
+        change[1:] |= k[1:] != k[:-1]
+    return order, np.flatnonzero(change)
+
+
+def _merge_stats(keys, count, mean, m2, minimum, maximum):
+    order, starts = _groups(keys)
+    count, mean, m2 = count[order], mean[order], m2[order]
+    total = np.add.reduceat(count, starts)
+    merged_mean = np.add.reduceat(count * mean, starts) / total
+    deviation = mean - np.repeat(merged_mean, np.diff(np.append(starts, len(order))))
+    return ([k[order][starts] for k in keys], total, merged_mean,
+            np.add.reduceat(m2 + count * deviation ** 2, starts),
+            np.minimum.reduceat(minimum[order], starts), np.maximum.reduceat(maximum[order], starts))
+
+
+def _merge_counts(keys, count):
+    order, starts = _groups(keys)
+    return [k[order][starts] for k in keys], np.add.reduceat(count[order], starts)
+
+
+class Aggregator:
+    """
+    Streaming aggregation of read_blocks(arrays=True) results into time buckets of bucket_micros.
+    """
+    def __init__(self, bucket_micros, percentiles=(), relative_accuracy=0.01):
+        """
+        percentiles: percentiles to compute (0 to 100), e.g. (50, 95)
+        relative_accuracy: relative error of the percentiles
+        """
+        if int(bucket_micros) <= 0:
+            raise ValueError('bucket_micros must be positive')
+        if not 0 < relative_accuracy < 1:
+            raise ValueError('relative_accuracy must be between 0 and 1')
+        self.bucket_micros = int(bucket_micros)
+        self.percentiles = sorted(set(float(p) for p in percentiles))
+        if any(not 0 <= p <= 100 for p in self.percentiles):
+            raise ValueError('percentiles must be between 0 and 100')
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = np.log(self.gamma)
+
+        self._sources = {}
+        # Partial aggregates keyed by [bucket, type_id, source] (see _groups), [histogram key, bucket, type_id,
+        # source] for the histogram
+        self._stats = None
+        self._histogram = None
+
+    def _source(self, source_id):
+        return self._sources.setdefault(str(source_id), len(self._sources))
+
+    def _histogram_keys(self, values):
+        keys = np.zeros(len(values), dtype=np.int64)
+        magnitude = np.abs(values)
+        nonzero = magnitude > 0
+        k = np.ceil(np.log(magnitude[nonzero]) / self._log_gamma).astype(np.int64) + _KEY_OFFSET
+        keys[nonzero] = np.where(values[nonzero] > 0, k, -k)
+        return keys
+
+    def _histogram_values(self, keys):
+        k = np.abs(keys) - _KEY_OFFSET
+        return np.where(keys == 0, 0., np.sign(keys) * 2 * self.gamma ** k.astype(np.float64) / (self.gamma + 1))
+
+    def add(self, source_id, type_id, timestamps, values):
+        """
+        Adds values (arrays of the same length) of a source_id.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        keep = ~np.isnan(values)
+        if not keep.all():
+            type_id, timestamps, values = type_id[keep], timestamps[keep], values[keep]
+        n = len(values)
+        if n == 0:
+            return
+
+        keys = [np.asarray(timestamps, dtype=np.int64) // self.bucket_micros * self.bucket_micros,
+                np.asarray(type_id, dtype=np.int64), np.full(n, self._source(source_id), dtype=np.int64)]
+        stats_keys, columns = keys, [np.ones(n, dtype=np.int64), values, np.zeros(n), values, values]
+        if self._stats is not None:
+            stats_keys = [np.concatenate(pair) for pair in zip(self._stats[0], stats_keys)]
+            columns = [np.concatenate(pair) for pair in zip(self._stats[1:], columns)]
+        self._stats = _merge_stats(stats_keys, *columns)
+
+        if self.percentiles:
+            # The histogram key is the least significant one: the bins of a bucket are contiguous, in value order
+            histogram_keys, count = [self._histogram_keys(values)] + keys, np.ones(n, dtype=np.int64)
+            if self._histogram is not None:
+                histogram_keys = [np.concatenate(pair) for pair in zip(self._histogram[0], histogram_keys)]
+                count = np.concatenate([self._histogram[1], count])
+            self._histogram = _merge_counts(histogram_keys, count)
+
+    def add_section(self, k, section):
+        """
+        Adds a section of a read_blocks(arrays=True) result.
+        """
+        if len(section['type_id']) == 0:
+            return
+        source_ids = section['source_id']
+        if k == 'lf':
+            self.add(source_ids[0], section['type_id'], section['timestamp_micros'], section['value'])
+        else:
+            rows, timestamps, values = blocks.sample_timestamps(section)
+            self.add(source_ids[0], section['type_id'][rows], timestamps, values)
+
+    def result(self):
+        """
+        Returns the columns {'source_id', 'type_id', 'bucket_micros', 'count', 'min', 'max', 'mean', 'std',
+        'p<percentile>', ...} sorted by source_id, type_id and bucket, std being the population one.
+        """
+        columns = ['source_id', 'type_id', 'bucket_micros'] + STATS + [self._name(p) for p in self.percentiles]
+        if self._stats is None:
+            return {c: [] for c in columns}
+
+        (bucket, type_id, source), count, mean, m2, minimum, maximum = self._stats
+        names = np.empty(len(self._sources), dtype=object)
+        for source_id, i in self._sources.items():
+            names[i] = source_id
+        # Sources are numbered in order of appearance, sort on their names
+        order = np.lexsort([bucket, type_id, names[source].astype(str)])
+        res = {
+            'source_id': names[source][order].tolist(),
+            'type_id': type_id[order].tolist(),
+            'bucket_micros': bucket[order].tolist(),
+            'count': count[order].tolist(),
+            'min': minimum[order].tolist(),
+            'max': maximum[order].tolist(),
+            'mean': mean[order].tolist(),
+            'std': np.sqrt(m2 / count)[order].tolist(),
+        }
+
+        if self.percentiles:
+            # Histogram bins are grouped like the stats, one group per stats row and in the same order
+            keys, bins = self._histogram
+            cumulative = np.cumsum(bins)
+            _, starts = _groups(keys[1:])
+            before = cumulative[starts] - bins[starts]
+            for p in self.percentiles:
+                rank = np.floor(p / 100. * (count - 1)).astype(np.int64)
+                index = np.searchsorted(cumulative, before + rank, side='right')
+                values = np.clip(self._histogram_values(keys[0][index]), minimum, maximum)
+                res[self._name(p)] = values[order].tolist()
+        return res
+
+    @staticmethod
+    def _name(p):
+        return 'p{:g}'.format(p)
+
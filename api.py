@@ -1,16 +1,37 @@
+import os
 import sys
+import json
+import struct
+import time
+import atexit
 
-from flask import Flask, abort, jsonify, request
+import msgpack
+import numpy as np
+from flask import Flask, Response, abort, g, jsonify, request, stream_with_context
 
 from flask_restful import Api, Resource
 from sqlalchemy.exc import IntegrityError
 
+import metrics
 from db.tables import AnnotationType, TimerangeAnnotation, TimestampAnnotation
 from storage import ImmutableStore, MutableStore
 
-immutable_store = ImmutableStore(location='test_db')
+HTTP_SECONDS = metrics.registry.histogram('pancarte_http_request_seconds', 'Duration of the API requests',
+                                          ['endpoint', 'method', 'status'])
+
+if os.environ.get('PANCARTE_SHARDS'):
+    from sharding import ShardedStore
+
+    # Every shard decodes its own blocks, and has its own block cache
+    immutable_store = ShardedStore(location='test_db_sharded', shards=int(os.environ['PANCARTE_SHARDS']),
+                                   block_cache_bytes=64 * 2 ** 20)
+else:
+    immutable_store = ImmutableStore(location='test_db', read_workers=os.cpu_count() or 1,
+                                     block_cache_bytes=256 * 2 ** 20)
 mutable_store = MutableStore()
 
+atexit.register(immutable_store.close)
+
 
 class App:
     app = Flask(__name__)
@@ -40,6 +61,41 @@ class App:
 app = App()
 
 
+@App.app.teardown_appcontext
+def remove_session(exception=None):
+    mutable_store.remove_session()
+
+
+@App.app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+
+@App.app.after_request
+def observe_request(response):
+    # Streamed responses are timed until their first block
+    if 'started' in g:
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unknown'
+        HTTP_SECONDS.observe(time.perf_counter() - g.started, endpoint, request.method, str(response.status_code))
+    return response
+
+
+@App.app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def traced(args, query):
+    """
+    Runs query(), adding the steps it went through to its result as 'trace' when args have trace=true.
+    """
+    with metrics.tracing(args.get('trace') == 'true') as trace:
+        res = query()
+    if trace is not None:
+        res['trace'] = trace.to_json()
+    return res
+
+
 def get_object_or_404(model, **kwargs):
     result = mutable_store.get(model, **kwargs)
     if result is None:
@@ -55,7 +111,10 @@ class MutableResource(Resource):
     model = None
 
     def _all(self, **kw):
-        return [o.to_json() for o in mutable_store.get_all(self.model, **kw)]
+        try:
+            return [o.to_json() for o in mutable_store.get_all(self.model, **kw)]
+        except ValueError:
+            abort(400)
 
     def _post(self, **kwargs):
         try:
@@ -76,7 +135,8 @@ class MutableResource(Resource):
         return jsonify(get_json_or_404(self.model, **kwargs))
 
     def _delete(self, id):
-        mutable_store.delete(self.model, id=id)
+        if not mutable_store.delete(self.model, id=id):
+            abort(404)
         return '', 204
 
 
@@ -164,62 +224,275 @@ class TimerangeAnnotationResource(MutableResource):
         return super()._delete(id=id)
 
 
+class AnnotationBulkResource(Resource):
+    """
+    POST body (msgpack): {column: values} with the required columns of the model, value and comment being
+    optional, every entry being a column (see decode_column) or a single value shared by all annotations.
+    DELETE: the annotations of the repeated id parameters and/or matching source_id, type_id,
+    start_micros/end_micros (as GET).
+    """
+    model = None
+    required = ()
+    optional = ('value', 'comment')
+
+    def post(self):
+        try:
+            body = msgpack.unpackb(request.get_data(), raw=False)
+            columns = {k: body[k] for k in self.required}
+            columns.update((k, body[k]) for k in self.optional if k in body)
+            arrays = {k: decode_column(v) for k, v in columns.items() if isinstance(v, (list, dict))}
+            count = max((len(v) for v in arrays.values()), default=1)
+            for k, v in columns.items():
+                v = arrays[k] if k in arrays else np.asarray([v] * count)
+                if len(v) != count:
+                    raise ValueError('{} has {} values instead of {}'.format(k, len(v), count))
+                columns[k] = v.tolist()
+            rows = [dict(zip(columns, row)) for row in zip(*columns.values())]
+            mutable_store.create_many(self.model, rows)
+        except (KeyError, ValueError, TypeError, msgpack.exceptions.UnpackException):
+            abort(400)
+        except IntegrityError:
+            return '', 409
+        return {'count': count}, 201
+
+    def delete(self):
+        try:
+            criteria = {k: int(request.args[k]) for k in ('source_id', 'type_id', 'start_micros', 'end_micros')
+                        if k in request.args}
+            ids = request.args.getlist('id') or None
+            return {'count': mutable_store.delete_many(self.model, ids=ids, **criteria)}
+        except ValueError:
+            abort(400)
+
+
+class TimestampAnnotationBulkResource(AnnotationBulkResource):
+    model = TimestampAnnotation
+    required = ('source_id', 'type_id', 'timestamp_micros')
+
+
+class TimerangeAnnotationBulkResource(AnnotationBulkResource):
+    model = TimerangeAnnotation
+    required = ('source_id', 'type_id', 'start_micros', 'end_micros')
+
+
+def parse_values(values):
+    """
+    hf values sent as a form field: a JSON list or comma separated floats.
+    """
+    values = values.strip()
+    if values.startswith('['):
+        return [float(v) for v in json.loads(values)]
+    return [float(v) for v in values.split(',') if v.strip()]
+
+
+def decode_column(column):
+    """
+    A bulk column is either a list or a raw array: {'dtype': '<f4', 'data': <bytes>}.
+    """
+    if isinstance(column, dict):
+        return np.frombuffer(column['data'], dtype=np.dtype(column['dtype']))
+    return np.asarray(column)
+
+
+def _ndjson_frame(block):
+    return json.dumps(block).encode('utf-8') + b'\n'
+
+
+def _msgpack_frame(block):
+    packed = msgpack.packb(block, use_bin_type=True)
+    return struct.pack('>I', len(packed)) + packed
+
+
+STREAM_FORMATS = {
+    'ndjson': ('application/x-ndjson', _ndjson_frame),
+    'msgpack': ('application/x-msgpack-stream', _msgpack_frame),
+}
+
+
+def stream_blocks(blocks, stream):
+    """
+    Sends every block of read_blocks as soon as it is read: one JSON document per line (ndjson) or
+    msgpack maps prefixed by their big-endian uint32 length (msgpack).
+    When the client goes away the WSGI server closes the response, which stops reading further blocks.
+    """
+    mimetype, frame = STREAM_FORMATS[stream]
+
+    def generate():
+        try:
+            for block in blocks:
+                if any(len(section['type_id']) > 0 for section in block.values()):
+                    yield frame(block)
+        finally:
+            blocks.close()
+
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+
+def waveform_filters(args):
+    """
+    read_blocks filters of query parameters: repeated source_id/type_id parameters select several of them.
+    """
+    filters = {}
+    for name in ('source_id', 'type_id'):
+        values = args.getlist(name)
+        if values:
+            filters[name] = values if len(values) > 1 else values[0]
+    for param, name in (('value_min', 'value__min'), ('value_max', 'value__max')):
+        if param in args:
+            filters[name] = args[param]
+    return filters
+
+
 class WaveformResource(Resource):
     def put(self):
         abort(404)
 
     def post(self):
         try:
-            if 'hf_source_id' in request.form:
+            if 'lf_source_id' in request.form:
                 immutable_store.write_lf(
-                    source_id=request.form['lf_source_id'],
-                    type_id=request.form['lf_type_id'],
-                    timestamp_micros=request.form['lf_timestamp_micros'],
-                    value=request.form.get['lf_value'],
+                    source_id=int(request.form['lf_source_id']),
+                    type_id=int(request.form['lf_type_id']),
+                    timestamp_micros=int(request.form['lf_timestamp_micros']),
+                    value=float(request.form['lf_value']),
                 )
             else:
                 immutable_store.write_hf(
-                    source_id=request.form['hf_source_id'],
-                    type_id=request.form['hf_type_id'],
-                    start_micros=request.form['hf_start_micros'],
-                    frequency=request.form['hf_frequency'],
-                    values=request.form['hf_values']
+                    source_id=int(request.form['hf_source_id']),
+                    type_id=int(request.form['hf_type_id']),
+                    start_micros=int(request.form['hf_start_micros']),
+                    frequency=float(request.form['hf_frequency']),
+                    values=parse_values(request.form['hf_values'])
                 )
-        except KeyError:
+        except (KeyError, ValueError):
             abort(400)
         return '', 201
 
     def get(self):
         try:
-            source_id = request.args.get('source_id', None)
-            type_id = request.args.get('type_id', None)
             lf = request.args['lf'] == 'true'
             hf = request.args['hf'] == 'true'
             start_micros = int(request.args['start_micros'])
             end_micros = int(request.args['end_micros'])
-        except KeyError:
+            stream = request.args.get('stream', None)
+            resolution = int(request.args['resolution']) if 'resolution' in request.args else None
+            max_points = int(request.args['max_points']) if 'max_points' in request.args else None
+            padding_micros = int(request.args.get('padding_micros', 0))
+        except (KeyError, ValueError):
+            abort(400)
+        if stream not in STREAM_FORMATS and stream is not None:
+            abort(400)
+        # The trace is sent with the result, streams have none
+        if stream is not None and request.args.get('trace') == 'true':
             abort(400)
 
-        filters = {}
-        if source_id is not None:
-            filters['source_id'] = source_id
-        if type_id is not None:
-            filters['type_id'] = type_id
-        return immutable_store.read_all_blocks(start_micros=start_micros, end_micros=end_micros, lf=lf, hf=hf, **filters)
+        filters = waveform_filters(request.args)
+
+        if 'annotation_type' in request.args:
+            if resolution is not None or max_points is not None:
+                abort(400)
+            return traced(request.args, lambda: self._get_annotated(request.args['annotation_type'], start_micros,
+                                                                    end_micros, lf, hf, padding_micros, stream,
+                                                                    filters))
+
+        try:
+            if stream is not None:
+                return stream_blocks(immutable_store.read_blocks(start_micros=start_micros, end_micros=end_micros,
+                                                                 lf=lf, hf=hf, resolution=resolution,
+                                                                 max_points=max_points, **filters), stream)
+            return traced(request.args, lambda: immutable_store.read_all_blocks(
+                start_micros=start_micros, end_micros=end_micros, lf=lf, hf=hf, resolution=resolution,
+                max_points=max_points, **filters))
+        except ValueError:
+            abort(400)
+
+    def _get_annotated(self, annotation_type, start_micros, end_micros, lf, hf, padding_micros, stream, filters):
+        """
+        Values inside the annotations of annotation_type (id or name), timestamp annotations being widened by
+        padding_micros on both sides.
+        """
+        type_id = mutable_store.annotation_type_id(annotation_type)
+        if type_id is None:
+            abort(404)
+        try:
+            intervals = mutable_store.annotation_intervals(type_id, start_micros, end_micros,
+                                                           source_id=filters.pop('source_id', None),
+                                                           padding_micros=padding_micros)
+            if stream is not None:
+                return stream_blocks(immutable_store.read_intervals(intervals, lf=lf, hf=hf, **filters), stream)
+            return immutable_store.read_all_intervals(intervals, lf=lf, hf=hf, **filters)
+        except ValueError:
+            abort(400)
 
     def delete(self, id):
         abort(404)
 
 
+class WaveformAggregateResource(Resource):
+    """
+    count/min/max/mean/std per bucket_micros bucket, source_id and type_id, plus the percentiles asked for
+    (percentiles=5,50,95 gives p5, p50 and p95).
+    """
+    def get(self):
+        try:
+            lf = request.args.get('lf', 'true') == 'true'
+            hf = request.args.get('hf', 'true') == 'true'
+            start_micros = int(request.args['start_micros'])
+            end_micros = int(request.args['end_micros'])
+            bucket_micros = int(request.args['bucket_micros'])
+            percentiles = [float(p) for p in request.args.get('percentiles', '').split(',') if p.strip()]
+            return traced(request.args, lambda: immutable_store.aggregate(
+                start_micros=start_micros, end_micros=end_micros, bucket_micros=bucket_micros, lf=lf, hf=hf,
+                percentiles=percentiles, **waveform_filters(request.args)))
+        except (KeyError, ValueError):
+            abort(400)
+
+
+class WaveformBulkResource(Resource):
+    """
+    Body (msgpack): {'lf': {'source_id', 'type_id', 'timestamp_micros', 'value'},
+                     'hf': {'source_id', 'type_id', 'start_micros', 'frequency', 'offsets', 'values'}}
+    every entry being a column (see decode_column), both sections being optional.
+    """
+    def post(self):
+        try:
+            body = msgpack.unpackb(request.get_data(), raw=False)
+            counts = {}
+            if 'lf' in body:
+                lf = {k: decode_column(v) for k, v in body['lf'].items()}
+                immutable_store.write_lf_batch(source_ids=lf['source_id'], type_ids=lf['type_id'],
+                                               timestamps_micros=lf['timestamp_micros'], values=lf['value'])
+                counts['lf'] = len(lf['value'])
+            if 'hf' in body:
+                hf = {k: decode_column(v) for k, v in body['hf'].items()}
+                immutable_store.write_hf_batch(source_ids=hf['source_id'], type_ids=hf['type_id'],
+                                               starts_micros=hf['start_micros'], frequencies=hf['frequency'],
+                                               values=hf['values'], offsets=hf['offsets'])
+                counts['hf'] = len(hf['start_micros'])
+        except (KeyError, ValueError, TypeError, msgpack.exceptions.UnpackException):
+            abort(400)
+        return counts, 201
+
+
 app.add_mutable_resource_class(AnnotationTypeResource, 'at', '/annotations/types')
 app.add_mutable_resource_class(TimestampAnnotationResource, 'ts', '/annotations/timestamp')
 app.add_mutable_resource_class(TimerangeAnnotationResource, 'tr', '/annotations/timerange')
+app.add_immutable_resource_class(TimestampAnnotationBulkResource, 'tsb', '/annotations/timestamp/bulk')
+app.add_immutable_resource_class(TimerangeAnnotationBulkResource, 'trb', '/annotations/timerange/bulk')
 app.add_immutable_resource_class(WaveformResource, 'wf', '/waveforms')
+app.add_immutable_resource_class(WaveformBulkResource, 'wfb', '/waveforms/bulk')
+app.add_immutable_resource_class(WaveformAggregateResource, 'wfa', '/waveforms/aggregate')
 
 # * [x] Get data from date A to date B
 # * [x] Get data where bed_id=X, signal_type=ECG
-# * [ ] Get data where there are arythmia annotations
+# * [x] Get data where there are arythmia annotations
 #
 
 if __name__ == "__main__":
+    if os.environ.get('PANCARTE_INGEST_PORT'):
+        from ingest import IngestServer
+
+        ingest_server = IngestServer(immutable_store, host=sys.argv[1], port=int(os.environ['PANCARTE_INGEST_PORT']))
+        ingest_server.start_in_thread()
+        atexit.register(ingest_server.close)
     app.run(sys.argv[1], int(sys.argv[2]))
@@ -0,0 +1,73 @@
+"""
+Size and decoding speed of the block column codecs.
+
+    python3 -m benchmarks.compression --values 1000000
+"""
+import argparse
+import time
+
+import numpy as np
+
+import compression
+
+CODECS = [
+    ['zlib:1'],
+    ['zlib'],
+    ['lzma'],
+    ['shuffle', 'zlib'],
+    ['xor', 'shuffle', 'zlib'],
+    ['xor', 'shuffle', 'lzma'],
+    ['xor', 'lzma'],
+    ['quantize:0.001', 'delta', 'shuffle', 'zlib'],
+    ['quantize:0.001', 'delta', 'shuffle', 'lzma'],
+    ['delta', 'shuffle', 'zlib'],
+    ['dod', 'shuffle', 'zlib'],
+    ['dod', 'shuffle', 'lzma'],
+]
+
+
+def datasets(n):
+    rng = np.random.RandomState(0)
+    t = np.arange(n)
+    return {
+        # Repeated heartbeat, as RepeatPattern generates in test.py
+        'repeat pattern': np.resize([1.1, 2.2, 3.3, 4.4, 5.5, 6.6], n).astype(np.float64),
+        # Slowly varying signal sampled at 250 Hz with 3 decimals, like a pleth/ECG export
+        'smooth 3 decimals': np.round(np.sin(t / 250.) + 0.05 * np.sin(t / 7.), 3),
+        'random': rng.normal(size=n),
+        # 250 Hz chunk start timestamps, with jitter
+        'timestamps': 1525255489000000 + t * 4000 + rng.randint(0, 3, n),
+    }
+
+
+def run(values, codec, repeat):
+    payload, dtypes = compression.encode(values, codec)
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        decoded = compression.decode(payload, codec, dtypes, len(values))
+    elapsed = (time.perf_counter() - t0) / repeat
+    lossless = np.array_equal(decoded, values)
+    return len(payload) / len(values), len(values) / elapsed, lossless
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--values', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=5, help='decodings averaged')
+    args = parser.parse_args()
+
+    for name, values in datasets(args.values).items():
+        print(name)
+        print('  {:<42} {:>8.2f} bytes/value'.format('raw', values.dtype.itemsize))
+        for codec in CODECS:
+            if values.dtype.kind == 'i' and codec[0] in ('xor', 'quantize:0.001'):
+                continue
+            if values.dtype.kind == 'f' and codec[0] in ('delta', 'dod'):
+                continue
+            size, rate, lossless = run(values, codec, args.repeat)
+            print('  {:<42} {:>8.2f} bytes/value {:>14,.0f} values/s decoded{}'
+                  .format(' '.join(codec), size, rate, '' if lossless else ' (lossy)'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Load generator for the TCP ingestion server (ingest.py): connections stream hf chunks as fast as the acks let them.
+Without --host, a server is started in-process on a temporary store.
+
+    python3 -m benchmarks.ingest --connections 8 --frames 5000
+    python3 -m benchmarks.ingest --shards 4
+    python3 -m benchmarks.ingest --host 127.0.0.1 --port 9000
+"""
+import argparse
+import asyncio
+import datetime
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import ingest
+from sharding import ShardedStore
+from storage import ImmutableStore
+
+
+async def read_acks(reader, frames):
+    """
+    Returns once frames are acked, raises on an error frame.
+    """
+    acked = 0
+    while acked < frames:
+        body = await ingest.read_frame(reader)
+        if body is None:
+            raise ConnectionError('connection closed after {} acked frames'.format(acked))
+        if body[0] == ingest.ERROR:
+            raise ConnectionError(body[1:].decode('utf-8'))
+        acked = ingest.unpack_ack(body)
+
+
+async def connection(host, port, source_id, frames, chunk_size, window):
+    """
+    Sends frames chunks of source_id, window frames per write.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    acks = asyncio.ensure_future(read_acks(reader, frames))
+    values = np.sin(np.arange(chunk_size) / 10.)
+    start = 1525255489000000
+    for i in range(0, frames, window):
+        writer.write(b''.join(ingest.pack_hf(source_id, 1, start + j * 1000000, chunk_size, values)
+                              for j in range(i, min(frames, i + window))))
+        # The server stops reading past its queue, drain waits for it
+        await writer.drain()
+        if acks.done():
+            break
+    await acks
+    writer.close()
+
+
+async def connections(host, port, count, frames, chunk_size, window):
+    await asyncio.gather(*[connection(host, port, i, frames, chunk_size, window) for i in range(count)])
+
+
+def run(host, port, count, frames, chunk_size, window):
+    loop = asyncio.new_event_loop()
+    try:
+        t0 = time.perf_counter()
+        loop.run_until_complete(connections(host, port, count, frames, chunk_size, window))
+        return time.perf_counter() - t0
+    finally:
+        loop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--connections', type=int, default=8, help='one source_id per connection')
+    parser.add_argument('--frames', type=int, default=5000, help='frames per connection')
+    parser.add_argument('--chunk-size', type=int, default=250, help='values per frame')
+    parser.add_argument('--window', type=int, default=256, help='frames sent at once')
+    parser.add_argument('--wal', action='store_true', help='in-process server only')
+    parser.add_argument('--shards', type=int, help='in-process server on a ShardedStore of this many processes')
+    args = parser.parse_args()
+
+    server = location = store = None
+    host, port = args.host, args.port
+    if host is None:
+        location = tempfile.mkdtemp(prefix='pancarte-bench-')
+        kwargs = dict(time_margin=datetime.timedelta(0), wal=args.wal)
+        if args.shards:
+            store = ShardedStore(location, shards=args.shards, **kwargs)
+        else:
+            store = ImmutableStore(location=location, **kwargs)
+        server = ingest.IngestServer(store, host='127.0.0.1', port=0)
+        server.start_in_thread()
+        host, port = '127.0.0.1', server.port
+    try:
+        elapsed = run(host, port, args.connections, args.frames, args.chunk_size, args.window)
+    finally:
+        if server is not None:
+            server.close()
+            store.close()
+            shutil.rmtree(location, ignore_errors=True)
+
+    frames = args.connections * args.frames
+    print('{:,} frames in {:.2f} s: {:>12,.0f} frames/s {:>14,.0f} values/s'.format(
+        frames, elapsed, frames / elapsed, frames * args.chunk_size / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""
+Ingest and query benchmark of an ImmutableStore on a synthetic workload (see benchmarks/workloads.py).
+
+Measures the sustained ingest rate (writes and the final flush), the latency of block writes, the number and size of
+the written blocks, bytes per value, and the latency percentiles of point (one signal, 1 s), window (one source,
+5 min) and day (every source, 24 h) queries. Results are saved as JSON and can be compared with a previous run:
+
+    python3 -m benchmarks.suite --workload small --output before.json
+    python3 -m benchmarks.suite --workload small --output after.json --baseline before.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks import workloads
+from storage import ImmutableStore
+
+DAY_MICROS = 24 * 3600 * 10 ** 6
+
+# (name, duration of the queried range, source_id and type_id filters)
+QUERIES = [
+    ('point', 10 ** 6, True, True),
+    ('window', 5 * 60 * 10 ** 6, True, False),
+    ('day', DAY_MICROS, False, False),
+]
+
+# Metrics improving when they go up, the others improve when they go down
+HIGHER_IS_BETTER = {'ingest_values_per_s'}
+# Metrics describing the run, not compared
+INFORMATIONAL = {'values', 'blocks', 'block_bytes'}
+
+
+def percentiles(samples):
+    """
+    Returns {p50, p90, p99, max, count} of samples (milliseconds).
+    """
+    if not samples:
+        return {'p50': None, 'p90': None, 'p99': None, 'max': None, 'count': 0}
+    p50, p90, p99 = np.percentile(samples, [50, 90, 99]).tolist()
+    return {'p50': p50, 'p90': p90, 'p99': p99, 'max': max(samples), 'count': len(samples)}
+
+
+def _timed_block_writes(store):
+    # Writer threads look the callback up on every write
+    latencies = []
+    write_block = store._write_block_callback
+
+    def timed(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return write_block(*args, **kwargs)
+        finally:
+            latencies.append((time.perf_counter() - t0) * 1000)
+
+    store._write_block_callback = timed
+    return latencies
+
+
+def ingest(location, workload, store_kwargs):
+    """
+    Writes the workload to a new store, returns the ingest metrics.
+    """
+    store = ImmutableStore(location=location, time_margin=datetime.timedelta(0), **store_kwargs)
+    latencies = _timed_block_writes(store)
+    t0 = time.perf_counter()
+    workloads.write(store, workload)
+    t1 = time.perf_counter()
+    store.close()
+    t2 = time.perf_counter()
+
+    values = workloads.value_count(workload)
+    sizes = [entry['byte_size'] for source_id in store.manifest.sources()
+             for entry in store.manifest.entries(source_id)]
+    return {
+        'values': values,
+        'ingest_values_per_s': values / (t2 - t0),
+        'write_seconds': t1 - t0,
+        'final_flush_seconds': t2 - t1,
+        'flush_latency_ms': percentiles(latencies),
+        'blocks': len(sizes),
+        'block_bytes': sum(sizes),
+        'block_bytes_mean': sum(sizes) / len(sizes) if sizes else None,
+        'bytes_per_value': sum(sizes) / values,
+    }
+
+
+def query(location, workload, store_kwargs, repeat):
+    """
+    Runs repeat queries of every kind on the blocks of a store, returns their latency metrics.
+    """
+    store = ImmutableStore(location=location, **store_kwargs)
+    rng = np.random.RandomState(workload['seed'] + 1)
+    duration = int(workload['duration_seconds'] * 1E6)
+    type_ids = np.arange(1, workload['hf_types'] + workload['lf_types'] + 1)
+    day = workloads.START_MICROS // DAY_MICROS * DAY_MICROS
+    metrics = {}
+    try:
+        for name, span, by_source, by_type in QUERIES:
+            count = repeat if span < DAY_MICROS else max(1, repeat // 10)
+            latencies = []
+            for _ in range(count):
+                filters = {}
+                if by_source:
+                    filters['source_id'] = int(rng.randint(workload['sources']))
+                if by_type:
+                    filters['type_id'] = int(rng.choice(type_ids))
+                if span >= DAY_MICROS:
+                    start = day
+                else:
+                    start = workloads.START_MICROS + int(rng.randint(max(1, duration - span)))
+                t0 = time.perf_counter()
+                store.read_all_blocks(start, start + span, **filters)
+                latencies.append((time.perf_counter() - t0) * 1000)
+            metrics['query_{}_ms'.format(name)] = percentiles(latencies)
+    finally:
+        store.close()
+    return metrics
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'commit': commit}
+
+
+def run(workload_name, store_kwargs, repeat, location=None):
+    """
+    Returns the results of a benchmark run: workload, store arguments, environment and metrics.
+    """
+    workload = workloads.WORKLOADS[workload_name]
+    keep = location is not None
+    location = location or tempfile.mkdtemp(prefix='pancarte-bench-')
+    try:
+        metrics = ingest(location, workload, store_kwargs)
+        metrics.update(query(location, workload, store_kwargs, repeat))
+    finally:
+        if not keep:
+            shutil.rmtree(location, ignore_errors=True)
+    return {'workload': dict(workload, name=workload_name), 'store': store_kwargs, 'environment': environment(),
+            'metrics': metrics}
+
+
+def flatten(metrics, prefix=''):
+    flat = {}
+    for k, v in metrics.items():
+        if isinstance(v, dict):
+            flat.update(flatten(v, prefix + k + '.'))
+        else:
+            flat[prefix + k] = v
+    return flat
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns [(metric, baseline value, value, relative change, regressed)] of the metrics of both runs, regressed
+    when the change is worse than threshold (0.05: 5%).
+    """
+    new, old = flatten(results['metrics']), flatten(baseline['metrics'])
+    rows = []
+    for metric in sorted(set(new) & set(old)):
+        if not old[metric] or new[metric] is None:
+            continue
+        change = new[metric] / old[metric] - 1
+        if metric in INFORMATIONAL or metric.endswith('.count'):
+            regressed = False
+        elif metric in HIGHER_IS_BETTER:
+            regressed = change < -threshold
+        else:
+            regressed = change > threshold
+        rows.append((metric, old[metric], new[metric], change, regressed))
+    return rows
+
+
+def report(results):
+    for metric, value in sorted(flatten(results['metrics']).items()):
+        print('{:<32} {:>16}'.format(metric, '-' if value is None else '{:,.3f}'.format(value)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workload', choices=sorted(workloads.WORKLOADS), default='small')
+    parser.add_argument('--repeat', type=int, default=50, help='queries of each kind (day ones: a tenth)')
+    parser.add_argument('--cache-bytes', type=int, default=4 * 2 ** 20)
+    parser.add_argument('--codecs', help='compression.PRESETS name')
+    parser.add_argument('--wal', action='store_true')
+    parser.add_argument('--location', help='store directory, kept (default: a temporary one)')
+    parser.add_argument('--output', help='JSON file of the results')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.05, help='relative change reported as a regression')
+    parser.add_argument('--fail-on-regression', action='store_true', help='exit with status 1 on a regression')
+    args = parser.parse_args()
+
+    store_kwargs = {'cache_bytes': args.cache_bytes, 'codecs': args.codecs, 'wal': args.wal}
+    results = run(args.workload, store_kwargs, args.repeat, args.location)
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['workload'] != results['workload'] or baseline['store'] != results['store']:
+            print('warning: the baseline ran another workload or store configuration')
+        print('\n{:<32} {:>16} {:>16}'.format('', 'baseline', 'this run'))
+        regressions = 0
+        for metric, old, new, change, regressed in compare(results, baseline, args.threshold):
+            regressions += regressed
+            print('{:<32} {:>16,.3f} {:>16,.3f} {:>+8.1f}%{}'.format(metric, old, new, change * 100,
+                                                                     '  REGRESSION' if regressed else ''))
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
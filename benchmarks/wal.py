@@ -0,0 +1,55 @@
+"""
+Sustained ingest rate with and without the write-ahead log.
+
+    python3 -m benchmarks.wal --chunks 20000
+"""
+import argparse
+import datetime
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from storage import ImmutableStore
+
+
+def run(chunks, sources, chunk_size, cache_size, **store_kwargs):
+    location = tempfile.mkdtemp(prefix='pancarte-bench-')
+    try:
+        store = ImmutableStore(location=location, cache_size=cache_size, time_margin=datetime.timedelta(0),
+                               **store_kwargs)
+        values = np.sin(np.arange(chunk_size) / 10.).tolist()
+        start = 1525255489000000
+        t0 = time.perf_counter()
+        for i in range(chunks):
+            store.write_hf(source_id=i % sources, type_id=1, start_micros=start + (i // sources) * 1000000,
+                           frequency=chunk_size, values=values)
+        store.close()
+        elapsed = time.perf_counter() - t0
+    finally:
+        shutil.rmtree(location, ignore_errors=True)
+    return chunks * chunk_size / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=20000)
+    parser.add_argument('--sources', type=int, default=20)
+    parser.add_argument('--chunk-size', type=int, default=250)
+    parser.add_argument('--cache-size', type=int, default=250000)
+    parser.add_argument('--repeat', type=int, default=3, help='best of n runs')
+    args = parser.parse_args()
+
+    configs = [('no wal', {})] + [('wal fsync={}'.format(p), {'wal': True, 'wal_fsync': p})
+                                  for p in ('never', 'interval', 'always')]
+    baseline = None
+    for name, kwargs in configs:
+        rate = max(run(args.chunks, args.sources, args.chunk_size, args.cache_size, **kwargs)
+                   for _ in range(args.repeat))
+        baseline = baseline or rate
+        print('{:<22} {:>14,.0f} values/s {:>+8.1f}%'.format(name, rate, (rate / baseline - 1) * 100))
+
+
+if __name__ == '__main__':
+    main()
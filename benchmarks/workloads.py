@@ -0,0 +1,141 @@
+"""
+Deterministic synthetic workloads of the benchmark suite and test.py.
+
+A workload is sources x (lf_types + hf_types) signals over duration_seconds of simulated time starting at
+START_MICROS: hf signals repeat an ECG heartbeat (dsfaker RepeatPattern, as test.py did) plus seeded gaussian noise,
+sent as chunks of chunk_seconds, lf signals are seeded uniform numerics at lf_frequency. Every run of a workload
+writes the same values in the same order.
+"""
+import numpy as np
+from dsfaker.generators.series import RepeatPattern
+
+# 2018-05-02 10:04:49 UTC
+START_MICROS = 1525255489000000
+
+# A few beats of an ECG lead
+HEARTBEAT = [
+    -0.145, -0.145, -0.145, -0.145, -0.145, -0.145, -0.145, -0.145, -0.12, -0.135, -0.145, -0.15, -0.16, -0.155,
+    -0.16, -0.175, -0.18, -0.185, -0.17, -0.155, -0.175, -0.18, -0.19, -0.18, -0.155, -0.135, -0.155, -0.19,
+    -0.205, -0.235, -0.225, -0.245, -0.25, -0.26, -0.275, -0.275, -0.275, -0.265, -0.255, -0.265, -0.275, -0.29,
+    -0.29, -0.29, -0.29, -0.285, -0.295, -0.305, -0.285, -0.275, -0.275, -0.28, -0.285, -0.305, -0.29, -0.3,
+    -0.28, -0.29, -0.3, -0.315, -0.32, -0.335, -0.36, -0.385, -0.385, -0.405, -0.455, -0.485, -0.485, -0.425,
+    -0.33, -0.22, -0.07, 0.12, 0.375, 0.62, 0.78, 0.84, 0.765, 0.52, 0.17, -0.165, -0.365, -0.435, -0.425,
+    -0.37, -0.33, -0.325, -0.335, -0.345, -0.33, -0.325, -0.315, -0.31, -0.32, -0.335, -0.34, -0.325, -0.345,
+    -0.335, -0.33, -0.335, -0.33, -0.325, -0.33, -0.33, -0.345, -0.355, -0.335, -0.325, -0.305, -0.32, -0.32,
+    -0.33, -0.34, -0.335, -0.34, -0.345, -0.355, -0.355, -0.34, -0.33, -0.33, -0.33, -0.34, -0.35, -0.325,
+    -0.325, -0.33, -0.33, -0.335, -0.335, -0.34, -0.33, -0.34, -0.35, -0.355, -0.35, -0.345, -0.33, -0.32,
+    -0.335, -0.33, -0.345, -0.33, -0.335, -0.335, -0.345, -0.345, -0.355, -0.34, -0.34, -0.335, -0.33, -0.35,
+    -0.35, -0.345, -0.335, -0.335, -0.335, -0.35, -0.355, -0.355, -0.345, -0.345, -0.335, -0.35, -0.36, -0.36,
+    -0.36, -0.365, -0.36, -0.37, -0.385, -0.37, -0.36, -0.355, -0.36, -0.375, -0.375, -0.365, -0.365, -0.36,
+    -0.36, -0.365, -0.37, -0.355, -0.33, -0.325, -0.325, -0.335, -0.34, -0.315, -0.3, -0.3, -0.29, -0.295,
+    -0.29, -0.285, -0.275, -0.255, -0.25, -0.25, -0.265, -0.255, -0.245, -0.23, -0.245, -0.245, -0.255, -0.255,
+    -0.24, -0.25, -0.255, -0.245, -0.255, -0.25, -0.25, -0.265, -0.26, -0.26, -0.265, -0.27, -0.265, -0.26,
+    -0.275, -0.28, -0.29, -0.275, -0.27, -0.26, -0.28, -0.28, -0.285, -0.275, -0.275, -0.265, -0.27, -0.285,
+    -0.29, -0.28, -0.275, -0.285, -0.28, -0.3, -0.3, -0.305, -0.295, -0.3, -0.31, -0.31, -0.305, -0.295, -0.285,
+    -0.285, -0.29, -0.295, -0.31, -0.29, -0.295, -0.3, -0.305, -0.31, -0.325, -0.31, -0.3, -0.29, -0.31, -0.325,
+    -0.33, -0.315, -0.3, -0.305, -0.31, -0.32, -0.33, -0.325, -0.315, -0.31, -0.305, -0.305, -0.31, -0.3,
+    -0.305, -0.29, -0.3, -0.3, -0.305, -0.305, -0.29, -0.28, -0.295, -0.305, -0.315, -0.305, -0.295, -0.29,
+    -0.28, -0.27, -0.275, -0.275, -0.27, -0.25, -0.25, -0.255, -0.225, -0.22, -0.205, -0.2, -0.205, -0.215,
+    -0.23, -0.22, -0.225, -0.225, -0.225, -0.23, -0.235, -0.24, -0.235, -0.22, -0.21, -0.205, -0.245, -0.285,
+    -0.285, -0.3, -0.31, -0.33, -0.33, -0.325, -0.315, -0.32, -0.315, -0.325, -0.34, -0.345, -0.34, -0.34,
+    -0.35, -0.345, -0.355, -0.33, -0.335, -0.33, -0.32, -0.345, -0.355, -0.34, -0.33, -0.325, -0.33, -0.35,
+    -0.365, -0.36, -0.38, -0.425, -0.445, -0.475, -0.51, -0.535, -0.505, -0.415, -0.3, -0.16, -0.015, 0.235,
+    0.49, 0.72, 0.875, 0.94, 0.905, 0.755, 0.49, 0.165, -0.11, -0.27, -0.39, -0.45, -0.475, -0.455, -0.425,
+    -0.39, -0.39, -0.385, -0.39, -0.38, -0.38, -0.38, -0.395, -0.385, -0.385, -0.385, -0.375, -0.395, -0.41,
+    -0.41, -0.4, -0.395, -0.39, -0.405, -0.395, -0.385, -0.375, -0.39, -0.39, -0.405, -0.41, -0.41, -0.39,
+    -0.39, -0.395, -0.405, -0.415, -0.4, -0.41, -0.405, -0.41, -0.415, -0.41, -0.4, -0.4, -0.395, -0.39, -0.405,
+    -0.41, -0.39, -0.39, -0.385, -0.385, -0.41, -0.405, -0.395, -0.39, -0.375, -0.39, -0.395, -0.41, -0.4,
+    -0.39, -0.39, -0.385, -0.405, -0.415, -0.415, -0.4, -0.395, -0.405, -0.415, -0.42, -0.42, -0.41, -0.415,
+    -0.425, -0.42, -0.435, -0.43, -0.43, -0.42, -0.43, -0.45, -0.455, -0.45, -0.435, -0.445, -0.45, -0.455,
+    -0.47, -0.46, -0.455, -0.45, -0.455, -0.47, -0.475, -0.46, -0.45, -0.445, -0.44, -0.435, -0.44, -0.41,
+    -0.395, -0.37, -0.365, -0.36, -0.365, -0.34, -0.325, -0.315, -0.32, -0.33, -0.33, -0.32, -0.31, -0.3, -0.3,
+    -0.32, -0.32, -0.315, -0.305, -0.305, -0.295, -0.32, -0.33, -0.305, -0.31, -0.3, -0.3, -0.32, -0.325, -0.31,
+    -0.305, -0.315, -0.305, -0.315, -0.315, -0.31, -0.295, -0.29, -0.305, -0.31, -0.32, -0.315, -0.3, -0.315,
+    -0.315, -0.315, -0.33, -0.315, -0.32, -0.315, -0.325, -0.335, -0.34, -0.335, -0.335, -0.33, -0.325, -0.345,
+    -0.35, -0.345, -0.335, -0.33, -0.33, -0.345, -0.345, -0.345, -0.32, -0.33, -0.335, -0.34, -0.355, -0.335,
+    -0.33, -0.33, -0.335, -0.355, -0.36, -0.355, -0.35, -0.34, -0.345, -0.345, -0.345, -0.345, -0.33, -0.33,
+    -0.335, -0.345, -0.35, -0.35, -0.34, -0.33, -0.345, -0.345, -0.355, -0.35, -0.34, -0.33, -0.34, -0.34,
+    -0.34, -0.33, -0.335, -0.33, -0.335, -0.345, -0.345, -0.34, -0.33, -0.315, -0.295, -0.3, -0.295, -0.285,
+    -0.275, -0.265, -0.265, -0.265, -0.255, -0.25, -0.24, -0.225, -0.215, -0.24, -0.245, -0.24, -0.245, -0.235,
+    -0.245, -0.25, -0.275, -0.275, -0.265, -0.25, -0.225, -0.22, -0.23, -0.265, -0.27, -0.28, -0.285, -0.305,
+    -0.32, -0.34, -0.33, -0.335, -0.335, -0.355, -0.37, -0.36, -0.345, -0.35, -0.355, -0.365, -0.375, -0.38,
+    -0.37, -0.365, -0.365, -0.38, -0.385, -0.38, -0.375, -0.355, -0.37, -0.39, -0.405, -0.41, -0.435, -0.465,
+    -0.49, -0.52, -0.555, -0.57, -0.525, -0.405, -0.25, -0.09, 0.12, 0.41, 0.69, 0.885, 0.96, 0.85, 0.52, 0.05,
+    -0.32, -0.5, -0.505, -0.445, -0.415
+]
+
+WORKLOADS = {
+    # Quick check, a few signals over 10 minutes
+    'small': dict(sources=4, lf_types=2, hf_types=2, hf_frequency=125, lf_frequency=1, chunk_seconds=1,
+                  duration_seconds=600, batch=True, noise=0.01, seed=0),
+    # A ward of 20 beds over half an hour
+    'default': dict(sources=20, lf_types=4, hf_types=2, hf_frequency=125, lf_frequency=1, chunk_seconds=1,
+                    duration_seconds=1800, batch=True, noise=0.01, seed=0),
+    # Many beds sending few signals
+    'wide': dict(sources=200, lf_types=8, hf_types=1, hf_frequency=125, lf_frequency=1, chunk_seconds=1,
+                 duration_seconds=300, batch=True, noise=0.01, seed=0),
+    # 'small' through write_lf/write_hf calls, one per value/chunk
+    'single': dict(sources=4, lf_types=2, hf_types=2, hf_frequency=125, lf_frequency=1, chunk_seconds=1,
+                   duration_seconds=600, batch=False, noise=0.01, seed=0),
+}
+
+
+def value_count(workload):
+    """
+    Returns the number of lf values and hf samples a workload writes.
+    """
+    w = workload
+    per_second = w['lf_types'] * w['lf_frequency'] + w['hf_types'] * w['hf_frequency']
+    return int(w['sources'] * per_second * w['duration_seconds'])
+
+
+def steps(workload):
+    """
+    Yields (lf, hf) write_lf_batch/write_hf_batch arguments, chunk_seconds of every signal at a time and in time
+    order. hf type_ids are 1 to hf_types, lf ones follow.
+    """
+    w = workload
+    rng = np.random.RandomState(w['seed'])
+    sources = np.arange(w['sources'], dtype=np.int64)
+    hf_types = np.arange(1, w['hf_types'] + 1, dtype=np.int64)
+    lf_types = np.arange(w['hf_types'] + 1, w['hf_types'] + w['lf_types'] + 1, dtype=np.int64)
+    chunk = int(w['hf_frequency'] * w['chunk_seconds'])
+    lf_per_step = int(w['lf_frequency'] * w['chunk_seconds'])
+    # One heartbeat generator per hf signal, shifted so that signals are not in phase
+    patterns = [RepeatPattern(np.roll(HEARTBEAT, 37 * i)) for i in range(len(sources) * len(hf_types))]
+
+    hf_source_ids = np.repeat(sources, len(hf_types))
+    hf_type_ids = np.tile(hf_types, len(sources))
+    offsets = np.arange(len(patterns) + 1, dtype=np.int64) * chunk
+    lf_source_ids = np.repeat(sources, len(lf_types) * lf_per_step)
+    lf_type_ids = np.tile(np.repeat(lf_types, lf_per_step), len(sources))
+    lf_offsets = np.tile(np.arange(lf_per_step, dtype=np.int64) * int(1E6 / w['lf_frequency']),
+                         len(sources) * len(lf_types))
+
+    step_micros = int(w['chunk_seconds'] * 1E6)
+    for i in range(int(w['duration_seconds'] / w['chunk_seconds'])):
+        start = START_MICROS + i * step_micros
+        values = np.concatenate([p.get_batch(chunk) for p in patterns]) + rng.normal(0, w['noise'], offsets[-1])
+        hf = dict(source_ids=hf_source_ids, type_ids=hf_type_ids,
+                  starts_micros=np.full(len(patterns), start, dtype=np.int64),
+                  frequencies=float(w['hf_frequency']), values=values, offsets=offsets)
+        lf = dict(source_ids=lf_source_ids, type_ids=lf_type_ids, timestamps_micros=start + lf_offsets,
+                  values=np.round(rng.uniform(40, 180, len(lf_source_ids)), 1))
+        yield lf, hf
+
+
+def write(store, workload):
+    """
+    Writes a workload to a store, with batches or one call per value/chunk (workload['batch']).
+    """
+    for lf, hf in steps(workload):
+        if workload['batch']:
+            store.write_lf_batch(**lf)
+            store.write_hf_batch(**hf)
+            continue
+        for row in zip(*(lf[k].tolist() for k in ('source_ids', 'type_ids', 'timestamps_micros', 'values'))):
+            store.write_lf(*row)
+        values, offsets = hf['values'], hf['offsets']
+        for j, (source_id, type_id, start) in enumerate(zip(hf['source_ids'].tolist(), hf['type_ids'].tolist(),
+                                                            hf['starts_micros'].tolist())):
+            store.write_hf(source_id, type_id, start, hf['frequencies'], values[offsets[j]:offsets[j + 1]].tolist())
@@ -0,0 +1,555 @@
+import os
+import struct
+import tempfile
+import threading
+import functools
+import collections
+
+import msgpack
+import numpy as np
+
+import compression
+
+MAGIC = b'PNCB'
+# Newest readable version, blocks are written with the oldest version able to describe them:
+# 1: raw columns, 2: columns may be encoded (see compression),
+# 3: rows sorted by type_id with a run index, encoded columns split by run
+VERSION = 3
+EXTENSION = '.pcb'
+LEGACY_EXTENSION = '.msgpck'
+EXTENSIONS = (EXTENSION, LEGACY_EXTENSION)
+
+# magic, version, flags, header length
+_PREAMBLE = struct.Struct('<4sHHI')
+_ALIGN = 8
+
+SCHEMA = {
+    'lf': {
+        'type_id': '<i4',
+        'timestamp_micros': '<i8',
+        'value': '<f8',
+    },
+    'hf': {
+        'type_id': '<i4',
+        'start_micros': '<i8',
+        'end_micros': '<i8',
+        'frequency': '<f8',
+        'offsets': '<i8',
+        'values': '<f8',
+    }
+}
+
+# hf rollup levels written with every block (bucket widths in microseconds): 1 s, 10 s, 1 min
+ROLLUP_RESOLUTIONS = (1000000, 10000000, 60000000)
+
+# One row per (type_id, bucket) holding hf samples, sum rather than mean so that partial buckets merge exactly
+ROLLUP_SCHEMA = {
+    'type_id': '<i4',
+    'bucket_micros': '<i8',
+    'count': '<i8',
+    'min': '<f8',
+    'max': '<f8',
+    'sum': '<f8',
+}
+
+
+def rollup_section(resolution_micros):
+    return 'rollup_{}'.format(resolution_micros)
+
+
+def section_schema(section):
+    if section.startswith('rollup_'):
+        return ROLLUP_SCHEMA
+    return SCHEMA[section]
+
+
+def _pad(n):
+    return (-n) % _ALIGN
+
+
+def empty_section(section):
+    columns = {name: np.empty(0, dtype=dtype) for name, dtype in section_schema(section).items()}
+    if section == 'hf':
+        columns['offsets'] = np.zeros(1, dtype=SCHEMA['hf']['offsets'])
+    return columns
+
+
+def take_rows(section, columns, index):
+    """
+    Selects rows (boolean mask or integer index) of section columns, hf values following their rows.
+    """
+    result = {name: array[index] for name, array in columns.items() if name not in ('offsets', 'values')}
+    if section == 'hf':
+        offsets = columns['offsets']
+        lengths = np.diff(offsets)[index]
+        starts = offsets[:-1][index]
+        new_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=new_offsets[1:])
+        # Position of every kept value in the source values array
+        positions = np.arange(new_offsets[-1], dtype=np.int64) + np.repeat(starts - new_offsets[:-1], lengths)
+        result['offsets'] = new_offsets
+        result['values'] = columns['values'][positions]
+    return result
+
+
+def concat_sections(section, parts):
+    """
+    Concatenates the columns of several sections, hf offsets being rebased on the concatenated values.
+    """
+    parts = list(parts)
+    if not parts:
+        return empty_section(section)
+    result = {name: np.concatenate([p[name] for p in parts]) for name in parts[0] if name != 'offsets'}
+    if section == 'hf':
+        lengths = np.concatenate([np.diff(p['offsets']) for p in parts])
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        result['offsets'] = offsets
+        result['values'] = np.concatenate([p['values'][p['offsets'][0]:p['offsets'][-1]] for p in parts])
+    return result
+
+
+def group_rollup(keys, count, minimum, maximum, total):
+    """
+    Merges the rollup rows sharing the same keys (list of arrays, the last one being the primary sort key).
+    Returns (keys, count, min, max, sum) sorted by keys.
+    """
+    if len(count) == 0:
+        return keys, count, minimum, maximum, total
+    order = np.lexsort(keys)
+    keys = [k[order] for k in keys]
+    change = np.zeros(len(order), dtype=bool)
+    change[0] = True
+    for k in keys:
+        change[1:] |= k[1:] != k[:-1]
+    starts = np.flatnonzero(change)
+    return ([k[starts] for k in keys], np.add.reduceat(count[order], starts),
+            np.minimum.reduceat(minimum[order], starts), np.maximum.reduceat(maximum[order], starts),
+            np.add.reduceat(total[order], starts))
+
+
+def row_anchors(hf):
+    """
+    Returns (anchors, first) of hf columns: the start_micros of the stored row every row comes from and the index
+    of its first sample in that row. Rows trimmed by a read carry first_sample, their start_micros being truncated
+    to the microsecond: timestamps are computed from the stored row start so that they do not drift.
+    """
+    starts = np.asarray(hf['start_micros'], dtype=np.int64)
+    if 'first_sample' not in hf:
+        return starts, np.zeros(len(starts), dtype=np.int64)
+    first = np.asarray(hf['first_sample'], dtype=np.int64)
+    return starts - (first / np.asarray(hf['frequency'], dtype=np.float64) * 1E6).astype(np.int64), first
+
+
+def sample_timestamps(hf):
+    """
+    Returns (rows, timestamps, values) of every sample of hf columns: the row holding it, its timestamp
+    (sample i of a stored row being at start_micros + int(i / frequency * 1E6)) and its value.
+    """
+    offsets = np.asarray(hf['offsets'], dtype=np.int64)
+    lengths = np.diff(offsets)
+    n = int(offsets[-1] - offsets[0])
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    anchors, first = row_anchors(hf)
+    index = np.arange(n, dtype=np.int64) - np.repeat(offsets[:-1] - offsets[0] - first, lengths)
+    frequency = np.asarray(hf['frequency'], dtype=np.float64)[rows]
+    timestamps = anchors[rows] + (index / frequency * 1E6).astype(np.int64)
+    values = np.asarray(hf['values'], dtype=np.float64)[offsets[0]:offsets[-1]]
+    return rows, timestamps, values
+
+
+def compute_rollup(hf, resolution_micros):
+    """
+    Returns the rollup section of hf columns at resolution_micros: samples are bucketed on their timestamp.
+    """
+    rows, timestamps, values = sample_timestamps(hf)
+    n = len(values)
+    if n == 0:
+        return empty_section(rollup_section(resolution_micros))
+
+    (bucket, type_id), count, minimum, maximum, total = group_rollup(
+        [timestamps // resolution_micros * resolution_micros, np.asarray(hf['type_id'])[rows]],
+        np.ones(n, dtype=np.int64), values, values, values)
+    return {'type_id': type_id, 'bucket_micros': bucket, 'count': count, 'min': minimum, 'max': maximum,
+            'sum': total}
+
+
+def _sort_runs(section, columns):
+    """
+    Returns the columns sorted by type_id (stable: time order is kept within a type_id) and their runs,
+    [[type_id, first row, last row + 1], ...].
+    """
+    type_id = np.asarray(columns['type_id'])
+    if np.any(type_id[1:] < type_id[:-1]):
+        columns = take_rows(section, {k: np.asarray(v) for k, v in columns.items()},
+                            np.argsort(type_id, kind='stable'))
+        type_id = columns['type_id']
+    type_ids, starts = np.unique(type_id, return_index=True)
+    ends = np.append(starts[1:], len(type_id))
+    return columns, [[int(t), int(lo), int(hi)] for t, lo, hi in zip(type_ids, starts, ends)]
+
+
+def write_block(path, sections, codecs=None, exclusive=False, sync=False, **meta):
+    """
+    Write a columnar block atomically (temporary file + rename).
+
+    sections: {'lf': {column: array}, 'hf': {column: array}}, hf 'values' being a flat array
+              delimited by 'offsets' (len(type_id) + 1 entries), plus optional rollup sections
+              ({rollup_section(resolution): compute_rollup(hf, resolution)})
+    codecs: {section: {column: codec}} (see compression), columns without codec are stored raw (memory-mappable)
+    Rows are stored sorted by type_id, each section header indexing the rows of every type_id (runs) so that
+    read_block(type_ids=...) only reads those. Encoded columns are encoded run by run for the same reason.
+    exclusive: never replace an existing file, path getting a '.<n>' suffix before its extension until the name
+               is free
+    sync: fsync the file before it gets its name
+    Returns (path of the written file, its size in bytes).
+    """
+    codecs = codecs or {}
+    version = 1
+    header = dict(meta, sections={})
+    arrays = []
+    offset = 0
+    for section, columns in sections.items():
+        dtypes = section_schema(section)
+        runs = None
+        if len(columns.get('type_id', ())):
+            columns, runs = _sort_runs(section, columns)
+            version = max(version, 3)
+
+        desc = {}
+        for name, array in columns.items():
+            array = np.ascontiguousarray(array, dtype=dtypes.get(name))
+            desc[name] = {'dtype': array.dtype.str, 'offset': offset, 'count': len(array)}
+            codec = codecs.get(section, {}).get(name)
+            if codec and len(array):
+                if runs is None or name == 'offsets':
+                    bounds = [(0, len(array))]
+                elif name == 'values':
+                    bounds = [(columns['offsets'][lo], columns['offsets'][hi]) for _, lo, hi in runs]
+                else:
+                    bounds = [(lo, hi) for _, lo, hi in runs]
+                payloads, parts, pos = [], [], 0
+                for lo, hi in bounds:
+                    payload, stage_dtypes = compression.encode(array[lo:hi], codec)
+                    parts.append([pos, len(payload), stage_dtypes])
+                    payloads.append(payload)
+                    pos += len(payload)
+                array = np.frombuffer(b''.join(payloads), dtype=np.uint8)
+                desc[name].update(codec=list(codec), parts=parts, nbytes=array.nbytes)
+                version = max(version, 2)
+            arrays.append(array)
+            offset += array.nbytes + _pad(array.nbytes)
+        rows = len(columns['type_id']) if 'type_id' in columns else 0
+        header['sections'][section] = {'rows': rows, 'columns': desc}
+        if runs is not None:
+            header['sections'][section]['runs'] = runs
+    header['version'] = version
+
+    packed_header = msgpack.packb(header, use_bin_type=True)
+    data_start = _PREAMBLE.size + len(packed_header)
+    data_start += _pad(data_start)
+
+    def write(f):
+        f.write(_PREAMBLE.pack(MAGIC, version, 0, len(packed_header)))
+        f.write(packed_header)
+        f.write(b'\0' * (data_start - _PREAMBLE.size - len(packed_header)))
+        for array in arrays:
+            f.write(array.tobytes())
+            f.write(b'\0' * _pad(array.nbytes))
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+
+    if not exclusive:
+        tmp = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.tmp')
+        with open(tmp, 'wb') as f:
+            write(f)
+        os.replace(tmp, path)
+        return path, data_start + offset
+
+    fd, tmp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        stem, extension = os.path.splitext(path)
+        i = 0
+        while True:
+            # link fails if the name exists, unlike rename: blocks of the same time range never replace each other
+            try:
+                os.link(tmp, path)
+                break
+            except FileExistsError:
+                i += 1
+                path = '{}.{}{}'.format(stem, i, extension)
+    finally:
+        os.remove(tmp)
+    return path, data_start + offset
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        magic, version, _, header_len = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+        if magic != MAGIC:
+            raise ValueError('{} is not a pancarte block'.format(path))
+        if version > VERSION:
+            raise ValueError('{} has unsupported block version {}'.format(path, version))
+        header = msgpack.unpackb(f.read(header_len), raw=False)
+    data_start = _PREAMBLE.size + header_len
+    header['data_start'] = data_start + _pad(data_start)
+    return header
+
+
+class _SectionReader:
+    """
+    Reads rows of the columns of one section, decoding only the encoded parts (runs) holding them.
+    """
+    def __init__(self, raw, data_start, section_header):
+        self.raw = raw
+        self.data_start = data_start
+        self.columns = section_header['columns']
+        self.runs = section_header.get('runs')
+        self._decoded = {}
+
+    def _part(self, desc, i, count):
+        if 'parts' in desc:
+            offset, nbytes, dtypes = desc['parts'][i]
+        else:
+            # Version 2: one part
+            offset, nbytes, dtypes = 0, desc['nbytes'], desc['dtypes']
+        start = self.data_start + desc['offset'] + offset
+        return compression.decode(self.raw[start:start + nbytes], desc['codec'], dtypes, count)
+
+    def column(self, name, lo, hi, run=None):
+        """
+        Items lo:hi of a column, run being the index of the run they are exactly made of, if any.
+        """
+        desc = self.columns[name]
+        dtype = np.dtype(desc['dtype'])
+        if desc['count'] == 0:
+            return np.empty(0, dtype=dtype)
+        if 'codec' not in desc:
+            start = self.data_start + desc['offset']
+            return self.raw[start + lo * dtype.itemsize:start + hi * dtype.itemsize].view(dtype)
+
+        by_run = len(desc.get('parts', ())) > 1
+        if by_run and run is not None:
+            return self._part(desc, run, hi - lo)
+        if name not in self._decoded:
+            if by_run:
+                bounds = self._bounds(name)
+                self._decoded[name] = np.concatenate([self._part(desc, i, b - a) for i, (a, b) in enumerate(bounds)])
+            else:
+                self._decoded[name] = self._part(desc, 0, desc['count'])
+        return self._decoded[name][lo:hi]
+
+    def _bounds(self, name):
+        if name == 'values':
+            offsets = self.column('offsets', 0, self.columns['offsets']['count'])
+            return [(offsets[lo], offsets[hi]) for _, lo, hi in self.runs]
+        return [(lo, hi) for _, lo, hi in self.runs]
+
+    def read(self, section, type_ids=None):
+        if type_ids is None or self.runs is None:
+            return {name: self.column(name, 0, desc['count']) for name, desc in self.columns.items()}
+
+        parts = []
+        for i, (type_id, lo, hi) in enumerate(self.runs):
+            if type_id not in type_ids:
+                continue
+            part = {}
+            for name in self.columns:
+                if name == 'offsets':
+                    offsets = self.column('offsets', lo, hi + 1)
+                    part['offsets'] = offsets - offsets[0]
+                elif name == 'values':
+                    offsets = self.column('offsets', lo, hi + 1)
+                    part['values'] = self.column('values', offsets[0], offsets[-1], i)
+                else:
+                    part[name] = self.column(name, lo, hi, i)
+            parts.append(part)
+        return concat_sections(section, parts)
+
+
+def _read_columnar(path, sections, header=None, type_ids=None):
+    header = header or read_header(path)
+    raw = None
+    result = {}
+    for section in sections:
+        if section not in header['sections']:
+            result[section] = empty_section(section)
+            continue
+        if raw is None:
+            raw = np.memmap(path, dtype=np.uint8, mode='r')
+        result[section] = _SectionReader(raw, header['data_start'], header['sections'][section])\
+            .read(section, type_ids)
+    return result
+
+
+def _read_legacy(path, sections):
+    with open(path, 'rb') as b:
+        json_store = msgpack.unpack(b, raw=False)
+
+    result = {}
+    for section in sections:
+        columns = {}
+        for name, dtype in SCHEMA[section].items():
+            if name in ('offsets', 'values'):
+                continue
+            columns[name] = np.asarray(json_store[section][name], dtype=dtype)
+        if section == 'hf':
+            values = json_store['hf']['values']
+            offsets = np.zeros(len(values) + 1, dtype=SCHEMA['hf']['offsets'])
+            np.cumsum([len(v) for v in values], out=offsets[1:])
+            columns['offsets'] = offsets
+            columns['values'] = np.fromiter((v for vv in values for v in vv), dtype=SCHEMA['hf']['values'],
+                                            count=offsets[-1])
+        result[section] = columns
+    return result
+
+
+class BlockCache:
+    """
+    Process-wide LRU cache of decoded block sections, keyed by path, evicting under a byte budget.
+
+    Blocks are immutable, an entry is only stale when its file is replaced or removed: entries are checked
+    against the file inode/mtime/size on every hit and can be dropped explicitly with invalidate().
+    """
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def get(self, path, section, stamp):
+        with self._lock:
+            entry = self._entries.get((path, section))
+            if entry is None or entry[0] != stamp:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((path, section))
+            self.hits += 1
+            return entry[1]
+
+    def put(self, path, section, stamp, columns):
+        nbytes = sum(c.nbytes for c in columns.values())
+        with self._lock:
+            if nbytes > self.max_bytes:
+                return
+            previous = self._entries.pop((path, section), None)
+            if previous is not None:
+                self._bytes -= previous[2]
+            self._entries[(path, section)] = (stamp, columns, nbytes)
+            self._bytes += nbytes
+            self._evict()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            _, (_, _, nbytes) = self._entries.popitem(last=False)
+            self._bytes -= nbytes
+            self.evictions += 1
+
+    def invalidate(self, path):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == path]:
+                self._bytes -= self._entries.pop(key)[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+block_cache = BlockCache()
+
+
+def _read_uncached(path, sections, type_ids=None):
+    if path.endswith(LEGACY_EXTENSION):
+        read = _read_legacy
+        available = ('lf', 'hf')
+    else:
+        header = read_header(path)
+        read = functools.partial(_read_columnar, header=header, type_ids=type_ids)
+        available = header['sections']
+
+    # Rollups missing from older blocks are computed from their hf section
+    missing = [s for s in sections if s.startswith('rollup_') and s not in available]
+    to_read = [s for s in sections if s not in missing]
+    if missing and 'hf' not in to_read:
+        to_read.append('hf')
+    result = read(path, to_read)
+    for section in missing:
+        result[section] = compute_rollup(result['hf'], int(section[len('rollup_'):]))
+    return {section: result[section] for section in sections}
+
+
+def read_block(path, sections=('lf', 'hf'), cache=True, type_ids=None):
+    """
+    Returns {section: {column: array}}. Raw columns are memory-mapped (no copy), encoded columns and legacy
+    msgpack blocks are decoded into arrays of the same layout. Sections are served from block_cache when it
+    has a budget, unless cache is False.
+
+    type_ids: only read the rows of these type_ids (blocks written before version 3 return all their rows)
+    """
+    if type_ids is not None:
+        type_ids = frozenset(int(t) for t in type_ids)
+    if not cache or block_cache.max_bytes <= 0:
+        return _read_uncached(path, sections, type_ids)
+
+    st = os.stat(path)
+    stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+    key = {section: section if type_ids is None else (section, type_ids) for section in sections}
+    result = {}
+    for section in sections:
+        columns = block_cache.get(path, key[section], stamp)
+        if columns is not None:
+            result[section] = columns
+    missing = [section for section in sections if section not in result]
+    if missing:
+        for section, columns in _read_uncached(path, missing, type_ids).items():
+            block_cache.put(path, key[section], stamp, columns)
+            result[section] = columns
+    return result
+
+
+def parse_block_name(name):
+    """
+    Returns (start_micros, end_micros) from a block file name, None if it is not a block.
+    """
+    if name.startswith('.') or not name.endswith(EXTENSIONS):
+        return None
+    s, e = name.split('.')[0].split('-')
+    return int(s), int(e)
+
+
+def block_stats(path):
+    """
+    Returns the row counts and type_ids present in a block, as recorded by the block manifest.
+    """
+    data = read_block(path)
+    return {
+        'lf_rows': len(data['lf']['type_id']),
+        'hf_rows': len(data['hf']['type_id']),
+        'type_ids': sorted(set(np.unique(data['lf']['type_id']).tolist()) |
+                           set(np.unique(data['hf']['type_id']).tolist())),
+        'byte_size': os.path.getsize(path),
+    }
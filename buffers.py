@@ -0,0 +1,169 @@
+"""
+Typed column buffers holding the rows of the memory caches until they are written to blocks.
+"""
+import numpy as np
+
+import blocks
+
+
+class ColumnBuffer:
+    """
+    Rows of one section (lf or hf, see blocks.SCHEMA) in growable NumPy arrays, the block section layout.
+
+    Rows arriving in time order, the usual case, are appended as is. Out-of-order rows mark the buffer unsorted,
+    it is sorted (stable) the next time its rows are read; MemoryCache sorts buffers when sealing them, a sealed
+    buffer is never modified again. Returned columns are views: appends only write past them and sorting
+    replaces the arrays, so they remain valid.
+    """
+    __slots__ = ('section', 'key', 'size', 'value_count', 'is_sorted', 'max_key', 'max_end', '_columns', '_capacity',
+                 '_value_capacity')
+
+    INITIAL_CAPACITY = 256
+    # Geometric growth keeps appends amortized O(1), 1.5 bounds the unused capacity to a third of the arrays
+    GROWTH = 1.5
+
+    def __init__(self, section):
+        self.section = section
+        self.key = 'timestamp_micros' if section == 'lf' else 'start_micros'
+        self.size = 0
+        # Values held: one per lf row, the samples of hf rows
+        self.value_count = 0
+        self.is_sorted = True
+        # Latest timestamp (lf) or start_micros (hf), latest hf end_micros
+        self.max_key = None
+        self.max_end = None
+
+        self._columns = {name: np.empty(self.INITIAL_CAPACITY, dtype=dtype)
+                         for name, dtype in blocks.SCHEMA[section].items()}
+        if section == 'hf':
+            self._columns['offsets'] = np.zeros(self.INITIAL_CAPACITY + 1, dtype=blocks.SCHEMA['hf']['offsets'])
+        self._capacities()
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        """
+        Bytes allocated by the buffer arrays.
+        """
+        return sum(a.nbytes for a in self._columns.values())
+
+    def _used(self, name):
+        if name == 'values':
+            return self.value_count
+        return self.size + 1 if name == 'offsets' else self.size
+
+    def _reserve(self, rows, values):
+        if self.size + rows <= self._capacity and self.value_count + values <= self._value_capacity:
+            return
+        for name, a in self._columns.items():
+            needed = self._used(name) + (values if name == 'values' else rows)
+            if needed > len(a):
+                grown = np.empty(max(needed, int(self.GROWTH * len(a))), dtype=a.dtype)
+                grown[:self._used(name)] = a[:self._used(name)]
+                self._columns[name] = grown
+        self._capacities()
+
+    def _capacities(self):
+        columns = self._columns
+        self._capacity = len(columns['type_id'])
+        if 'offsets' in columns:
+            self._capacity = min(self._capacity, len(columns['offsets']) - 1)
+        self._value_capacity = len(columns['values']) if 'values' in columns else self._capacity
+
+    def _keys_added(self, first, last, ordered=True):
+        if not ordered or (self.max_key is not None and first < self.max_key):
+            self.is_sorted = False
+        if self.max_key is None or last > self.max_key:
+            self.max_key = last
+
+    def append(self, row):
+        """
+        Appends a MemoryCache row: (type_id, value, timestamp_micros) for lf, (type_id, values, start_micros,
+        end_micros, frequency) for hf.
+        """
+        i = self.size
+        columns = self._columns
+        if self.section == 'lf':
+            type_id, value, key = row
+            self._reserve(1, 0)
+            columns['value'][i] = value
+            self.value_count += 1
+        else:
+            type_id, values, key, end_micros, frequency = row
+            n = len(values)
+            self._reserve(1, n)
+            columns['values'][self.value_count:self.value_count + n] = values
+            self.value_count += n
+            columns['offsets'][i + 1] = self.value_count
+            columns['end_micros'][i] = end_micros
+            columns['frequency'][i] = frequency
+            if self.max_end is None or end_micros > self.max_end:
+                self.max_end = end_micros
+        columns['type_id'][i] = type_id
+        columns[self.key][i] = key
+        self.size += 1
+        self._keys_added(key, key)
+
+    def extend(self, columns):
+        """
+        Appends rows given as section columns (hf offsets may start anywhere in values).
+        """
+        keys = columns[self.key]
+        n = len(keys)
+        if n == 0:
+            return
+        i = self.size
+        if self.section == 'hf':
+            offsets = columns['offsets']
+            values = columns['values'][offsets[0]:offsets[-1]]
+            self._reserve(n, len(values))
+            self._columns['values'][self.value_count:self.value_count + len(values)] = values
+            self._columns['offsets'][i + 1:i + n + 1] = offsets[1:] - offsets[0] + self.value_count
+            self.value_count += len(values)
+            end_micros = int(np.max(columns['end_micros']))
+            if self.max_end is None or end_micros > self.max_end:
+                self.max_end = end_micros
+        else:
+            self._reserve(n, 0)
+            self.value_count += n
+        for name in blocks.SCHEMA[self.section]:
+            if name not in ('offsets', 'values'):
+                self._columns[name][i:i + n] = columns[name]
+        self.size += n
+        self._keys_added(int(keys[0]), int(np.max(keys)), not np.any(keys[1:] < keys[:-1]))
+
+    def sort(self):
+        if self.is_sorted:
+            return
+        columns = self._views()
+        self._columns = blocks.take_rows(self.section, columns, np.argsort(columns[self.key], kind='stable'))
+        self._capacities()
+        self.is_sorted = True
+
+    def _views(self):
+        return {name: a[:self._used(name)] for name, a in self._columns.items()}
+
+    def columns(self):
+        """
+        Returns the section columns of the rows, in time order.
+        """
+        self.sort()
+        return self._views()
+
+    def range(self, lower, upper):
+        """
+        Returns the section columns of the rows keyed in [lower, upper), None if there is none.
+        hf offsets index the whole values array.
+        """
+        self.sort()
+        keys = self._columns[self.key][:self.size]
+        lo, hi = np.searchsorted(keys, [lower, upper], side='left').tolist()
+        if lo == hi:
+            return None
+        res = {name: a[lo:hi] for name, a in self._columns.items() if name not in ('offsets', 'values')}
+        if self.section == 'hf':
+            res['offsets'] = self._columns['offsets'][lo:hi + 1]
+            res['values'] = self._columns['values'][:self.value_count]
+        return res
@@ -0,0 +1,189 @@
+import os
+import time
+import threading
+import traceback
+
+import numpy as np
+
+import blocks
+
+
+class TokenBucket:
+    """
+    Limits a flow of bytes to rate bytes per second, allowing bursts of burst bytes.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Going into debt lets a request larger than burst through after the matching wait
+            self._tokens -= n
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Compactor:
+    """
+    Merges adjacent small blocks of a source_id into larger sorted blocks, within a partition directory.
+
+    A merged block replaces its sources in the manifest in one transaction taken under the store view lock,
+    readers list either the sources or the merged block, never both. The sources are removed after
+    grace_period seconds, once the readers that listed them are done. Merged blocks record the blocks they
+    replace (compacted_from) so that rebuild_manifest ignores sources left over by a crash.
+    """
+    def __init__(self, store, target_bytes=64 * 2 ** 20, target_span=None, io_rate=None, interval=None,
+                 grace_period=60.0):
+        """
+        target_bytes: blocks are merged until the result reaches this size, larger blocks are left alone
+        target_span: maximum time span (microseconds) of a merged block
+        io_rate: bytes per second read and written by the compaction, unlimited if None
+        interval: seconds between background compactions of every source, no background compaction if None
+        """
+        self.store = store
+        self.target_bytes = target_bytes
+        self.target_span = target_span
+        self.grace_period = grace_period
+        self.throttle = TokenBucket(io_rate) if io_rate else None
+
+        self._lock = threading.Lock()
+        self._retired = []
+        self._retired_lock = threading.Lock()
+
+        self._stopped = threading.Event()
+        self._thread = None
+        if interval is not None:
+            self._thread = threading.Thread(target=self._run, args=(interval,), name='pancarte-compact',
+                                            daemon=True)
+            self._thread.start()
+
+    def _consume(self, n):
+        if self.throttle is not None:
+            self.throttle.consume(n)
+
+    def groups(self, entries):
+        """
+        Returns the lists of manifest entries to merge: consecutive small blocks of a same directory.
+        """
+        by_directory = {}
+        for e in entries:
+            by_directory.setdefault(os.path.dirname(e['path']), []).append(e)
+
+        groups = []
+        for directory_entries in by_directory.values():
+            current, size = [], 0
+            for e in directory_entries:
+                full = current and (size + e['byte_size'] > self.target_bytes or
+                                    (self.target_span is not None and
+                                     e['end_micros'] - current[0]['start_micros'] > self.target_span))
+                if e['byte_size'] >= self.target_bytes or full:
+                    if len(current) > 1:
+                        groups.append(current)
+                    current, size = [], 0
+                if e['byte_size'] < self.target_bytes:
+                    current.append(e)
+                    size += e['byte_size']
+            if len(current) > 1:
+                groups.append(current)
+        return groups
+
+    def compact(self, source_id, partition=None):
+        """
+        Compacts the blocks of source_id, only the ones of a partition directory if given (e.g. '2018/05/02').
+        Returns the number of merged blocks written.
+        """
+        with self._lock:
+            written = 0
+            for group in self.groups(self.store.manifest.entries(source_id, partition)):
+                if self._stopped.is_set():
+                    break
+                written += self._merge(source_id, group)
+        self.collect()
+        return written
+
+    def compact_all(self):
+        return sum(self.compact(source_id) for source_id in self.store.manifest.sources())
+
+    def _merge(self, source_id, group):
+        paths = [e['path'] for e in group]
+        parts = {'lf': [], 'hf': []}
+        for e in group:
+            self._consume(e['byte_size'])
+            data = blocks.read_block(e['path'], cache=False)
+            for section in parts:
+                parts[section].append(data[section])
+
+        sections = {}
+        for section, key in (('lf', 'timestamp_micros'), ('hf', 'start_micros')):
+            columns = blocks.concat_sections(section, parts[section])
+            order = np.argsort(columns[key], kind='stable')
+            sections[section] = blocks.take_rows(section, columns, order)
+        for resolution in self.store.rollups:
+            sections[blocks.rollup_section(resolution)] = blocks.compute_rollup(sections['hf'], resolution)
+
+        start_micros = min(e['start_micros'] for e in group)
+        end_micros = max(e['end_micros'] for e in group)
+        directory = os.path.dirname(paths[0])
+        dst = os.path.join(directory, '{}-{}{}'.format(start_micros, end_micros, blocks.EXTENSION))
+        # The merged blocks are removed once it is swapped in: it must be durable before the manifest names it
+        dst, byte_size = blocks.write_block(dst, sections, codecs=self.store.codecs, exclusive=True, sync=True,
+                                            source_id=str(source_id), start_micros=start_micros,
+                                            end_micros=end_micros,
+                                            compacted_from=[os.path.basename(p) for p in paths])
+        self._consume(byte_size)
+
+        type_ids = set()
+        for e in group:
+            type_ids.update(int(t) for t in e['type_ids'].split(',') if t)
+        entry = dict(source_id=str(source_id), path=dst, start_micros=start_micros, end_micros=end_micros,
+                     lf_rows=len(sections['lf']['type_id']), hf_rows=len(sections['hf']['type_id']),
+                     type_ids=sorted(type_ids), byte_size=byte_size)
+
+        with self.store._view_lock:
+            swapped = self.store.manifest.replace(paths, entry)
+        if not swapped:
+            # A source block went away meanwhile (rebuilt manifest, concurrent compaction)
+            os.remove(dst)
+            return 0
+
+        with self._retired_lock:
+            self._retired.append((time.monotonic() + self.grace_period, paths))
+        return 1
+
+    def collect(self, force=False):
+        """
+        Removes the merged blocks whose grace period is over (all of them if force).
+        """
+        now = time.monotonic()
+        with self._retired_lock:
+            expired = [paths for deadline, paths in self._retired if force or deadline <= now]
+            self._retired = [(deadline, paths) for deadline, paths in self._retired
+                             if not (force or deadline <= now)]
+        for paths in expired:
+            for path in paths:
+                blocks.block_cache.invalidate(path)
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _run(self, interval):
+        while not self._stopped.wait(interval):
+            try:
+                self.compact_all()
+            except Exception:
+                traceback.print_exc()
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.collect(force=True)
@@ -0,0 +1,119 @@
+"""
+Column codecs of the immutable blocks.
+
+A codec is a list of stages applied in order when encoding, e.g. ['xor', 'shuffle', 'zlib']:
+- 'delta': differences between consecutive integers (sorted timestamps, offsets)
+- 'dod': delta of delta (timestamps at a fixed rate become zeros)
+- 'xor': XOR of consecutive float64 bit patterns, the vectorizable part of Gorilla encoding
+- 'quantize:<step>': floats rounded to integer multiples of step (lossy, error <= step / 2)
+- 'shuffle': groups the n-th byte of every item together so that the compressors see the runs of zeros
+- 'zlib[:<level>]', 'lzma[:<preset>]': stdlib compressors
+Array stages come first, compressors last. Every stage decodes with vectorized NumPy (or C) code.
+"""
+import lzma
+import zlib
+
+import numpy as np
+
+# Presets usable as ImmutableStore(codecs=...): {section: {column: codec}}, see python3 -m benchmarks.compression
+PRESETS = {
+    'none': {},
+    'fast': {
+        'lf': {'timestamp_micros': ['delta', 'shuffle', 'zlib:1'], 'value': ['zlib:1']},
+        'hf': {'start_micros': ['delta', 'shuffle', 'zlib:1'], 'end_micros': ['delta', 'shuffle', 'zlib:1'],
+               'offsets': ['delta', 'shuffle', 'zlib:1'], 'values': ['zlib:1']},
+    },
+    'small': {
+        'lf': {'timestamp_micros': ['delta', 'shuffle', 'lzma'], 'value': ['xor', 'lzma']},
+        'hf': {'start_micros': ['delta', 'shuffle', 'lzma'], 'end_micros': ['delta', 'shuffle', 'lzma'],
+               'offsets': ['delta', 'shuffle', 'lzma'], 'values': ['xor', 'lzma']},
+    },
+}
+
+
+def _parse(stage):
+    name, _, arg = stage.partition(':')
+    return name, arg
+
+
+def _delta(a):
+    out = np.empty_like(a)
+    if len(a):
+        out[0] = a[0]
+        np.subtract(a[1:], a[:-1], out=out[1:])
+    return out
+
+
+def _encode_array(name, arg, a):
+    if name == 'delta':
+        return _delta(a.astype(np.int64, copy=False))
+    if name == 'dod':
+        return _delta(_delta(a.astype(np.int64, copy=False)))
+    if name == 'xor':
+        u = a.astype('<f8', copy=False).view('<u8')
+        out = np.empty_like(u)
+        if len(u):
+            out[0] = u[0]
+            np.bitwise_xor(u[1:], u[:-1], out=out[1:])
+        return out
+    if name == 'quantize':
+        return np.rint(a / float(arg)).astype(np.int64)
+    if name == 'shuffle':
+        return np.ascontiguousarray(a.view(np.uint8).reshape(-1, a.dtype.itemsize).T).reshape(-1)
+    raise ValueError('unknown codec stage {}'.format(name))
+
+
+def _decode_array(name, arg, a, dtype, count):
+    if name == 'delta':
+        return np.cumsum(a, dtype=np.int64).astype(dtype, copy=False)
+    if name == 'dod':
+        return np.cumsum(np.cumsum(a, dtype=np.int64), dtype=np.int64).astype(dtype, copy=False)
+    if name == 'xor':
+        return np.bitwise_xor.accumulate(a).view('<f8').astype(dtype, copy=False)
+    if name == 'quantize':
+        return (a * float(arg)).astype(dtype)
+    if name == 'shuffle':
+        return np.ascontiguousarray(a.reshape(dtype.itemsize, count).T).reshape(-1).view(dtype)
+    raise ValueError('unknown codec stage {}'.format(name))
+
+
+def encode(array, codec):
+    """
+    Returns (payload bytes, dtypes), dtypes being the input dtype of every array stage (needed to decode).
+    """
+    dtypes = []
+    a = np.ascontiguousarray(array)
+    data = None
+    for stage in codec:
+        name, arg = _parse(stage)
+        if name == 'zlib':
+            data = zlib.compress(data if data is not None else a.tobytes(), int(arg or 6))
+        elif name == 'lzma':
+            data = lzma.compress(data if data is not None else a.tobytes(), preset=int(arg or 6))
+        else:
+            if data is not None:
+                raise ValueError('array stage {} after a compressor in {}'.format(name, codec))
+            dtypes.append(a.dtype.str)
+            a = _encode_array(name, arg, a)
+    if data is None:
+        data = a.tobytes()
+    return data, dtypes + [a.dtype.str]
+
+
+def decode(payload, codec, dtypes, count):
+    """
+    Inverse of encode, count being the number of items of the column.
+    """
+    array_stages = [_parse(s) for s in codec if _parse(s)[0] not in ('zlib', 'lzma')]
+    data = payload
+    for stage in reversed(codec):
+        name, _ = _parse(stage)
+        if name == 'zlib':
+            data = zlib.decompress(data)
+        elif name == 'lzma':
+            data = lzma.decompress(data)
+
+    a = np.frombuffer(data, dtype=np.dtype(dtypes[-1]))
+    for (name, arg), dtype in zip(reversed(array_stages), reversed(dtypes[:-1])):
+        a = _decode_array(name, arg, a, np.dtype(dtype), count)
+    return a
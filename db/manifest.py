@@ -0,0 +1,45 @@
+from sqlalchemy import Column, Integer, String, BigInteger, Index
+from sqlalchemy.ext.declarative import declarative_base
+
+ManifestBase = declarative_base()
+
+
+class BlockEntry(ManifestBase):
+    __tablename__ = 'block'
+
+    id = Column(Integer, primary_key=True)
+    source_id = Column(String, nullable=False)
+    path = Column(String, unique=True, nullable=False)
+
+    start_micros = Column(BigInteger, nullable=False)
+    end_micros = Column(BigInteger, nullable=False)
+    span_micros = Column(BigInteger, nullable=False)
+
+    lf_rows = Column(BigInteger, nullable=False, default=0)
+    hf_rows = Column(BigInteger, nullable=False, default=0)
+    type_ids = Column(String, nullable=False, default='')
+    byte_size = Column(BigInteger, nullable=False, default=0)
+
+    __table_args__ = (
+        Index('ix_block_source_start', 'source_id', 'start_micros'),
+        Index('ix_block_source_span', 'source_id', 'span_micros'),
+        Index('ix_block_start', 'start_micros'),
+        Index('ix_block_span', 'span_micros'),
+    )
+
+    def to_json(self):
+        return {
+            'id': self.id,
+            'source_id': self.source_id,
+            'path': self.path,
+            'start_micros': self.start_micros,
+            'end_micros': self.end_micros,
+            'lf_rows': self.lf_rows,
+            'hf_rows': self.hf_rows,
+            'type_ids': [int(t) for t in self.type_ids.split(',') if t],
+            'byte_size': self.byte_size,
+        }
+
+    def __repr__(self):
+        return "{}(id={}, source_id={}, start={}, end={}, path={})"\
+            .format(self.__tablename__, self.id, self.source_id, self.start_micros, self.end_micros, self.path)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, BigInteger, ForeignKey, Float
+from sqlalchemy import Column, Integer, String, BigInteger, ForeignKey, Float, Index
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -28,6 +28,11 @@ class TimestampAnnotation(Base):
 
     timestamp_micros = Column(BigInteger, nullable=False)
 
+    __table_args__ = (
+        Index('ix_timestamp_annotation_source_time', 'source_id', 'timestamp_micros'),
+        Index('ix_timestamp_annotation_type_time', 'type_id', 'timestamp_micros'),
+    )
+
     def to_json(self):
         return {
             'id': self.id,
@@ -55,6 +60,12 @@ class TimerangeAnnotation(Base):
     start_micros = Column(BigInteger, nullable=False)
     end_micros = Column(BigInteger, nullable=False)
 
+    # end_micros is part of the index so that overlap queries filter on it without reading the rows
+    __table_args__ = (
+        Index('ix_timerange_annotation_source_time', 'source_id', 'start_micros', 'end_micros'),
+        Index('ix_timerange_annotation_type_time', 'type_id', 'start_micros', 'end_micros'),
+    )
+
     def to_json(self):
         return {
             'id': self.id,
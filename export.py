@@ -0,0 +1,340 @@
+"""
+Export of the store to Hive-style partitioned columnar files, for Hive, Spark, Presto or any Hadoop tool:
+
+    <output>/lf/source_id=<id>/date=<YYYY-MM-DD>/hour=<HH>/part-<hour start micros>.parquet
+    <output>/hf/source_id=<id>/date=<YYYY-MM-DD>/hour=<HH>/part-<hour start micros>.parquet
+
+Partitions are UTC hours, only closed ones are exported: hours ending before now - delay, the delay covering the time
+values can wait in the memory caches of the writing process (time_margin + max_cache_age of the store) plus
+FLUSH_ALLOWANCE for the flush queue. lf files hold type_id, timestamp_micros and value, hf chunks are exploded into
+one row per sample (type_id, timestamp_micros, value, frequency), sample i of a chunk being at
+start_micros + int(i / frequency * 1E6). source_id, date and hour are partition columns, not stored in the files.
+
+Parquet files are written with pyarrow when it is installed, gzipped headerless CSV files (Hive text tables) are
+written otherwise. Rows are read block by block (ImmutableStore.read_blocks) and written in row groups of
+row_group_rows, memory stays bounded by one decoded block and one row group whatever the size of a partition.
+Files appear under their final name once complete. <output>/_checkpoint.json keeps the end of the last exported hour of
+every source_id and when it was exported: the next run exports the hours closed since, and exports again the hours
+receiving blocks after their export (values written late, blocks of another store copied in).
+
+    python3 export.py --location test_db --output export
+"""
+import argparse
+import csv
+import datetime
+import gzip
+import json
+import os
+import time
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+import blocks
+import metrics
+
+HOUR_MICROS = 3600 * 10 ** 6
+
+FORMATS = ('parquet', 'csv')
+EXTENSIONS = {'parquet': '.parquet', 'csv': '.csv.gz'}
+
+# Columns of the exported files
+SCHEMA = {
+    'lf': [('type_id', '<i4'), ('timestamp_micros', '<i8'), ('value', '<f8')],
+    'hf': [('type_id', '<i4'), ('timestamp_micros', '<i8'), ('value', '<f8'), ('frequency', '<f8')],
+}
+
+CHECKPOINT = '_checkpoint.json'
+
+# Time for a sealed cache to go through the flush queue of the writing process
+FLUSH_ALLOWANCE = datetime.timedelta(minutes=1)
+# Blocks are found in the manifest shortly after their file is written, blocks modified this long before an export
+# count as new at the next one
+MTIME_SLACK = 10.
+
+EXPORT_ROWS = metrics.registry.counter('pancarte_export_rows', 'Rows written by the exporter', ['section'])
+EXPORT_SECONDS = metrics.registry.histogram('pancarte_export_partition_seconds',
+                                            'Time to export one source_id hour')
+
+
+def default_format():
+    return 'parquet' if pyarrow is not None else 'csv'
+
+
+def hour_partition(hour_micros):
+    """
+    Returns the (date, hour) partition values of the UTC hour starting at hour_micros.
+    """
+    dt = datetime.datetime.fromtimestamp(hour_micros // 10 ** 6, datetime.timezone.utc)
+    return dt.strftime('%Y-%m-%d'), dt.strftime('%H')
+
+
+def explode_hf(hf, max_samples):
+    """
+    Yields the samples of hf result columns (read_blocks arrays) as exported hf columns, max_samples per piece at most
+    (a chunk is never split, one longer than that is a piece of its own).
+    """
+    offsets = np.asarray(hf['offsets'], dtype=np.int64)
+    first = 0
+    while first < len(offsets) - 1:
+        last = int(np.searchsorted(offsets, offsets[first] + max_samples, side='right')) - 1
+        last = max(last, first + 1)
+        piece = {'offsets': offsets[first:last + 1], 'values': hf['values']}
+        for col in ('type_id', 'start_micros', 'frequency', 'first_sample'):
+            if col in hf:
+                piece[col] = hf[col][first:last]
+        rows, timestamps, values = blocks.sample_timestamps(piece)
+        yield {'type_id': piece['type_id'][rows], 'timestamp_micros': timestamps, 'value': values,
+               'frequency': piece['frequency'][rows]}
+        first = last
+
+
+class PartWriter:
+    """
+    Writes one partition file in row groups of row_group_rows, under a hidden temporary name until close().
+    """
+    def __init__(self, path, section, fmt, row_group_rows):
+        self.path = path
+        self.columns = SCHEMA[section]
+        self.fmt = fmt
+        self.row_group_rows = row_group_rows
+        self.rows = 0
+        self._pending = []
+        self._pending_rows = 0
+        directory, name = os.path.split(path)
+        os.makedirs(directory, exist_ok=True)
+        # Hive and Spark skip the files starting with '.' or '_'
+        self._tmp_path = os.path.join(directory, '.' + name + '.tmp')
+        if fmt == 'parquet':
+            schema = pyarrow.schema([(col, pyarrow.from_numpy_dtype(np.dtype(dtype))) for col, dtype in self.columns])
+            self._writer = pyarrow.parquet.ParquetWriter(self._tmp_path, schema)
+        else:
+            self._file = gzip.open(self._tmp_path, 'wt', newline='')
+            self._writer = csv.writer(self._file)
+
+    def write(self, columns):
+        """
+        Buffers rows ({column: array}), writing every complete row group.
+        """
+        n = len(columns['type_id'])
+        if not n:
+            return
+        self._pending.append([np.asarray(columns[col], dtype=dtype) for col, dtype in self.columns])
+        self._pending_rows += n
+        while self._pending_rows >= self.row_group_rows:
+            self._write_group(self.row_group_rows)
+
+    def _write_group(self, n):
+        merged = [np.concatenate(arrays) for arrays in zip(*self._pending)]
+        group = [column[:n] for column in merged]
+        self._pending = [[column[n:] for column in merged]] if len(merged[0]) > n else []
+        self._pending_rows -= len(group[0])
+        if self.fmt == 'parquet':
+            self._writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(column) for column in group], names=[col for col, _ in self.columns]),
+                row_group_size=len(group[0]))
+        else:
+            # str() of a float64 is its shortest exact representation
+            self._writer.writerows(zip(*[column.astype(str) for column in group]))
+        self.rows += len(group[0])
+
+    def close(self):
+        if self._pending_rows:
+            self._write_group(self._pending_rows)
+        if self.fmt == 'parquet':
+            self._writer.close()
+        else:
+            self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        try:
+            if self.fmt == 'parquet':
+                self._writer.close()
+            else:
+                self._file.close()
+        finally:
+            os.remove(self._tmp_path)
+
+
+class Exporter:
+    def __init__(self, store, output, fmt=None, row_group_rows=2 ** 20, delay=None):
+        """
+        store: ImmutableStore whose blocks are exported
+        output: root directory of the lf and hf tables
+        fmt: 'parquet' (needs pyarrow) or 'csv', default: parquet when pyarrow is installed
+        row_group_rows: rows per row group (per CSV write), the memory used by a file being written
+        delay: timedelta after its end before an hour is exported, default: time_margin + max_cache_age of the store
+               + FLUSH_ALLOWANCE (give the settings of the writing process when they differ)
+        """
+        fmt = fmt or default_format()
+        if fmt not in FORMATS:
+            raise ValueError('fmt must be one of {}'.format(', '.join(FORMATS)))
+        if fmt == 'parquet' and pyarrow is None:
+            raise ValueError('the parquet format needs pyarrow')
+        self.store = store
+        self.output = output
+        self.fmt = fmt
+        self.row_group_rows = int(row_group_rows)
+        if delay is None:
+            delay = store.time_margin + (store.max_cache_age or datetime.timedelta(0)) + FLUSH_ALLOWANCE
+        self.delay = delay
+        self.checkpoint_path = os.path.join(output, CHECKPOINT)
+
+    def load_checkpoint(self):
+        """
+        Returns {source_id: {'until': end of the last exported hour (micros), 'exported_at': start of the export
+        (seconds since the epoch)}}.
+        """
+        try:
+            with open(self.checkpoint_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save_checkpoint(self, checkpoint):
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def watermark(self):
+        """
+        Returns the end of the closed hours (micros): values before now - delay are in blocks.
+        """
+        settled = int(time.time() * 1E6) - int(self.delay.total_seconds() * 1E6)
+        return settled // HOUR_MICROS * HOUR_MICROS
+
+    def hours(self, source_id, since=None, until=None, modified_after=None):
+        """
+        Returns the start of the closed hours of source_id holding blocks, from since (included) to until, and
+        before since the hours of the blocks modified after modified_after (seconds since the epoch).
+        """
+        until = self.watermark() if until is None else min(until, self.watermark())
+        if since is not None:
+            since = -(-since // HOUR_MICROS) * HOUR_MICROS
+        hours = set()
+        for entry in self.store.manifest.entries(source_id):
+            first = entry['start_micros']
+            if since is not None and not self._modified_after(entry, modified_after):
+                first = max(first, since)
+            hours.update(range(first // HOUR_MICROS * HOUR_MICROS, min(entry['end_micros'], until), HOUR_MICROS))
+        return sorted(hours)
+
+    @staticmethod
+    def _modified_after(entry, modified_after):
+        if modified_after is None:
+            return False
+        try:
+            return os.path.getmtime(entry['path']) >= modified_after
+        except FileNotFoundError:
+            # Removed after a compaction, the merged block is listed too
+            return False
+
+    def path(self, section, source_id, hour_micros):
+        date, hour = hour_partition(hour_micros)
+        return os.path.join(self.output, section, 'source_id={}'.format(source_id), 'date={}'.format(date),
+                            'hour={}'.format(hour), 'part-{}{}'.format(hour_micros, EXTENSIONS[self.fmt]))
+
+    def export_hour(self, source_id, hour_micros):
+        """
+        Rewrites the hour of source_id starting at hour_micros, returns the rows written {'lf': n, 'hf': n}.
+        An hour without rows of a section has no file of that section.
+        """
+        t0 = time.perf_counter()
+        writers = {}
+
+        def writer(section):
+            if section not in writers:
+                writers[section] = PartWriter(self.path(section, source_id, hour_micros), section, self.fmt,
+                                              self.row_group_rows)
+            return writers[section]
+
+        try:
+            for res in self.store.read_blocks(hour_micros, hour_micros + HOUR_MICROS, arrays=True,
+                                              source_id=source_id):
+                if len(res['lf']['type_id']):
+                    writer('lf').write(res['lf'])
+                if len(res['hf']['type_id']):
+                    for piece in explode_hf(res['hf'], self.row_group_rows):
+                        writer('hf').write(piece)
+        except BaseException:
+            for w in writers.values():
+                w.abort()
+            raise
+        rows = {'lf': 0, 'hf': 0}
+        for section, w in writers.items():
+            w.close()
+            rows[section] = w.rows
+            EXPORT_ROWS.inc(w.rows, section)
+        EXPORT_SECONDS.observe(time.perf_counter() - t0)
+        return rows
+
+    def export(self, source_ids=None, since=None, until=None):
+        """
+        Exports the closed hours of source_ids (default: every source_id) not exported yet and the exported ones
+        holding blocks written since their export, or every hour from since (micros) when given. The checkpoint is
+        saved after every hour, an interrupted export resumes from the last complete one.
+        Returns {source_id: {'hours': n, 'lf': rows, 'hf': rows}}.
+        """
+        started = time.time()
+        checkpoint = self.load_checkpoint()
+        if source_ids is None:
+            source_ids = self.store.manifest.sources()
+        summary = {}
+        for source_id in source_ids:
+            source_id = str(source_id)
+            done = summary[source_id] = {'hours': 0, 'lf': 0, 'hf': 0}
+            state = checkpoint.get(source_id, {'until': None, 'exported_at': None})
+            if since is not None:
+                hours = self.hours(source_id, since, until)
+            else:
+                modified_after = state['exported_at'] - MTIME_SLACK if state['exported_at'] is not None else None
+                hours = self.hours(source_id, state['until'], until, modified_after)
+            for hour_micros in hours:
+                rows = self.export_hour(source_id, hour_micros)
+                done['hours'] += 1
+                done['lf'] += rows['lf']
+                done['hf'] += rows['hf']
+                checkpoint[source_id] = dict(state, until=max(state['until'] or 0, hour_micros + HOUR_MICROS))
+                self._save_checkpoint(checkpoint)
+            # Blocks found after this point are new at the next export
+            checkpoint[source_id] = dict(checkpoint.get(source_id, state), exported_at=started)
+            self._save_checkpoint(checkpoint)
+        return summary
+
+
+def main():
+    from storage import ImmutableStore
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--location', default='test_db')
+    parser.add_argument('--output', default='export')
+    parser.add_argument('--format', choices=FORMATS, default=default_format())
+    parser.add_argument('--row-group-rows', type=int, default=2 ** 20)
+    parser.add_argument('--source-id', action='append', help='export only these source_ids (repeatable)')
+    parser.add_argument('--since', type=int, help='rewrite the hours from these micros instead of the checkpoint')
+    parser.add_argument('--until', type=int, help='stop at these micros (at most the closed hours)')
+    parser.add_argument('--delay-seconds', type=float,
+                        help='time after its end before an hour is exported (default: see Exporter)')
+    args = parser.parse_args()
+
+    store = ImmutableStore(location=args.location)
+    try:
+        delay = datetime.timedelta(seconds=args.delay_seconds) if args.delay_seconds is not None else None
+        exporter = Exporter(store, args.output, fmt=args.format, row_group_rows=args.row_group_rows, delay=delay)
+        summary = exporter.export(source_ids=args.source_id, since=args.since, until=args.until)
+    finally:
+        store.close()
+    for source_id, done in sorted(summary.items()):
+        print('source_id={}: {} hours, {:,} lf rows, {:,} hf rows'.format(source_id, done['hours'], done['lf'],
+                                                                        done['hf']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+"""
+Asyncio TCP ingestion server for monitor gateways keeping long-lived connections.
+
+Every message is a frame: a big-endian uint32 length followed by that many bytes, the first one giving the kind.
+Client to server:
+- HF (0x01): little-endian source_id int64, type_id int32, start_micros int64, frequency float64, count uint32,
+  then count float32 values
+Server to client:
+- ACK (0x81): little-endian uint64, number of frames of the connection written to the store so far (cumulative)
+- ERROR (0x82): utf-8 message, the server closes the connection after sending it
+
+Frames are batched per connection into ImmutableStore.write_hf_batch, a batch the store rejects (e.g. a frequency
+that is not finite and > 0) closing the connection with an error. An ack means the frames are in the memory
+caches (in the write-ahead log too when the store has one). Flow control: a connection stops being read while
+queue_frames of its frames wait to be written, TCP then pushes back on the client.
+
+    python3 ingest.py serve --location test_db --port 9000
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import struct
+import threading
+
+import numpy as np
+
+HF = 0x01
+ACK = 0x81
+ERROR = 0x82
+
+_LENGTH = struct.Struct('>I')
+# kind, source_id, type_id, start_micros, frequency, number of values
+_HF = struct.Struct('<BqiqdI')
+_ACK = struct.Struct('<BQ')
+
+MAX_FRAME_BYTES = 16 * 2 ** 20
+
+
+def pack_hf(source_id, type_id, start_micros, frequency, values):
+    """
+    Returns the HF frame of a chunk, values being sent as float32.
+    """
+    values = np.asarray(values, dtype='<f4')
+    body = _HF.pack(HF, source_id, type_id, start_micros, frequency, len(values)) + values.tobytes()
+    return _LENGTH.pack(len(body)) + body
+
+
+def unpack_hf(body):
+    """
+    Returns (source_id, type_id, start_micros, frequency, values) of the body of an HF frame.
+    """
+    if not body or body[0] != HF:
+        raise ValueError('unknown frame kind {:#x}'.format(body[0]) if body else 'empty frame')
+    _, source_id, type_id, start_micros, frequency, count = _HF.unpack_from(body)
+    if len(body) != _HF.size + 4 * count:
+        raise ValueError('frame of {} bytes for {} values'.format(len(body), count))
+    return source_id, type_id, start_micros, frequency, np.frombuffer(body, dtype='<f4', count=count,
+                                                                       offset=_HF.size)
+
+
+def pack_ack(frames):
+    body = _ACK.pack(ACK, frames)
+    return _LENGTH.pack(len(body)) + body
+
+
+def unpack_ack(body):
+    """
+    Returns the number of frames acked by the body of an ACK frame.
+    """
+    kind, frames = _ACK.unpack(body)
+    if kind != ACK:
+        raise ValueError('unknown frame kind {:#x}'.format(kind))
+    return frames
+
+
+def pack_error(message):
+    body = bytes([ERROR]) + message.encode('utf-8')
+    return _LENGTH.pack(len(body)) + body
+
+
+async def read_frame(reader):
+    """
+    Returns the body of the next frame, None at the end of the stream.
+    """
+    try:
+        length = _LENGTH.unpack(await reader.readexactly(_LENGTH.size))[0]
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise
+        return None
+    if length > MAX_FRAME_BYTES:
+        raise ValueError('frame of {} bytes, at most {} accepted'.format(length, MAX_FRAME_BYTES))
+    return await reader.readexactly(length)
+
+
+def hf_batch(chunks):
+    """
+    Returns the write_hf_batch arguments of unpacked HF frames.
+    """
+    source_ids, type_ids, starts_micros, frequencies, values = zip(*chunks)
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum([len(v) for v in values], out=offsets[1:])
+    return dict(source_ids=np.asarray(source_ids, dtype=np.int64), type_ids=np.asarray(type_ids, dtype=np.int64),
+                starts_micros=np.asarray(starts_micros, dtype=np.int64),
+                frequencies=np.asarray(frequencies, dtype=np.float64),
+                values=np.concatenate(values).astype(np.float64), offsets=offsets)
+
+
+class IngestServer:
+    """
+    Accepts HF frames over TCP and writes them to an ImmutableStore.
+    """
+    def __init__(self, store, host='0.0.0.0', port=9000, batch_frames=1024, batch_delay=0.005, queue_frames=8192,
+                 write_workers=2):
+        """
+        batch_frames: frames of a connection written at once
+        batch_delay: seconds a partial batch waits for more frames before being written
+        queue_frames: frames of a connection read ahead of the store writes (flow control)
+        write_workers: threads calling the store, which may block (full flusher queue, wal fsync)
+        """
+        self.store = store
+        self.host = host
+        self.port = port
+        self.batch_frames = batch_frames
+        self.batch_delay = batch_delay
+        self.queue_frames = queue_frames
+        self._executor = concurrent.futures.ThreadPoolExecutor(write_workers, thread_name_prefix='pancarte-ingest')
+        self._server = None
+        self._loop = None
+        self._ready = threading.Event()
+        self._startup_error = None
+        self._thread = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        # port=0 binds any free port
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    def _write(self, chunks):
+        self.store.write_hf_batch(**hf_batch(chunks))
+
+    async def _receive(self, reader, queue):
+        try:
+            while True:
+                body = await read_frame(reader)
+                if body is None:
+                    break
+                await queue.put(unpack_hf(body))
+        except (ValueError, struct.error, asyncio.IncompleteReadError, ConnectionError) as e:
+            await queue.put(e)
+            return
+        await queue.put(None)
+
+    async def _handle(self, reader, writer):
+        queue = asyncio.Queue(maxsize=self.queue_frames)
+        receiver = asyncio.ensure_future(self._receive(reader, queue))
+        loop = asyncio.get_event_loop()
+        acked = 0
+        try:
+            done = False
+            while not done:
+                item = await queue.get()
+                chunks = []
+                deadline = loop.time() + self.batch_delay
+                while True:
+                    if item is None:
+                        done = True
+                        break
+                    if isinstance(item, Exception):
+                        writer.write(pack_error(str(item) or type(item).__name__))
+                        done = True
+                        break
+                    chunks.append(item)
+                    if len(chunks) >= self.batch_frames:
+                        break
+                    try:
+                        item = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        timeout = deadline - loop.time()
+                        if timeout <= 0:
+                            break
+                        try:
+                            item = await asyncio.wait_for(queue.get(), timeout)
+                        except asyncio.TimeoutError:
+                            break
+
+                if chunks:
+                    try:
+                        await loop.run_in_executor(self._executor, self._write, chunks)
+                    except ValueError as e:
+                        writer.write(pack_error(str(e)))
+                        break
+                    acked += len(chunks)
+                    writer.write(pack_ack(acked))
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            receiver.cancel()
+            writer.close()
+
+    def serve_forever(self):
+        """
+        Runs the server in the calling thread, on its own event loop.
+        """
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self.start())
+        except BaseException as e:
+            # e.g. the port is in use
+            self._startup_error = e
+            self._loop.close()
+            self._executor.shutdown()
+            raise
+        finally:
+            self._ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._server.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+            self._executor.shutdown()
+
+    def start_in_thread(self):
+        """
+        Runs serve_forever in a daemon thread, returns once the server listens. Raises the error of the server
+        when it could not start.
+        """
+        self._thread = threading.Thread(target=self._serve_in_thread, name='pancarte-ingest-server', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._startup_error is not None:
+            self._thread.join()
+            raise self._startup_error
+        return self._thread
+
+    def _serve_in_thread(self):
+        try:
+            self.serve_forever()
+        except BaseException:
+            # Raised by start_in_thread instead
+            if self._startup_error is None:
+                raise
+
+    def close(self):
+        """
+        Stops the server, waiting for the running writes when it runs in a thread (close it before the store).
+        """
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._thread is not None:
+            self._thread.join()
+
+
+def main():
+    from storage import ImmutableStore
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['serve'])
+    parser.add_argument('--location', default='test_db')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--wal', action='store_true')
+    args = parser.parse_args()
+
+    store = ImmutableStore(location=args.location, wal=args.wal)
+    server = IngestServer(store, host=args.host, port=args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
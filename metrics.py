@@ -0,0 +1,266 @@
+"""
+Counters, histograms and per-query traces of the store, exposed in the Prometheus text format (GET /metrics).
+
+Metrics are process-wide (registry). Values computed when scraped, like the fill of the memory caches, come from
+collectors: callables returning families (see Registry.collect). A trace records the steps of the queries run by
+a thread while it is active (see tracing), code paths check current_trace() and skip the recording when it is None.
+"""
+import bisect
+import contextlib
+import math
+import threading
+import time
+import weakref
+
+# Seconds, from 100 µs to 30 s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30)
+# Bytes, from 4 KiB to 1 GiB
+SIZE_BUCKETS = tuple(4 ** i * 1024 for i in range(1, 11))
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1E15:
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels) + '}'
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.label_names):
+            raise ValueError('{} takes the labels {}'.format(self.name, self.label_names))
+        return tuple(labels)
+
+    def family(self):
+        with self._lock:
+            items = sorted(self._values.items())
+            return {'name': self.name, 'type': self.type, 'help': self.help,
+                    'samples': [s for key, value in items for s in self._samples(key, value)]}
+
+    def _labels(self, key):
+        return tuple(zip(self.label_names, key))
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, *labels):
+        """
+        Adds amount to the counter of the label values (in the order of the metric labels).
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self, key, value):
+        return [(self.name + '_total', self._labels(key), value)]
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0., 0]
+            state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        """
+        Observes the seconds spent in the block.
+        """
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, *labels)
+
+    def count(self, *labels):
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def _samples(self, key, state):
+        counts, total, count = state
+        labels = self._labels(key)
+        samples = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + (math.inf,), counts):
+            cumulative += n
+            samples.append((self.name + '_bucket', labels + (('le', _format_value(float(bound))),), cumulative))
+        samples.append((self.name + '_sum', labels, total))
+        samples.append((self.name + '_count', labels, count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.label_names != metric.label_names:
+                    raise ValueError('metric {} already registered differently'.format(metric.name))
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def add_collector(self, collector, owner=None):
+        """
+        Adds a callable returning families [{'name', 'type', 'help', 'samples': [(name, labels, value)]}] when
+        metrics are collected. With an owner, the collector is called with it as long as it is alive.
+        """
+        with self._lock:
+            if owner is None:
+                self._collectors.append(collector)
+            else:
+                ref = weakref.ref(owner)
+                self._collectors.append(lambda: collector(ref()) if ref() is not None else [])
+
+    def collect(self):
+        """
+        Returns the families of every metric and collector, families of the same name being merged.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        families = {}
+        for family in [m.family() for m in metrics] + [f for c in collectors for f in c()]:
+            merged = families.setdefault(family['name'], dict(family, samples=[]))
+            merged['samples'] += family['samples']
+        return [families[name] for name in sorted(families)]
+
+    def render(self, families=None):
+        """
+        Returns the Prometheus text format (version 0.0.4) of families (default: collect()).
+        """
+        lines = []
+        for family in self.collect() if families is None else families:
+            lines.append('# HELP {} {}'.format(family['name'], family['help'].replace('\\', r'\\')
+                                                .replace('\n', r'\n')))
+            lines.append('# TYPE {} {}'.format(family['name'], family['type']))
+            for name, labels, value in family['samples']:
+                lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def gauge_family(name, help, samples):
+    """
+    Returns a gauge family for a collector, samples being [(labels, value)] with labels as ((name, value), ...).
+    """
+    return {'name': name, 'type': 'gauge', 'help': help,
+            'samples': [(name, tuple(labels), value) for labels, value in samples]}
+
+
+def counter_family(name, help, samples):
+    """
+    Same as gauge_family for a counter, kept by the collector (e.g. updated under a lock it already takes).
+    """
+    return {'name': name, 'type': 'counter', 'help': help,
+            'samples': [(name + '_total', tuple(labels), value) for labels, value in samples]}
+
+
+def with_labels(families, **labels):
+    """
+    Returns families with labels added to every sample (e.g. the shard of a process).
+    """
+    extra = tuple(sorted(labels.items()))
+    return [dict(f, samples=[(name, tuple(sample_labels) + extra, value) for name, sample_labels, value
+                             in f['samples']]) for f in families]
+
+
+registry = Registry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Trace:
+    """
+    Steps of a query, each with its start and duration in milliseconds since the start of the trace.
+    """
+    def __init__(self):
+        self._t0 = time.perf_counter()
+        self.steps = []
+
+    def step(self, name, started, **fields):
+        """
+        Records a step started at started (time.perf_counter()) and ending now.
+        """
+        now = time.perf_counter()
+        self.steps.append(dict(fields, step=name, at_ms=round((started - self._t0) * 1000, 3),
+                               ms=round((now - started) * 1000, 3)))
+
+    def to_json(self):
+        return {'total_ms': round((time.perf_counter() - self._t0) * 1000, 3),
+                'steps': sorted(self.steps, key=lambda step: step['at_ms'])}
+
+
+_local = threading.local()
+
+
+def current_trace():
+    """
+    Returns the trace of the calling thread, None when it is not tracing.
+    """
+    return getattr(_local, 'trace', None)
+
+
+@contextlib.contextmanager
+def tracing(enabled=True):
+    """
+    Traces the queries of the calling thread in the block, yields the Trace (None if not enabled).
+    """
+    if not enabled:
+        yield None
+        return
+    previous = current_trace()
+    _local.trace = trace = Trace()
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
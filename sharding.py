@@ -0,0 +1,455 @@
+"""
+ImmutableStore split over worker processes, source_ids being hash-partitioned between them.
+
+Every shard is a process owning an ImmutableStore in <location>/shard-<i> (its own memory caches, flushers,
+write-ahead log, manifest and block cache), so that ingest and block decoding are no longer bound to one core.
+ShardedStore routes writes to the shard of their source_id, batches being split by shard and sent to all of them
+at once, and fans reads out to the shards holding the requested source_ids.
+
+Shards serve requests on local sockets (multiprocessing.connection), one thread per connection: a request is
+(method, args, kwargs, stream) and NumPy arrays are pickled as raw buffers. Read iterators are streamed item by item,
+the socket buffers bounding how far a shard decodes ahead of the reader.
+"""
+import multiprocessing
+import os
+import pickle
+import threading
+import time
+import zlib
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+import blocks
+import metrics
+from storage import ImmutableStore, _section_lists, check_hf_chunks, compile_filters, source_set
+
+# ImmutableStore methods a shard serves
+METHODS = {
+    'write_lf', 'write_hf', 'write_lf_batch', 'write_hf_batch', 'read_blocks', 'read_all_blocks', 'read_intervals',
+    'read_all_intervals', 'aggregate', 'rollup_level', 'flush_all', 'compact', 'rebuild_manifest',
+}
+# Served by the shard process itself: the families of its metrics registry
+COLLECT_METRICS = 'collect_metrics'
+
+
+def shard_of(source_id, shards):
+    """
+    Returns the shard (0 to shards - 1) of a source_id, ints and their strings giving the same one.
+    """
+    return zlib.crc32(str(source_id).encode('utf-8')) % shards
+
+
+def _error(e):
+    try:
+        pickle.dumps(e)
+        return e
+    except Exception:
+        return RuntimeError('{}: {}'.format(type(e).__name__, e))
+
+
+def _serve_connection(store, conn):
+    with conn:
+        while True:
+            try:
+                method, args, kwargs, stream = conn.recv()
+            except (EOFError, OSError):
+                return
+            try:
+                if method == COLLECT_METRICS:
+                    result = metrics.registry.collect()
+                elif method in METHODS:
+                    result = getattr(store, method)(*args, **kwargs)
+                else:
+                    raise ValueError('unknown method {}'.format(method))
+                if stream:
+                    for item in result:
+                        conn.send(('item', item))
+                    result = None
+                message = ('ok', result)
+            except (BrokenPipeError, ConnectionResetError):
+                # The reader left in the middle of a stream
+                return
+            except Exception as e:
+                message = ('error', _error(e))
+            try:
+                conn.send(message)
+            except OSError:
+                return
+
+
+def _accept(store, listener):
+    while True:
+        try:
+            conn = listener.accept()
+        except multiprocessing.AuthenticationError:
+            continue
+        except OSError:
+            return
+        threading.Thread(target=_serve_connection, args=(store, conn), daemon=True).start()
+
+
+def _run_shard(location, store_kwargs, control, authkey):
+    """
+    Shard process: serves the store until the router closes it (or exits).
+    """
+    try:
+        store = ImmutableStore(location=location, **store_kwargs)
+        listener = Listener(family='AF_UNIX', authkey=authkey)
+    except Exception as e:
+        control.send(('error', _error(e)))
+        return
+    control.send(('ok', listener.address))
+    threading.Thread(target=_accept, args=(store, listener), name='pancarte-shard-accept', daemon=True).start()
+    try:
+        control.recv()
+    except EOFError:
+        pass
+    finally:
+        listener.close()
+        store.close()
+    try:
+        control.send(('ok', None))
+    except OSError:
+        pass
+
+
+class ShardedStore:
+    """
+    Same write and read interface as ImmutableStore over shards worker processes.
+
+    Results of reads are grouped by shard (each in ImmutableStore order) and every shard decodes its blocks in
+    parallel with the others. The number of shards of a location is fixed when it is created.
+    """
+    def __init__(self, location: str, shards=None, start_method=None, **store_kwargs):
+        """
+        shards: number of worker processes (default: the one of the location, else the number of CPUs)
+        start_method: multiprocessing start method of the workers (default: the platform one). With 'fork', create
+                      the store before starting threads.
+        store_kwargs: ImmutableStore arguments of every shard (block_cache_bytes is a per-process budget)
+        """
+        self.location = location
+        os.makedirs(location, exist_ok=True)
+        self.shards = self._check_shards(shards)
+
+        context = multiprocessing.get_context(start_method)
+        authkey = os.urandom(32)
+        self._authkey = authkey
+        self._processes = []
+        self._controls = []
+        self._addresses = []
+        self._idle = [[] for _ in range(self.shards)]
+        self._idle_lock = threading.Lock()
+        try:
+            for i in range(self.shards):
+                control, child = context.Pipe()
+                process = context.Process(target=_run_shard, name='pancarte-shard-{}'.format(i),
+                                          args=(self.shard_location(i), store_kwargs, child, authkey), daemon=True)
+                process.start()
+                child.close()
+                self._processes.append(process)
+                self._controls.append(control)
+            for control in self._controls:
+                self._addresses.append(self._reply(control))
+        except Exception:
+            self._stop()
+            raise
+
+        metrics.registry.add_collector(ShardedStore._collect_metrics, owner=self)
+
+    def _collect_metrics(self):
+        """
+        Metrics of the shard processes, labelled with their shard.
+        """
+        if not self._processes:
+            return []
+        families = self._call_all([(shard, COLLECT_METRICS, (), {}) for shard in range(self.shards)])
+        return [f for shard, shard_families in enumerate(families)
+                for f in metrics.with_labels(shard_families, shard=str(shard))]
+
+    def _check_shards(self, shards):
+        # Source_ids would move between shards, and be found in none of them, if the count changed
+        path = os.path.join(self.location, '.shards')
+        if os.path.exists(path):
+            with open(path) as f:
+                existing = int(f.read())
+            if shards is not None and existing != shards:
+                raise ValueError('{} is split over {} shards, not {}'.format(self.location, existing, shards))
+            return existing
+        shards = shards or os.cpu_count() or 1
+        with open(path, 'w') as f:
+            f.write(str(shards))
+        return shards
+
+    def shard_location(self, shard):
+        return os.path.join(self.location, 'shard-{}'.format(shard))
+
+    def shard_of(self, source_id):
+        return shard_of(source_id, self.shards)
+
+    @staticmethod
+    def _reply(conn):
+        status, result = conn.recv()
+        if status == 'error':
+            raise result
+        return result
+
+    def _connect(self, shard):
+        with self._idle_lock:
+            if self._idle[shard]:
+                return self._idle[shard].pop()
+        return Client(self._addresses[shard], family='AF_UNIX', authkey=self._authkey)
+
+    def _release(self, shard, conn):
+        with self._idle_lock:
+            self._idle[shard].append(conn)
+
+    def _call_all(self, calls):
+        """
+        Sends calls [(shard, method, args, kwargs), ...] to their shards at once, returns their results in order.
+        """
+        sent = []
+        try:
+            for shard, method, args, kwargs in calls:
+                conn = self._connect(shard)
+                conn.send((method, args, kwargs, False))
+                sent.append((shard, conn))
+        except Exception:
+            for _, conn in sent:
+                conn.close()
+            raise
+
+        trace = metrics.current_trace()
+        started = time.perf_counter()
+        results, error = [], None
+        for (shard, conn), (_, method, _, _) in zip(sent, calls):
+            try:
+                status, result = conn.recv()
+                if trace is not None:
+                    trace.step('shard', started, shard=shard, method=method)
+            except Exception as e:
+                conn.close()
+                error = error or e
+                continue
+            self._release(shard, conn)
+            if status == 'error':
+                error = error or result
+            results.append(result)
+        if error is not None:
+            raise error
+        return results
+
+    def _call(self, shard, method, *args, **kwargs):
+        return self._call_all([(shard, method, args, kwargs)])[0]
+
+    def _stream_all(self, calls):
+        """
+        Iterator of the items of read iterators of several shards, all of them reading at once.
+        """
+        sent = []
+        try:
+            for shard, method, args, kwargs in calls:
+                conn = self._connect(shard)
+                conn.send((method, args, kwargs, True))
+                sent.append((shard, conn))
+            trace = metrics.current_trace()
+            for i, (shard, conn) in enumerate(sent):
+                started = time.perf_counter()
+                while True:
+                    status, result = conn.recv()
+                    if status == 'item':
+                        if trace is not None:
+                            trace.step('shard', started, shard=shard, method=calls[i][1])
+                        yield result
+                        started = time.perf_counter()
+                        continue
+                    self._release(shard, conn)
+                    sent[i] = (shard, None)
+                    if status == 'error':
+                        raise result
+                    break
+        finally:
+            # Connections left in the middle of a stream can not be reused
+            for shard, conn in sent:
+                if conn is not None:
+                    conn.close()
+
+    def _shards_of(self, source_id):
+        wanted = source_set(source_id)
+        if wanted is None:
+            return list(range(self.shards))
+        return sorted({self.shard_of(s) for s in wanted})
+
+    def _partition(self, source_ids):
+        """
+        Returns {shard: row index} of source_ids (one value or one per row), None for all the rows.
+        """
+        if np.ndim(source_ids) == 0:
+            return {self.shard_of(source_ids): None}
+        unique, inverse = np.unique(np.asarray(source_ids), return_inverse=True)
+        shards = np.array([self.shard_of(s) for s in unique.tolist()], dtype=np.int64)[inverse]
+        present = np.unique(shards).tolist()
+        if len(present) == 1:
+            return {present[0]: None}
+        return {shard: np.flatnonzero(shards == shard) for shard in present}
+
+    def write_lf(self, source_id: int, type_id: int, timestamp_micros: int, value: float):
+        self._call(self.shard_of(source_id), 'write_lf', source_id, type_id, timestamp_micros, value)
+
+    def write_hf(self, source_id: int, type_id: int, start_micros: int, frequency: float, values: list):
+        self._call(self.shard_of(source_id), 'write_hf', source_id, type_id, start_micros, frequency, values)
+
+    def write_lf_batch(self, source_ids, type_ids, timestamps_micros, values):
+        """
+        See ImmutableStore.write_lf_batch.
+        """
+        timestamps_micros = np.asarray(timestamps_micros, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) != len(timestamps_micros):
+            raise ValueError('timestamps_micros and values must have the same length')
+        calls = []
+        for shard, index in self._partition(source_ids).items():
+            columns = [source_ids, type_ids, timestamps_micros, values]
+            if index is not None:
+                columns = [c if np.ndim(c) == 0 else np.asarray(c)[index] for c in columns]
+            calls.append((shard, 'write_lf_batch', tuple(columns), {}))
+        self._call_all(calls)
+
+    def write_hf_batch(self, source_ids, type_ids, starts_micros, frequencies, values, offsets):
+        """
+        See ImmutableStore.write_hf_batch.
+        """
+        offsets = np.asarray(offsets, dtype=np.int64)
+        starts_micros = np.asarray(starts_micros, dtype=np.int64)
+        if len(offsets) != len(starts_micros) + 1:
+            raise ValueError('offsets must have one more element than starts_micros')
+        values = np.asarray(values, dtype=np.float64)
+        # Checked before any shard writes its part
+        check_hf_chunks(frequencies, offsets, len(values))
+        calls = []
+        for shard, index in self._partition(source_ids).items():
+            columns = [source_ids, type_ids, starts_micros, frequencies, values, offsets]
+            if index is not None:
+                chunks = blocks.take_rows('hf', {'offsets': offsets, 'values': values}, index)
+                columns = [c if np.ndim(c) == 0 else np.asarray(c)[index] for c in columns[:4]] + \
+                          [chunks['values'], chunks['offsets']]
+            calls.append((shard, 'write_hf_batch', tuple(columns), {}))
+        self._call_all(calls)
+
+    def rollup_level(self, start_micros, end_micros, resolution=None, max_points=None):
+        return self._call(0, 'rollup_level', start_micros, end_micros, resolution, max_points)
+
+    def read_blocks(self, start_micros, end_micros, lf=True, hf=True, parallel=None, memory=True, resolution=None,
+                    max_points=None, arrays=False, **filters):
+        """
+        See ImmutableStore.read_blocks, results being grouped by shard.
+        """
+        compile_filters(filters)
+        kwargs = dict(lf=lf, hf=hf, parallel=parallel, memory=memory, resolution=resolution, max_points=max_points,
+                      arrays=True, **filters)
+        calls = [(shard, 'read_blocks', (start_micros, end_micros), kwargs)
+                 for shard in self._shards_of(filters.get('source_id'))]
+        return self._results(self._stream_all(calls), arrays)
+
+    def read_intervals(self, intervals, lf=True, hf=True, parallel=None, memory=True, arrays=False, **filters):
+        """
+        See ImmutableStore.read_intervals, results being grouped by shard.
+        """
+        compile_filters(filters)
+        by_shard = {}
+        for source_id, interval in intervals.items():
+            by_shard.setdefault(self.shard_of(source_id), {})[source_id] = interval
+        kwargs = dict(lf=lf, hf=hf, parallel=parallel, memory=memory, arrays=True, **filters)
+        calls = [(shard, 'read_intervals', (shard_intervals,), kwargs)
+                 for shard, shard_intervals in sorted(by_shard.items())]
+        return self._results(self._stream_all(calls), arrays)
+
+    @staticmethod
+    def _results(results, arrays):
+        # Arrays cross process boundaries much faster than lists, these are built on this side
+        for res in results:
+            if arrays:
+                yield res
+            else:
+                # hf sections hold rollups when read at a resolution
+                yield {k: _section_lists('rollup' if 'bucket_micros' in section else k, section)
+                       for k, section in res.items()}
+
+    @staticmethod
+    def _concatenate(parts):
+        dd = parts[0]
+        for part in parts[1:]:
+            for k in dd:
+                for kk, vv in part[k].items():
+                    dd[k][kk] += vv
+        return dd
+
+    def read_all_blocks(self, start_micros, end_micros, lf=True, hf=True, parallel=None, memory=True,
+                        resolution=None, max_points=None, **filters):
+        kwargs = dict(lf=lf, hf=hf, parallel=parallel, memory=memory, resolution=resolution, max_points=max_points,
+                      **filters)
+        return self._concatenate(self._call_all([(shard, 'read_all_blocks', (start_micros, end_micros), kwargs)
+                                                 for shard in self._shards_of(filters.get('source_id'))]))
+
+    def read_all_intervals(self, intervals, lf=True, hf=True, parallel=None, memory=True, **filters):
+        by_shard = {}
+        for source_id, interval in intervals.items():
+            by_shard.setdefault(self.shard_of(source_id), {})[source_id] = interval
+        if not by_shard:
+            by_shard = {0: {}}
+        kwargs = dict(lf=lf, hf=hf, parallel=parallel, memory=memory, **filters)
+        return self._concatenate(self._call_all([(shard, 'read_all_intervals', (shard_intervals,), kwargs)
+                                                 for shard, shard_intervals in sorted(by_shard.items())]))
+
+    def aggregate(self, start_micros, end_micros, bucket_micros, lf=True, hf=True, percentiles=(),
+                  relative_accuracy=0.01, parallel=None, memory=True, **filters):
+        """
+        See ImmutableStore.aggregate: shards aggregate their source_ids, the results are concatenated.
+        """
+        kwargs = dict(lf=lf, hf=hf, percentiles=percentiles, relative_accuracy=relative_accuracy, parallel=parallel,
+                      memory=memory, **filters)
+        res = self._concatenate(self._call_all([(shard, 'aggregate', (start_micros, end_micros, bucket_micros), kwargs)
+                                                for shard in self._shards_of(filters.get('source_id'))]))
+        for k, columns in res.items():
+            # Same order as one store: source_id, type_id then bucket
+            order = np.lexsort([np.asarray(columns['bucket_micros'], dtype=np.int64),
+                                np.asarray(columns['type_id'], dtype=np.int64),
+                                np.asarray(columns['source_id'], dtype=str)])
+            res[k] = {col: [values[i] for i in order.tolist()] for col, values in columns.items()}
+        return res
+
+    def flush_all(self):
+        self._call_all([(shard, 'flush_all', (), {}) for shard in range(self.shards)])
+
+    def compact(self, source_id, partition=None):
+        return self._call(self.shard_of(source_id), 'compact', source_id, partition)
+
+    def rebuild_manifest(self):
+        return sum(self._call_all([(shard, 'rebuild_manifest', (), {}) for shard in range(self.shards)]))
+
+    def _stop(self):
+        for control in self._controls:
+            try:
+                control.send('close')
+            except OSError:
+                pass
+        for control in self._controls:
+            try:
+                control.recv()
+            except (EOFError, OSError):
+                pass
+            control.close()
+        for process in self._processes:
+            process.join()
+        self._controls, self._processes = [], []
+
+    def close(self):
+        """
+        Closes the store of every shard (writing their caches) and stops the workers.
+        """
+        with self._idle_lock:
+            for conns in self._idle:
+                for conn in conns:
+                    conn.close()
+                conns.clear()
+        self._stop()
@@ -1,16 +1,89 @@
 import os
+import time
+import collections
+import itertools
+import concurrent.futures
+import queue
 import datetime
 import pathlib
+import threading
+import traceback
 
-import msgpack
 import numpy as np
-import pandas as pd
-from sortedcontainers import SortedListWithKey
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, select, func, and_
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import sessionmaker
-
-from db.tables import Base
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+import aggregation
+import blocks
+import compression
+import metrics
+from buffers import ColumnBuffer
+from compaction import Compactor
+from wal import WriteAheadLog, pack_source as wal_pack_source, encode as wal_encode, \
+    encode_batch as wal_encode_batch, encode_flushed as wal_encode_flushed
+from db.manifest import ManifestBase, BlockEntry
+from db.tables import Base, AnnotationType, TimerangeAnnotation, TimestampAnnotation
+
+
+FLUSH_SECONDS = metrics.registry.histogram('pancarte_flush_seconds', 'Time to write a sealed cache to a block')
+FLUSH_FAILURES = metrics.registry.counter('pancarte_flush_failures', 'Sealed caches that could not be written')
+FLUSH_BYTES = metrics.registry.histogram('pancarte_flush_bytes', 'Size of the blocks written from the caches',
+                                         buckets=metrics.SIZE_BUCKETS)
+READ_SECONDS = metrics.registry.histogram('pancarte_read_seconds',
+                                          'Duration of read queries, from their start to their last result', ['query'])
+BLOCKS_SCANNED = metrics.registry.counter('pancarte_read_blocks_scanned', 'Blocks decoded by read queries')
+BLOCKS_RETURNED = metrics.registry.counter('pancarte_read_blocks_returned',
+                                           'Decoded blocks holding rows matching their read query')
+DECODE_SECONDS = metrics.registry.histogram('pancarte_decode_seconds',
+                                            'Time to read and filter one block (decoded in this process)')
+SQL_SECONDS = metrics.registry.histogram('pancarte_sql_seconds', 'Duration of SQL statements',
+                                         ['database', 'statement'])
+
+
+def _collect_block_cache():
+    # blocks.block_cache is process-wide: collected once here rather than by every store
+    stats = blocks.block_cache.stats()
+    return [
+        metrics.counter_family('pancarte_block_cache_hits', 'Block sections served from the block cache',
+                               [((), stats['hits'])]),
+        metrics.counter_family('pancarte_block_cache_misses', 'Block sections not found in the block cache',
+                               [((), stats['misses'])]),
+        metrics.counter_family('pancarte_block_cache_evictions', 'Block sections evicted from the block cache',
+                               [((), stats['evictions'])]),
+        metrics.gauge_family('pancarte_block_cache_bytes', 'Bytes of the decoded sections in the block cache',
+                             [((), stats['bytes'])]),
+        metrics.gauge_family('pancarte_block_cache_entries', 'Decoded sections in the block cache',
+                             [((), stats['entries'])]),
+    ]
+
+
+metrics.registry.add_collector(_collect_block_cache)
+
+
+def source_set(source_id):
+    """
+    Returns the source_ids a source_id filter (None, one or a list) selects as strings, None for all.
+    """
+    if source_id is None:
+        return None
+    if isinstance(source_id, (list, tuple, set, frozenset, np.ndarray)):
+        return {str(s) for s in source_id}
+    return {str(source_id)}
+
+
+def check_hf_chunks(frequencies, offsets=None, values_count=None):
+    """
+    Raises ValueError unless every frequency is finite and > 0 (sample timestamps are computed from it) and, when
+    given, offsets delimit values_count values: starting at 0, non-decreasing and ending at values_count.
+    """
+    frequencies = np.asarray(frequencies, dtype=np.float64)
+    if not np.all(np.isfinite(frequencies) & (frequencies > 0)):
+        raise ValueError('frequencies must be finite and > 0')
+    if offsets is not None:
+        if not len(offsets) or offsets[0] != 0 or offsets[-1] != values_count or np.any(np.diff(offsets) < 0):
+            raise ValueError('offsets must go from 0 to the number of values without decreasing')
 
 
 def dt_to_micro_timestamp(dt):
@@ -34,245 +107,1312 @@ def numpy_fillna(data):
     return out.tolist()
 
 
+DATATYPES = {
+    'lf': ['type_id', 'value', 'timestamp_micros'],
+    'hf': ['type_id', 'values', 'start_micros', 'end_micros', 'frequency']
+}
+
+
+def hf_sample_range(start_micros, frequency, count, qstart_micros, qend_micros):
+    """
+    Returns (first, last) per hf row: the indices of its samples timestamped in [qstart_micros, qend_micros),
+    sample i of a row being at start_micros + int(i / frequency * 1E6).
+    """
+    step = 1E6 / frequency
+    first = np.clip(np.ceil((qstart_micros - start_micros) / step), 0, count).astype(np.int64)
+    last = np.clip(np.ceil((qend_micros - start_micros) / step), 0, count).astype(np.int64)
+    return first, np.maximum(first, last)
+
+
+FILTER_COLUMNS = {}
+for _schema in (blocks.SCHEMA['lf'], blocks.SCHEMA['hf'], blocks.ROLLUP_SCHEMA):
+    FILTER_COLUMNS.update((c, dtype) for c, dtype in _schema.items() if c not in ('offsets', 'values'))
+
+
+def compile_filters(filters):
+    """
+    Returns the predicates [(column, op, value)] of read_blocks filters, values converted to the column dtype:
+    - column=value: equality, column=[value, ...] (list, tuple, set or array): IN
+    - column__min=value, column__max=value: inclusive bounds (e.g. value__min=10 on lf values)
+    A predicate applies to the sections having its column. source_id selects blocks and caches, not rows.
+    """
+    predicates = []
+    for key, value in filters.items():
+        if key == 'source_id':
+            continue
+        column, _, op = key.partition('__')
+        if column not in FILTER_COLUMNS or op not in ('', 'min', 'max'):
+            raise ValueError('unknown filter {}'.format(key))
+        dtype = np.dtype(FILTER_COLUMNS[column])
+        if op:
+            predicates.append((column, op, np.asarray(value, dtype=dtype).item()))
+        elif isinstance(value, (list, tuple, set, frozenset, np.ndarray)):
+            predicates.append((column, 'in', np.unique(np.asarray(list(value), dtype=dtype))))
+        else:
+            predicates.append((column, 'eq', np.asarray(value, dtype=dtype).item()))
+    return predicates
+
+
+def predicate_type_ids(predicates):
+    """
+    Returns the type_ids the predicates restrict rows to, None if they do not.
+    """
+    type_ids = None
+    for column, op, value in predicates:
+        if column == 'type_id' and op in ('eq', 'in'):
+            wanted = set(np.atleast_1d(value).tolist())
+            type_ids = wanted if type_ids is None else type_ids & wanted
+    return type_ids
+
+
+def _mask(columns, mask, predicates):
+    for column, op, value in predicates:
+        if column not in columns:
+            continue
+        array = columns[column]
+        if op == 'eq':
+            mask &= array == value
+        elif op == 'in':
+            mask &= np.isin(array, value)
+        elif op == 'min':
+            mask &= array >= value
+        else:
+            mask &= array <= value
+    return mask
+
+
+def _time_ordered(index, timestamps):
+    # Rows come time-ordered from blocks holding one type_id and from memory caches, sorting is skipped then
+    t = timestamps[index]
+    if np.any(t[1:] < t[:-1]):
+        index = index[np.argsort(t, kind='stable')]
+    return index
+
+
+def _filter_section(block, k, start_micros, end_micros, predicates, arrays=False):
+    if k not in ['lf', 'hf']:
+        raise NotImplementedError()
+
+    columns = block[k]
+    if k == 'lf':
+        timestamps = columns['timestamp_micros']
+        mask = (timestamps >= start_micros) & (timestamps < end_micros)
+    else:
+        # Rows overlapping the range, trimmed to their samples inside it below
+        timestamps = columns['start_micros']
+        mask = (timestamps < end_micros) & (columns['end_micros'] > start_micros)
+    index = _time_ordered(np.flatnonzero(_mask(columns, mask, predicates)), timestamps)
+
+    if k == 'lf':
+        res = {col: columns[col][index] for col in DATATYPES['lf']}
+        return res if arrays else _section_lists('lf', res)
+
+    offsets = columns['offsets']
+    starts = columns['start_micros'][index]
+    frequencies = columns['frequency'][index]
+    first, last = hf_sample_range(starts, frequencies, offsets[index + 1] - offsets[index], start_micros, end_micros)
+    keep = last > first
+    index, starts, frequencies, first, last = index[keep], starts[keep], frequencies[keep], first[keep], last[keep]
+
+    lengths = last - first
+    bounds = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=bounds[1:])
+    # Position of every kept sample in the flat values array
+    positions = np.arange(bounds[-1], dtype=np.int64) + np.repeat(offsets[index] + first - bounds[:-1], lengths)
+    # Same layout as the hf section of a block: flat values split by offsets
+    res = {
+        'type_id': columns['type_id'][index],
+        'offsets': bounds,
+        'values': columns['values'][positions],
+        'start_micros': starts + (first / frequencies * 1E6).astype(np.int64),
+        'end_micros': starts + (last / frequencies * 1E6).astype(np.int64),
+        'frequency': frequencies,
+        # Index of the first kept sample in the stored row, see blocks.row_anchors
+        'first_sample': first.astype(np.int64),
+    }
+    return res if arrays else _section_lists('hf', res)
+
+
+def _section_lists(k, section):
+    """
+    Converts NumPy result columns to the lists read_blocks yields, hf values becoming one list per row.
+    """
+    if k != 'hf':
+        return {col: np.asarray(v).tolist() for col, v in section.items()}
+    res = {col: np.asarray(v).tolist() for col, v in section.items()
+           if col not in ('offsets', 'values', 'first_sample')}
+    values = section['values'].tolist()
+    bounds = section['offsets'].tolist()
+    res['values'] = [values[lo:hi] for lo, hi in zip(bounds[:-1], bounds[1:])]
+    return res
+
+
+def coalesce_intervals(starts, ends):
+    """
+    Returns the (starts, ends) arrays of the union of the [start, end) intervals, sorted and disjoint
+    (overlapping and touching intervals are merged).
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep]
+    if len(starts) == 0:
+        return starts, ends
+    order = np.argsort(starts, kind='stable')
+    starts, ends = starts[order], np.maximum.accumulate(ends[order])
+    first = np.ones(len(starts), dtype=bool)
+    first[1:] = starts[1:] > ends[:-1]
+    last = np.append(first[1:], True)
+    return starts[first], ends[last]
+
+
+def _clip_intervals(res, starts, ends):
+    """
+    Keeps the rows of a read_blocks(arrays=True) result lying in the (coalesced) intervals, hf rows being cut
+    into one row per interval they cross.
+    """
+    clipped = {}
+    for k, section in res.items():
+        if k == 'lf':
+            t = section['timestamp_micros']
+            i = np.searchsorted(starts, t, side='right') - 1
+            index = np.flatnonzero((i >= 0) & (t < ends[np.maximum(i, 0)]))
+            clipped[k] = {col: v[index] for col, v in section.items()}
+            continue
+
+        rows, timestamps, values = blocks.sample_timestamps(section)
+        i = np.searchsorted(starts, timestamps, side='right') - 1
+        keep = np.flatnonzero((i >= 0) & (timestamps < ends[np.maximum(i, 0)]))
+        rows, i, timestamps = rows[keep], i[keep], timestamps[keep]
+        # Position of the kept samples in their row, a new row starts with every (row, interval) pair
+        positions = keep - section['offsets'][rows]
+        first = np.ones(len(keep), dtype=bool)
+        first[1:] = (rows[1:] != rows[:-1]) | (i[1:] != i[:-1])
+        head = np.flatnonzero(first)
+        bounds = np.append(head, len(keep))
+        last = positions[bounds[1:] - 1] + 1
+        row = rows[head]
+        frequencies = section['frequency'][row]
+        anchors, first_sample = blocks.row_anchors(section)
+        anchors, first_sample = anchors[row], first_sample[row]
+        clipped[k] = {
+            'type_id': section['type_id'][row],
+            'offsets': bounds.astype(np.int64),
+            'values': values[keep],
+            'start_micros': timestamps[head],
+            'end_micros': anchors + ((first_sample + last) / frequencies * 1E6).astype(np.int64),
+            'frequency': frequencies,
+            'first_sample': first_sample + positions[head],
+            'source_id': section['source_id'][row],
+        }
+    return clipped
+
+
+ROLLUP_COLUMNS = ['type_id', 'bucket_micros', 'resolution_micros', 'count', 'min', 'max', 'mean']
+
+
+def _filter_rollup(columns, resolution_micros, start_micros, end_micros, predicates, arrays=False):
+    # Buckets holding samples of [start_micros, end_micros), edge buckets may also count samples outside of it
+    mask = (columns['bucket_micros'] >= start_micros // resolution_micros * resolution_micros) & \
+           (columns['bucket_micros'] < end_micros)
+    index = _time_ordered(np.flatnonzero(_mask(columns, mask, predicates)), columns['bucket_micros'])
+
+    count = columns['count'][index]
+    res = {
+        'type_id': columns['type_id'][index],
+        'bucket_micros': columns['bucket_micros'][index],
+        'resolution_micros': np.full(len(index), resolution_micros, dtype=np.int64),
+        'count': count,
+        'min': columns['min'][index],
+        'max': columns['max'][index],
+        'mean': columns['sum'][index] / count,
+    }
+    return res if arrays else _section_lists('rollup', res)
+
+
+def _filter_sections(data, source_id, start_micros, end_micros, lf, hf, predicates, rollup, arrays):
+    res = {}
+    if lf:
+        res['lf'] = _filter_section(data, 'lf', start_micros, end_micros, predicates, arrays)
+    if hf and rollup is not None:
+        res['hf'] = _filter_rollup(data[blocks.rollup_section(rollup)], rollup, start_micros, end_micros,
+                                   predicates, arrays)
+    elif hf:
+        res['hf'] = _filter_section(data, 'hf', start_micros, end_micros, predicates, arrays)
+    for k in res:
+        if arrays:
+            res[k]['source_id'] = np.full(len(res[k]['type_id']), source_id, dtype=object)
+        else:
+            res[k]['source_id'] = [source_id for _ in range(len(res[k]['type_id']))]
+    return res
+
+
+def decode_block(path, source_id, start_micros, end_micros, lf, hf, predicates, rollup=None, arrays=False):
+    """
+    Reads one block and returns its rows matching the query, as read_blocks yields them.
+    rollup: resolution of the hf rollup to return instead of the hf samples
+    arrays: return NumPy columns instead of lists (see read_blocks)
+    Module level so that it can run in a process pool.
+    """
+    t0 = time.perf_counter()
+    sections = []
+    if lf:
+        sections.append('lf')
+    if hf:
+        sections.append('hf' if rollup is None else blocks.rollup_section(rollup))
+    # Only the runs of the requested type_id are read from blocks indexing them
+    data = blocks.read_block(path, sections, type_ids=predicate_type_ids(predicates))
+    res = _filter_sections(data, source_id, start_micros, end_micros, lf, hf, predicates, rollup, arrays)
+    DECODE_SECONDS.observe(time.perf_counter() - t0)
+    return res
+
+
+def _result_rows(res):
+    return sum(len(section['type_id']) for section in res.values())
+
+
+def _filter_memory(rows, source_id, start_micros, end_micros, lf, hf, predicates, rollup=None, arrays=False):
+    """
+    Same as decode_block for rows taken from the memory caches ({datatype: [row, ...]}).
+    """
+    data = {k: blocks.concat_sections(k, rows.get(k, [])) for k in ('lf', 'hf')}
+    if rollup is not None:
+        data[blocks.rollup_section(rollup)] = blocks.compute_rollup(data['hf'], rollup)
+    return _filter_sections(data, source_id, start_micros, end_micros, lf, hf, predicates, rollup, arrays)
+
+
+def merge_rollups(hf):
+    """
+    Merges the partial buckets of rollup results (a bucket spread over several blocks or still in memory).
+    """
+    if not hf['type_id']:
+        return hf
+    source_ids, inverse = np.unique(np.asarray([str(s) for s in hf['source_id']]), return_inverse=True)
+    count = np.asarray(hf['count'], dtype=np.int64)
+    (bucket, type_id, source), count, minimum, maximum, total = blocks.group_rollup(
+        [np.asarray(hf['bucket_micros'], dtype=np.int64), np.asarray(hf['type_id'], dtype=np.int64), inverse],
+        count, np.asarray(hf['min'], dtype=np.float64), np.asarray(hf['max'], dtype=np.float64),
+        np.asarray(hf['mean'], dtype=np.float64) * count)
+    return {
+        'source_id': source_ids[source].tolist(),
+        'type_id': type_id.tolist(),
+        'bucket_micros': bucket.tolist(),
+        'resolution_micros': [hf['resolution_micros'][0]] * len(count),
+        'count': count.tolist(),
+        'min': minimum.tolist(),
+        'max': maximum.tolist(),
+        'mean': (total / count).tolist(),
+    }
+
+
+def _range_rows(full_cache, start_micros, end_micros, hf_span, rows):
+    # hf rows are keyed by their start, the ones starting up to hf_span earlier can overlap the range
+    for datatype, buffer in full_cache.items():
+        lower = start_micros - hf_span if datatype == 'hf' else start_micros
+        part = buffer.range(lower, end_micros)
+        if part is not None:
+            rows.setdefault(datatype, []).append(part)
+    return rows
+
+
 class MemoryCache:
-    # TODO: background delay before forcing flush
-    def __init__(self, cache_size, time_margin, callback_when_full, source_id):
+    def __init__(self, cache_size, time_margin, callback_when_full, source_id, wal=None, cache_bytes=None):
+        """
+        cache_size: number of values, cache_bytes: bytes of the buffers (if not None), sealing the cache when
+                    reached
+        """
         self.cache_size = cache_size
+        self.cache_bytes = cache_bytes
         self.time_margin = time_margin
+        self._margin_micros = int(time_margin.total_seconds() * 1E6)
         self.callback_when_full = callback_when_full
         self.source_id = source_id
+        self.wal = wal
+        self.wal_source = wal_pack_source(source_id) if wal is not None else None
 
+        self.lock = threading.Lock()
         self.dump = False
 
+        # Generation of the values in cache (next_cache is epoch + 1) and oldest wal segment holding them
+        self.epoch = wal.first_epoch if wal is not None else 0
+        self.cache_wal_segment = None
+        self.next_cache_wal_segment = None
+
         self.cache = {}
         self.cache_nov = 0
+        self.cache_since = None
 
         self.next_cache = {}
         self.next_cache_nov = 0
 
-    def add_data(self, timestamp, datatype, data, number_of_values):
+        # Caches sealed but not yet taken by callback_when_full: [(cache, (wal segment, epochs))]
+        self.sealed = []
+
+        # Longest hf row seen, hf rows being sorted by start_micros only
+        self.hf_span = 0
+
+        # Ingest counters, updated under the lock writes take anyway
+        self.rows_added = {'lf': 0, 'hf': 0}
+        self.values_added = {'lf': 0, 'hf': 0}
+
+    def _buffers(self, datatype):
         if datatype not in self.cache:
-            self.cache[datatype] = SortedListWithKey(key=lambda x: x[0])
+            self.cache[datatype] = ColumnBuffer(datatype)
         if datatype not in self.next_cache:
-            self.next_cache[datatype] = SortedListWithKey(key=lambda x: x[0])
+            self.next_cache[datatype] = ColumnBuffer(datatype)
+        if self.cache_since is None:
+            self.cache_since = time.monotonic()
+
+    def _settled_before(self):
+        # Values older than this go to cache, newer ones wait in next_cache while dumping
+        return int(time.time() * 1E6) - self._margin_micros
+
+    def nbytes(self):
+        return sum(b.nbytes for full_cache in (self.cache, self.next_cache) for b in full_cache.values())
+
+    def stats(self):
+        """
+        Returns (values, bytes of buffers, seconds since the oldest value arrived, {datatype: rows added},
+        {datatype: values added}) of the cache.
+        """
+        with self.lock:
+            age = time.monotonic() - self.cache_since if self.cache_since is not None else 0.
+            return (self.cache_nov + self.next_cache_nov, self.nbytes(), age, dict(self.rows_added),
+                    dict(self.values_added))
+
+    def _log(self, to_next, record):
+        segment, seq = self.wal.append(record)
+        if to_next and self.next_cache_wal_segment is None:
+            self.next_cache_wal_segment = segment
+        elif not to_next and self.cache_wal_segment is None:
+            self.cache_wal_segment = segment
+        return seq
+
+    def _added(self):
+        if not self.dump and (self.cache_nov >= self.cache_size or
+                              (self.cache_bytes is not None and self.nbytes() >= self.cache_bytes)):
+            self.dump = True
 
         if self.dump:
-            if timestamp < dt_to_micro_timestamp(datetime.datetime.now() - self.time_margin):
-                self.cache[datatype].add((timestamp, data))
-                self.cache_nov += number_of_values
-            else:
-                self.next_cache[datatype].add((timestamp, data))
+            self._seal_if_settled()
+
+    def add_data(self, timestamp, datatype, data, number_of_values):
+        """
+        Returns the wal sequence number to commit, None without wal.
+        """
+        seq = None
+        with self.lock:
+            self._buffers(datatype)
+
+            to_next = self.dump and timestamp >= self._settled_before()
+            if self.wal is not None:
+                seq = self._log(to_next, wal_encode(datatype, self.wal_source, self.epoch + to_next, data))
+
+            if datatype == 'hf':
+                self.hf_span = max(self.hf_span, data[3] - data[2])
+            if to_next:
+                self.next_cache[datatype].append(data)
                 self.next_cache_nov += number_of_values
-        else:
-            self.cache[datatype].add((timestamp, data))
-            self.cache_nov += number_of_values
+            else:
+                self.cache[datatype].append(data)
+                self.cache_nov += number_of_values
+            self.rows_added[datatype] += 1
+            self.values_added[datatype] += number_of_values
 
-        if not self.dump and self.cache_nov >= self.cache_size:
+            self._added()
+        self._hand_over()
+        return seq
+
+    def add_batch(self, datatype, columns):
+        """
+        Adds many rows given as block section columns (see blocks.SCHEMA) at once.
+        Returns the wal sequence number to commit, None without wal.
+        """
+        seq = None
+        with self.lock:
+            self._buffers(datatype)
+
+            timestamps = columns['timestamp_micros' if datatype == 'lf' else 'start_micros']
+            if datatype == 'hf' and len(timestamps):
+                self.hf_span = max(self.hf_span, int((columns['end_micros'] - timestamps).max()))
+            parts = [(False, columns)]
+            if self.dump:
+                to_next = timestamps >= self._settled_before()
+                if to_next.all():
+                    parts = [(True, columns)]
+                elif to_next.any():
+                    parts = [(False, blocks.take_rows(datatype, columns, ~to_next)),
+                             (True, blocks.take_rows(datatype, columns, to_next))]
+
+            for to_next, part in parts:
+                if self.wal is not None:
+                    seq = self._log(to_next, wal_encode_batch(datatype, self.wal_source, self.epoch + to_next, part))
+
+                number_of_values = len(part['type_id']) if datatype == 'lf' else \
+                    int(part['offsets'][-1] - part['offsets'][0])
+                if to_next:
+                    self.next_cache[datatype].extend(part)
+                    self.next_cache_nov += number_of_values
+                else:
+                    self.cache[datatype].extend(part)
+                    self.cache_nov += number_of_values
+                self.rows_added[datatype] += len(part['type_id'])
+                self.values_added[datatype] += number_of_values
+
+            self._added()
+        self._hand_over()
+        return seq
+
+    def _hand_over(self):
+        # Outside of the lock: callback_when_full may block when the flusher falls behind
+        if self.sealed:
+            self.callback_when_full(self)
+
+    def take_sealed(self):
+        with self.lock:
+            sealed = self.sealed
+            self.sealed = []
+        return sealed
+
+    def oldest_wal_segment(self):
+        segments = [s for s in (self.cache_wal_segment, self.next_cache_wal_segment) if s is not None]
+        segments += [wal_state[0] for _, wal_state in self.sealed if wal_state[0] is not None]
+        return min(segments) if segments else None
+
+    def snapshot(self, start_micros, end_micros):
+        """
+        Returns {datatype: [row, ...]} of the rows held in memory (including sealed caches not taken yet)
+        that may hold values in [start_micros, end_micros).
+        """
+        rows = {}
+        with self.lock:
+            for full_cache in [self.cache, self.next_cache] + [c for c, _ in self.sealed]:
+                _range_rows(full_cache, start_micros, end_micros, self.hf_span, rows)
+        return rows
+
+    def _seal(self, full_cache, wal_state):
+        # Sorted now, under the lock: sealed buffers are read concurrently and never modified again
+        for buffer in full_cache.values():
+            buffer.sort()
+        self.sealed.append((full_cache, wal_state))
+
+    def _seal_if_settled(self):
+        limit = self._settled_before()
+        for buffer in self.cache.values():
+            if len(buffer) > 0 and buffer.max_key >= limit:
+                return
+
+        if self.cache_nov > 0:
+            self._seal(self.cache, (self.cache_wal_segment, [self.epoch]))
+
+        self.epoch += 1
+        self.cache = self.next_cache
+        self.cache_nov = self.next_cache_nov
+        self.cache_wal_segment = self.next_cache_wal_segment
+        self.cache_since = time.monotonic() if self.cache_nov > 0 else None
+        self.next_cache = {}
+        self.next_cache_nov = 0
+        self.next_cache_wal_segment = None
+
+        self.dump = False
+
+    def flush_if_older(self, max_age):
+        """
+        Starts dumping a cache holding data for longer than max_age (seconds), even if no new sample arrives.
+        """
+        with self.lock:
+            if self.cache_since is None or time.monotonic() - self.cache_since < max_age:
+                return
             self.dump = True
+            self._seal_if_settled()
+        self._hand_over()
 
-        if self.dump:
-            do = True
-            for k, _ in self.cache.items():
-                if len(self.cache[k]) > 0 and self.cache[k][-1][0] >= dt_to_micro_timestamp(datetime.datetime.now() - self.time_margin):
-                    do = False
-                    break
-            if do:
-                # TODO: Background-ize
-                self.callback_when_full(self.cache, self.source_id)
+    def flush(self):
+        """
+        Seals everything buffered (cache and next_cache) regardless of time_margin.
+        """
+        with self.lock:
+            for k, buffer in self.next_cache.items():
+                self.cache.setdefault(k, ColumnBuffer(k)).extend(buffer.columns())
+            if self.cache_nov + self.next_cache_nov > 0:
+                segments = [s for s in (self.cache_wal_segment, self.next_cache_wal_segment) if s is not None]
+                self._seal(self.cache, (min(segments) if segments else None, [self.epoch, self.epoch + 1]))
+
+            self.epoch += 2
+            self.cache = {}
+            self.cache_nov = 0
+            self.cache_since = None
+            self.cache_wal_segment = None
+            self.next_cache = {}
+            self.next_cache_nov = 0
+            self.next_cache_wal_segment = None
+            self.dump = False
+        self._hand_over()
+
+
+class Flusher:
+    """
+    Writes sealed caches from worker threads, off the ingest path.
+
+    The queue of sealed caches is bounded: when the disk falls behind, submit() blocks the writer that
+    sealed its cache (backpressure). A timer thread forces the flush of caches older than max_age.
+    """
+    def __init__(self, write_callback, get_caches, workers=1, queue_size=8, max_age=None, check_interval=1.0):
+        self.write_callback = write_callback
+        self.get_caches = get_caches
+        self.max_age = max_age
+        self.check_interval = check_interval
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stopped = threading.Event()
+
+        self._workers = [threading.Thread(target=self._work, name='pancarte-flush-{}'.format(i), daemon=True)
+                         for i in range(workers)]
+        for w in self._workers:
+            w.start()
+
+        self._timer = None
+        if max_age is not None:
+            self._timer = threading.Thread(target=self._tick, name='pancarte-flush-timer', daemon=True)
+            self._timer.start()
+
+    def submit(self, full_cache, source_id, wal_state=None):
+        self._queue.put((full_cache, source_id, wal_state))
+
+    def queued(self):
+        return self._queue.qsize()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self.write_callback(*item)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self._queue.task_done()
+
+    def _tick(self):
+        while not self._stopped.wait(self.check_interval):
+            for cache in list(self.get_caches()):
+                cache.flush_if_older(self.max_age)
+
+    def flush_all(self):
+        """
+        Flushes every cache and waits until all the sealed caches are written.
+        """
+        for cache in list(self.get_caches()):
+            cache.flush()
+        self._queue.join()
 
-                self.cache = self.next_cache
-                self.cache_nov = self.next_cache_nov
-                self.next_cache = {}
-                self.next_cache_nov = 0
+    def close(self):
+        if self._stopped.is_set():
+            return
+        self.flush_all()
+        self._stopped.set()
+        for _ in self._workers:
+            self._queue.put(None)
+        for w in self._workers:
+            w.join()
+        if self._timer is not None:
+            self._timer.join()
+
+
+def sqlite_on_connect(dbapi_connection, connection_record):
+    """
+    SQLite connection setup: WAL journal (readers do not block the writer nor each other), waiting for locks.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA busy_timeout=30000')
+    cursor.close()
+
+
+def instrument_engine(engine, database):
+    """
+    Observes the duration of the statements of engine in SQL_SECONDS (and the query trace, if any).
+    """
+    def before(conn, cursor, statement, parameters, context, executemany):
+        context._pancarte_started = time.perf_counter()
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, '_pancarte_started', None)
+        if started is None:
+            return
+        kind = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else ''
+        SQL_SECONDS.observe(time.perf_counter() - started, database, kind)
+        trace = metrics.current_trace()
+        if trace is not None:
+            trace.step('sql', started, database=database, statement=kind)
+
+    event.listen(engine, 'before_cursor_execute', before)
+    event.listen(engine, 'after_cursor_execute', after)
+
+
+class BlockManifest:
+    """
+    On-disk catalog of the immutable blocks (sqlite), queried instead of walking the partitioning tree.
+    """
+    def __init__(self, path, location):
+        self.location = location
+        self._engine = create_engine('sqlite:///{}'.format(path), connect_args={'check_same_thread': False})
+        event.listen(self._engine, 'connect', sqlite_on_connect)
+        instrument_engine(self._engine, 'manifest')
+        self._table = BlockEntry.__table__
+
+        ManifestBase.metadata.create_all(self._engine)
+
+    def _row(self, source_id, path, start_micros, end_micros, lf_rows=0, hf_rows=0, type_ids=(), byte_size=0):
+        return {
+            'source_id': str(source_id),
+            'path': os.path.relpath(path, self.location),
+            'start_micros': start_micros,
+            'end_micros': end_micros,
+            'span_micros': end_micros - start_micros,
+            'lf_rows': lf_rows,
+            'hf_rows': hf_rows,
+            'type_ids': ','.join(str(t) for t in type_ids),
+            'byte_size': byte_size,
+        }
+
+    def add(self, **entry):
+        with self._engine.begin() as conn:
+            conn.execute(self._table.insert(), self._row(**entry))
 
-                self.dump = False
+    def reset(self, entries):
+        with self._engine.begin() as conn:
+            conn.execute(self._table.delete())
+            if entries:
+                conn.execute(self._table.insert(), [self._row(**e) for e in entries])
+
+    def find(self, start_micros, end_micros, source_id=None):
+        """
+        Returns the (source_id, path) of the blocks overlapping [start_micros, end_micros], in time order.
+        source_id: one source_id or a list of them, all sources if None
+
+        Blocks are indexed by start; bounding the scan with the longest block span of the source turns the
+        overlap query into an index range scan.
+        """
+        t = self._table
+        where = []
+        sources = source_set(source_id)
+        if sources is not None:
+            where.append(t.c.source_id.in_(sorted(sources)))
+
+        with self._engine.connect() as conn:
+            q = select([func.max(t.c.span_micros)])
+            if where:
+                q = q.where(and_(*where))
+            max_span = conn.execute(q).scalar()
+            if max_span is None:
+                return []
+            where += [t.c.start_micros >= start_micros - max_span,
+                      t.c.start_micros <= end_micros,
+                      t.c.end_micros >= start_micros]
+            rows = conn.execute(select([t.c.source_id, t.c.path]).where(and_(*where))
+                                .order_by(t.c.start_micros, t.c.source_id)).fetchall()
+
+        return [(sid, os.path.join(self.location, path)) for sid, path in rows]
+
+    def sources(self):
+        with self._engine.connect() as conn:
+            return [sid for (sid,) in conn.execute(select([self._table.c.source_id]).distinct()
+                                                   .order_by(self._table.c.source_id))]
+
+    def entries(self, source_id, partition=None):
+        """
+        Returns the blocks of source_id as dicts (path being absolute), in time order.
+        partition: only the blocks of this partition directory (relative to the source directory, e.g. '2018/05/02')
+        """
+        t = self._table
+        where = [t.c.source_id == str(source_id)]
+        if partition is not None:
+            prefix = os.path.join(str(source_id), partition.strip('/'), '')
+            where.append(t.c.path.like(prefix.replace('%', r'\%').replace('_', r'\_') + '%', escape='\\'))
+        with self._engine.connect() as conn:
+            rows = conn.execute(select([t]).where(and_(*where)).order_by(t.c.start_micros)).fetchall()
+        return [dict(row, path=os.path.join(self.location, row['path'])) for row in rows]
+
+    def replace(self, old_paths, entry):
+        """
+        Swaps blocks for the one merging them in a single transaction. Returns False, changing nothing, if one of
+        old_paths is not in the manifest anymore.
+        """
+        t = self._table
+        relative = [os.path.relpath(p, self.location) for p in old_paths]
+        conn = self._engine.connect()
+        try:
+            with conn.begin() as transaction:
+                deleted = conn.execute(t.delete().where(t.c.path.in_(relative))).rowcount
+                if deleted != len(relative):
+                    transaction.rollback()
+                    return False
+                conn.execute(t.insert(), self._row(**entry))
+        finally:
+            conn.close()
+        return True
 
 
 class ImmutableStore:
-    def __init__(self, location: str, cache_size: int = 1E10, time_margin=datetime.timedelta(minutes=5), partitioning_depth=4):
+    def __init__(self, location: str, cache_size: int = 1E10, time_margin=datetime.timedelta(minutes=5), partitioning_depth=4,
+                 background_flush=True, flush_workers=1, flush_queue_size=8,
+                 max_cache_age=datetime.timedelta(minutes=10),
+                 wal=False, wal_fsync='interval', wal_segment_size=64 * 2 ** 20,
+                 read_workers=0, read_pool='thread', read_prefetch=None, block_cache_bytes=None,
+                 rollups=blocks.ROLLUP_RESOLUTIONS, compaction_interval=None,
+                 compaction_target_bytes=64 * 2 ** 20, compaction_io_rate=None, compaction_grace_period=60.0,
+                 codecs=None, cache_bytes=None):
         """
         cache_size: the number of values needed to dump the cache to disk
+        cache_bytes: bytes of memory buffers needed to dump a cache to disk (if not None), whichever of cache_size
+                     and cache_bytes is reached first
+        background_flush: write sealed caches from flush_workers threads instead of the writing thread, at most
+                          flush_queue_size sealed caches waiting before writers block
+        max_cache_age: dump a cache holding data for longer than this even if it is not full (background_flush only)
+        wal: log every write to <location>/.wal before it reaches the memory caches, replayed at startup
+        wal_fsync: 'always', 'interval' or 'never', see WriteAheadLog
+        read_workers: size of the pool decoding blocks in read_blocks (0: decode in the reading thread)
+        read_pool: 'thread' or 'process'
+        read_prefetch: number of blocks decoded ahead of the one being yielded (default: 2 * read_workers)
+        block_cache_bytes: budget of the process-wide cache of decoded blocks (blocks.block_cache), unchanged if None
+        rollups: resolutions (microseconds) of the hf min/max/mean rollups written with every block
+        compaction_interval: seconds between background compactions of the small blocks (see Compactor), None to
+                             only compact on compact() calls
+        compaction_target_bytes, compaction_io_rate, compaction_grace_period: see Compactor
+        codecs: column codecs of the written blocks, a compression.PRESETS name or {section: {column: codec}}
+                (default: raw columns)
         """
         self.location = location
         self.partitioning = '%Y/%m/%d/%H/%M/%S'.split('/')[:partitioning_depth]
 
+        self.datatypes = DATATYPES
+        self.rollups = sorted(rollups)
+        self.codecs = compression.PRESETS[codecs] if isinstance(codecs, str) else (codecs or {})
+
+        pathlib.Path(location).mkdir(parents=True, exist_ok=True)
+        manifest_path = os.path.join(location, '.manifest.sqlite3')
+        new_manifest = not os.path.exists(manifest_path)
+        self.manifest = BlockManifest(manifest_path, location)
+        if new_manifest:
+            self.rebuild_manifest()
+
         self.caches = {}
+        self._caches_lock = threading.Lock()
+        # Sealed caches handed to the writers and not in the manifest yet:
+        # {id(full_cache): (source_id, full_cache, hf_span)}
+        self._pending = {}
+        # Taken by readers to snapshot caches, pending caches and manifest together, always before a cache lock
+        self._view_lock = threading.Lock()
         self.cache_size = cache_size
+        self.cache_bytes = cache_bytes
         self.time_margin = time_margin
+        self.max_cache_age = max_cache_age if background_flush else None
+
+        self.flusher = None
+        if background_flush:
+            self.flusher = Flusher(self._write_sealed, lambda: self.caches.values(),
+                                   workers=flush_workers, queue_size=flush_queue_size,
+                                   max_age=max_cache_age.total_seconds() if max_cache_age is not None else None)
+
+        if block_cache_bytes is not None:
+            blocks.block_cache.resize(block_cache_bytes)
+
+        if read_pool not in ('thread', 'process'):
+            raise ValueError("read_pool must be 'thread' or 'process'")
+        self.read_workers = read_workers
+        self.read_pool = read_pool
+        self.read_prefetch = read_prefetch or 2 * max(read_workers, 1)
+        self._read_executor = None
+
+        self.wal = None
+        self._wal_pending = collections.Counter()
+        # Segments holding values of sealed caches that could not be written, kept for replay
+        self._wal_kept = set()
+        self._wal_lock = threading.Lock()
+        # Errors of the sealed caches that did not reach a block
+        self._flush_errors = []
+        if wal:
+            self.wal = WriteAheadLog(os.path.join(location, '.wal'), fsync=wal_fsync, segment_size=wal_segment_size)
+            self._replay_wal()
+
+        self.compactor = Compactor(self, target_bytes=compaction_target_bytes, io_rate=compaction_io_rate,
+                                   interval=compaction_interval, grace_period=compaction_grace_period)
+
+        metrics.registry.add_collector(ImmutableStore._collect_metrics, owner=self)
+
+    def _collect_metrics(self):
+        """
+        Gauges of the memory caches and of the flush path, labelled with the location of the store.
+        """
+        labels = (('location', self.location),)
+        stats = [cache.stats() for cache in list(self.caches.values())]
+        queued = self.flusher.queued() if self.flusher is not None else 0
+        ingested = [[(labels + (('datatype', k),), sum(s[i][k] for s in stats)) for k in self.datatypes]
+                    for i in (3, 4)]
+        return [
+            metrics.counter_family('pancarte_ingest_rows', 'lf values and hf chunks added to the memory caches',
+                                   ingested[0]),
+            metrics.counter_family('pancarte_ingest_values', 'lf values and hf samples added to the memory caches',
+                                   ingested[1]),
+            metrics.gauge_family('pancarte_cache_values', 'Values waiting in the memory caches',
+                                 [(labels, sum(s[0] for s in stats))]),
+            metrics.gauge_family('pancarte_cache_bytes', 'Bytes of the memory cache buffers',
+                                 [(labels, sum(s[1] for s in stats))]),
+            metrics.gauge_family('pancarte_cache_oldest_age_seconds',
+                                 'Age of the oldest value waiting in a memory cache',
+                                 [(labels, max([s[2] for s in stats], default=0.))]),
+            metrics.gauge_family('pancarte_caches', 'Memory caches (one per source_id)', [(labels, len(stats))]),
+            metrics.gauge_family('pancarte_flush_pending', 'Sealed caches not written to blocks yet',
+                                 [(labels, len(self._pending))]),
+            metrics.gauge_family('pancarte_flush_queued', 'Sealed caches waiting for a flush worker',
+                                 [(labels, queued)]),
+        ]
+
+    def _replay_wal(self):
+        # Replayed values are logged again in the new segments, the old ones can go once those are durable
+        for source_id, datatype, columns in self.wal.replay():
+            self._create_cache_if_not_exists(source_id)
+            self.caches[source_id].add_batch(datatype, columns)
+        self.wal.sync()
+        self.wal.truncate_before(self.wal.first_segment)
+
+    def _on_cache_sealed(self, cache):
+        with self._view_lock:
+            sealed = cache.take_sealed()
+            for full_cache, wal_state in sealed:
+                self._pending[id(full_cache)] = (cache.source_id, full_cache, cache.hf_span)
+                if self.wal is not None and wal_state[0] is not None:
+                    with self._wal_lock:
+                        self._wal_pending[wal_state[0]] += 1
+
+        errors = []
+        for full_cache, wal_state in sealed:
+            if self.flusher is not None:
+                self.flusher.submit(full_cache, cache.source_id, wal_state)
+                continue
+            try:
+                self._write_sealed(full_cache, cache.source_id, wal_state)
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+
+    def _write_sealed(self, full_cache, source_id, wal_state=None):
+        t0 = time.perf_counter()
+        segment = wal_state[0] if self.wal is not None and wal_state is not None else None
+        try:
+            entry = self._write_block_callback(full_cache, source_id)
+            if entry is not None:
+                FLUSH_SECONDS.observe(time.perf_counter() - t0)
+                FLUSH_BYTES.observe(entry['byte_size'])
+            # Published and unregistered at once: readers see the values either in memory or in a block
+            with self._view_lock:
+                try:
+                    if entry is not None:
+                        self.manifest.add(**entry)
+                except Exception:
+                    # Not published: no block left behind
+                    os.remove(entry['path'])
+                    raise
+                finally:
+                    self._pending.pop(id(full_cache), None)
+        except Exception as e:
+            # The values only remain in the WAL (no FLUSHED mark): their segment is kept for the next start
+            FLUSH_FAILURES.inc(1)
+            with self._view_lock:
+                self._pending.pop(id(full_cache), None)
+            with self._wal_lock:
+                self._flush_errors.append(e)
+                if segment is not None:
+                    self._wal_kept.add(segment)
+                    self._release_wal_segment(segment)
+            raise
 
-        self.datatypes = {
-            'lf': ['type_id', 'value', 'timestamp_micros'],
-            'hf': ['type_id', 'values', 'start_micros', 'end_micros', 'frequency']
-        }
+        if self.wal is None or wal_state is None:
+            return
+
+        self.wal.commit(self.wal.append(wal_encode_flushed(source_id, wal_state[1]))[1], force=True)
+        with self._wal_lock:
+            if segment is not None:
+                self._release_wal_segment(segment)
+            needed = list(self._wal_pending) + list(self._wal_kept)
+        needed += [c.oldest_wal_segment() for c in list(self.caches.values())]
+        needed = [s for s in needed if s is not None]
+        self.wal.truncate_before(min(needed) if needed else self.wal.segment)
+
+    def _release_wal_segment(self, segment):
+        # Under _wal_lock
+        self._wal_pending[segment] -= 1
+        if self._wal_pending[segment] <= 0:
+            del self._wal_pending[segment]
+
+    def _raise_flush_errors(self, since):
+        errors = self._flush_errors[since:]
+        if errors:
+            raise IOError('{} sealed caches could not be written to blocks{}'.format(
+                len(errors), ', their values are kept in the WAL' if self.wal is not None else '')) from errors[0]
 
     def _write_block_callback(self, full_cache: dict, source_id):
+        """
+        Writes a sealed cache to a block, returns its manifest entry (None if the cache is empty).
+        """
         date_start = None
         date_end = None
 
-        json_store = {
-            'lf': {
-                'type_id': [],
-                'timestamp_micros': [],
-                'value': [],
-            },
-            'hf': {
-                'type_id': [],
-                'start_micros': [],
-                'end_micros': [],
-                'frequency': [],
-                'values': [],
-            }
-        }
-
-        for dtt, sorted_list in full_cache.items():
-            if len(sorted_list) == 0:
+        sections = {}
+        for dtt, buffer in full_cache.items():
+            if len(buffer) == 0:
                 continue
-            if date_start is None or date_start > sorted_list[0][0]:
-                date_start = sorted_list[0][0]
-            if date_end is None or date_end < sorted_list[-1][0]:
-                date_end = sorted_list[-1][0]
+            sections[dtt] = buffer.columns()
+            first = int(sections[dtt][buffer.key][0])
+            if date_start is None or date_start > first:
+                date_start = first
+            # hf rows end after their start, the block spans up to the end of the last one
+            last = buffer.max_end if dtt == 'hf' else buffer.max_key
+            if date_end is None or date_end < last:
+                date_end = last
+
+        if date_start is None:
+            return
 
-            for (timestamp, data) in sorted_list:
-                for sub_dtt in self.datatypes[dtt]:
-                    json_store[dtt][sub_dtt].append(data[sub_dtt])
+        for dtt in self.datatypes:
+            if dtt not in sections:
+                sections[dtt] = blocks.empty_section(dtt)
+        for resolution in self.rollups:
+            sections[blocks.rollup_section(resolution)] = blocks.compute_rollup(sections['hf'], resolution)
 
         dt_date_first = datetime.datetime.fromtimestamp(date_start / 1E6)
 
         dst_dir = os.path.join(self.location, str(source_id), dt_date_first.strftime('/'.join(self.partitioning)))
         pathlib.Path(dst_dir).mkdir(parents=True, exist_ok=True)
 
-        dst = os.path.join(dst_dir, '{}-{}.msgpck'.format(date_start, date_end))
+        dst = os.path.join(dst_dir, '{}-{}{}'.format(date_start, date_end, blocks.EXTENSION))
+
+        # Caches of the same source can hold the same time range (rewritten values, replayed WAL)
+        # With a WAL, the block is durable before the flush mark dropping its values from the log
+        dst, byte_size = blocks.write_block(dst, sections, codecs=self.codecs, exclusive=True,
+                                            sync=self.wal is not None, source_id=str(source_id),
+                                            start_micros=date_start, end_micros=date_end)
 
-        with open(dst, 'wb') as f:
-            msgpack.pack(json_store, f)
+        type_ids = set()
+        for columns in sections.values():
+            type_ids.update(np.unique(np.asarray(columns['type_id'], dtype=np.int64)).tolist())
+        return dict(source_id=str(source_id), path=dst, start_micros=date_start, end_micros=date_end,
+                    lf_rows=len(sections['lf']['type_id']), hf_rows=len(sections['hf']['type_id']),
+                    type_ids=sorted(type_ids), byte_size=byte_size)
 
     def _create_cache_if_not_exists(self, source_id):
         if source_id not in self.caches:
-            self.caches[source_id] = MemoryCache(cache_size=self.cache_size, time_margin=self.time_margin,
-                                                 callback_when_full=self._write_block_callback, source_id=source_id)
+            with self._caches_lock:
+                if source_id not in self.caches:
+                    self.caches[source_id] = MemoryCache(cache_size=self.cache_size, time_margin=self.time_margin,
+                                                         callback_when_full=self._on_cache_sealed,
+                                                         source_id=source_id, wal=self.wal,
+                                                         cache_bytes=self.cache_bytes)
+
+    def flush_all(self):
+        """
+        Writes every cached value to disk, returns once the blocks are written. Raises IOError if some could not be
+        written (see close).
+        """
+        since = len(self._flush_errors)
+        if self.flusher is not None:
+            self.flusher.flush_all()
+        else:
+            for cache in list(self.caches.values()):
+                try:
+                    cache.flush()
+                except Exception:
+                    # Recorded in _flush_errors
+                    pass
+        self._raise_flush_errors(since)
+
+    def compact(self, source_id, partition=None):
+        """
+        Merges the small blocks of source_id (of one partition directory, e.g. '2018/05/02', if given).
+        Returns the number of merged blocks written.
+        """
+        return self.compactor.compact(source_id, partition)
+
+    def close(self):
+        """
+        Writes the cached values to blocks and stops the store. The WAL is removed only if every sealed cache
+        reached a block, it is replayed at the next start otherwise. Raises IOError if values written while
+        closing could not be written to blocks.
+        """
+        since = len(self._flush_errors)
+        try:
+            self.compactor.close()
+            if self.flusher is not None:
+                self.flusher.close()
+            else:
+                self.flush_all()
+        finally:
+            if self.wal is not None:
+                self.wal.close(remove=not self._flush_errors)
+            if self._read_executor is not None:
+                self._read_executor.shutdown()
+        self._raise_flush_errors(since)
 
     def write_lf(self, source_id: int, type_id: int, timestamp_micros: int, value: float):
         self._create_cache_if_not_exists(source_id)
 
-        self.caches[source_id].add_data(timestamp_micros, 'lf',
-                                        {'type_id': type_id, 'timestamp_micros': timestamp_micros,
-                                         'value': value},
-                                        number_of_values=1)
+        seq = self.caches[source_id].add_data(timestamp_micros, 'lf', (type_id, value, timestamp_micros),
+                                              number_of_values=1)
+        if seq is not None:
+            self.wal.commit(seq)
 
     def write_hf(self, source_id: int, type_id: int, start_micros: int, frequency: float, values: list):
+        check_hf_chunks(frequency)
         self._create_cache_if_not_exists(source_id)
 
+        # Converted once: the wal and the block writer both consume the array as is
+        values = np.asarray(values, dtype=np.float64)
         end_micros = start_micros + int((len(values) / frequency) * 1E6)
-        self.caches[source_id].add_data(start_micros, 'hf',
-                                        {'type_id': type_id, 'start_micros': start_micros,
-                                         'end_micros': end_micros,
-                                         'frequency': frequency, 'values': values},
-                                        number_of_values=len(values))
+        seq = self.caches[source_id].add_data(start_micros, 'hf',
+                                              (type_id, values, start_micros, end_micros, frequency),
+                                              number_of_values=len(values))
+        if seq is not None:
+            self.wal.commit(seq)
+
+    def _write_batch(self, datatype, source_ids, columns):
+        source_ids = np.asarray(source_ids)
+        if source_ids.ndim == 0:
+            groups = [(source_ids.item(), None)]
+        else:
+            if len(source_ids) != len(columns['type_id']):
+                raise ValueError('source_ids, type_ids and timestamps must have the same length')
+            uniques, inverse = np.unique(source_ids, return_inverse=True)
+            groups = [(u, inverse == i) for i, u in enumerate(uniques.tolist())] if len(uniques) > 1 else \
+                [(u, None) for u in uniques.tolist()]
+
+        seqs = []
+        for source_id, mask in groups:
+            self._create_cache_if_not_exists(source_id)
+            part = columns if mask is None else blocks.take_rows(datatype, columns, mask)
+            seqs.append(self.caches[source_id].add_batch(datatype, part))
+        seqs = [seq for seq in seqs if seq is not None]
+        if seqs:
+            self.wal.commit(max(seqs))
+
+    def write_lf_batch(self, source_ids, type_ids, timestamps_micros, values):
+        """
+        Writes many lf values at once. source_ids is either one source_id or one per value.
+        """
+        columns = {
+            'type_id': np.asarray(type_ids, dtype=np.int64),
+            'timestamp_micros': np.asarray(timestamps_micros, dtype=np.int64),
+            'value': np.asarray(values, dtype=np.float64),
+        }
+        columns['type_id'] = np.broadcast_to(columns['type_id'], columns['timestamp_micros'].shape)
+        if len(columns['value']) != len(columns['timestamp_micros']):
+            raise ValueError('timestamps_micros and values must have the same length')
+        self._write_batch('lf', source_ids, columns)
+
+    def write_hf_batch(self, source_ids, type_ids, starts_micros, frequencies, values, offsets):
+        """
+        Writes many hf chunks at once: chunk i is values[offsets[i]:offsets[i + 1]] (len(offsets) is the number
+        of chunks + 1, offsets[0] is 0 and offsets[-1] len(values)). source_ids, type_ids and frequencies are either
+        one value or one per chunk. Invalid chunks raise ValueError, nothing being written.
+        """
+        offsets = np.asarray(offsets, dtype=np.int64)
+        starts_micros = np.asarray(starts_micros, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        if len(offsets) != len(starts_micros) + 1:
+            raise ValueError('offsets must have one more element than starts_micros')
+        frequencies = np.broadcast_to(np.asarray(frequencies, dtype=np.float64), starts_micros.shape)
+        check_hf_chunks(frequencies, offsets, len(values))
+        columns = {
+            'type_id': np.broadcast_to(np.asarray(type_ids, dtype=np.int64), starts_micros.shape),
+            'start_micros': starts_micros,
+            'end_micros': starts_micros + ((np.diff(offsets) / frequencies) * 1E6).astype(np.int64),
+            'frequency': frequencies,
+            'offsets': offsets,
+            'values': values,
+        }
+        self._write_batch('hf', source_ids, columns)
+
+    def _walk_blocks(self):
+        for source_id in sorted(os.listdir(self.location)):
+            source_dir = os.path.join(self.location, source_id)
+            if source_id.startswith('.') or not os.path.isdir(source_dir):
+                continue
+            for root, dirs, files in os.walk(source_dir):
+                dirs.sort()
+                for f in sorted(files):
+                    if blocks.parse_block_name(f) is not None:
+                        yield source_id, os.path.join(root, f)
+
+    def rebuild_manifest(self):
+        """
+        Reconstructs the block manifest from the blocks found in the partitioning tree.
+        """
+        entries = []
+        superseded = set()
+        for source_id, path in self._walk_blocks():
+            start_micros, end_micros = blocks.parse_block_name(os.path.basename(path))
+            entries.append(dict(blocks.block_stats(path), source_id=source_id, path=path,
+                                start_micros=start_micros, end_micros=end_micros))
+            if path.endswith(blocks.EXTENSION):
+                # Sources of a compaction interrupted before their removal
+                superseded.update(os.path.join(os.path.dirname(path), name)
+                                  for name in blocks.read_header(path).get('compacted_from', []))
+        entries = [e for e in entries if e['path'] not in superseded]
+        self.manifest.reset(entries)
+        return len(entries)
 
     def _find_blocks(self, start_micros, end_micros, source_id=None):
-        dt_start = micros_timestamp_to_dt(start_micros)
-        dt_end = micros_timestamp_to_dt(end_micros)
-
-        ls = []
-        le = []
-
-        m = {'Y': 'year', 'm': 'month', 'd': 'day', 'H': 'hour', 'M': 'minute', 'S': 'second'}
-        for e in self.partitioning:
-            ls.append(str(getattr(dt_start, m[e[1]])))
-            le.append(str(getattr(dt_end, m[e[1]])))
-
-        def rec_explore(dir, previous=None, depth=0):
-            if previous is None:
-                previous = []
-
-            if depth == len(self.partitioning):
-                res = []
-                for f in os.listdir(os.path.join(dir, *previous)):
-                    s, e = [int(k) for k in f.split('.')[0].split('-')]
-                    if e < start_micros or s > end_micros:
-                        continue
-                    res.append(os.path.join(dir, *previous, f))
-                return res
-            else:
-                result = []
-                for p in os.listdir(os.path.join(dir, *previous)):
-                    curr = int(''.join(previous) + p)
-                    if int(dt_start.strftime(''.join(self.partitioning[:depth + 1]))) <= curr <= int(
-                            dt_end.strftime(''.join(self.partitioning[:depth + 1]))):
-                        result += rec_explore(dir, previous + [p], depth + 1)
-                return result
-
-        if source_id is None:
-            result = []
-            for source_id in os.listdir(self.location):
-                result += [(source_id, e) for e in rec_explore(os.path.join(self.location, source_id))]
-            return sorted(result, key=lambda x: '/'.join(x[1].split('/')[1:]))
-
-        return [(str(source_id), e) for e in sorted(rec_explore(os.path.join(self.location, str(source_id))))]
-
-    def read_blocks(self, start_micros, end_micros, lf=True, hf=True, **filters):
+        return self.manifest.find(start_micros, end_micros, source_id=source_id)
+
+    def _read_pool(self):
+        if self._read_executor is None:
+            with self._caches_lock:
+                if self._read_executor is None:
+                    if self.read_pool == 'process':
+                        self._read_executor = concurrent.futures.ProcessPoolExecutor(self.read_workers)
+                    else:
+                        self._read_executor = concurrent.futures.ThreadPoolExecutor(
+                            self.read_workers, thread_name_prefix='pancarte-read')
+        return self._read_executor
+
+    def _snapshot(self, start_micros, end_micros, source_id=None, memory=True):
+        """
+        Returns (blocks, memory rows) as of one instant: a value is either in a listed block or in the rows
+        ({source_id: {datatype: [row, ...]}}), never in both. Caches are only locked while their rows in the
+        range are copied.
+        """
+        with self._view_lock:
+            return self._snapshot_locked(start_micros, end_micros, source_id, memory)
+
+    def _snapshot_locked(self, start_micros, end_micros, source_id, memory):
+        wanted = source_set(source_id)
+        blocks_found = self._find_blocks(start_micros, end_micros, source_id=source_id)
+        if not memory:
+            return blocks_found, {}
+
+        in_memory = {}
+        for sid, cache in list(self.caches.items()):
+            if wanted is None or str(sid) in wanted:
+                in_memory[sid] = cache.snapshot(start_micros, end_micros)
+        for sid, full_cache, hf_span in self._pending.values():
+            if wanted is None or str(sid) in wanted:
+                _range_rows(full_cache, start_micros, end_micros, hf_span, in_memory.setdefault(sid, {}))
+        return blocks_found, in_memory
+
+    def rollup_level(self, start_micros, end_micros, resolution=None, max_points=None):
+        """
+        Returns the rollup resolution to read hf values at, None for the raw samples:
+        - resolution (microseconds): the coarsest level not coarser than it
+        - max_points: the finest level giving at most max_points buckets per source_id/type_id over the range
+          (the coarsest one if none does), raw samples when the range is shorter than max_points finest buckets
+        resolution takes precedence over max_points.
+        """
+        if not self.rollups:
+            return None
+        if resolution is not None:
+            levels = [r for r in self.rollups if r <= resolution]
+            return levels[-1] if levels else None
+        if max_points is not None:
+            wanted = (end_micros - start_micros) / max(max_points, 1)
+            if wanted < self.rollups[0]:
+                return None
+            levels = [r for r in self.rollups if r >= wanted]
+            return levels[0] if levels else self.rollups[-1]
+        return None
+
+    def read_blocks(self, start_micros, end_micros, lf=True, hf=True, parallel=None, memory=True, resolution=None,
+                    max_points=None, arrays=False, **filters):
+        """
+        Returns an iterator of one result per block, in the order of _find_blocks, then one per source_id holding
+        values not written to blocks yet.
+
+        parallel: decode blocks in the read pool (read_workers), read_prefetch blocks ahead of the one being
+                  yielded. Defaults to True when the store has read_workers.
+        memory: include the values still in the memory caches
+        resolution, max_points: return hf values as min/max/mean rollups (see rollup_level), a bucket may be split
+                                over several results (read_all_blocks merges them)
+        arrays: results hold NumPy arrays instead of lists, hf samples being laid out as in blocks (flat values
+                and offsets) with the first_sample of trimmed rows (see blocks.row_anchors)
+        filters: source_id (one or a list) and row filters, see compile_filters. Invalid filters raise ValueError
+                 here rather than while iterating.
+        """
+        predicates = compile_filters(filters)
+        rollup = self.rollup_level(start_micros, end_micros, resolution, max_points) if hf else None
+        return self._read_blocks(start_micros, end_micros, lf, hf, parallel, memory, rollup, predicates, arrays,
+                                 filters.get('source_id', None))
+
+    def _read_blocks(self, start_micros, end_micros, lf, hf, parallel, memory, rollup, predicates, arrays,
+                     source_id):
         if not lf and not hf:
-            yield from []
             return
 
-        t0 = datetime.datetime.now()
-
-        blocks = self._find_blocks(start_micros, end_micros, source_id=filters.get('source_id', None))
-
-        def _subfun(json_store, k):
-            if k not in ['lf', 'hf']:
-                raise NotImplementedError()
-
-            if k == 'lf':
-                df = pd.DataFrame.from_dict(json_store['lf']).astype({
-                                                              'type_id': int,
-                                                              'timestamp_micros': int,
-                                                              'value': float})
-                where = 'timestamp_micros >= {} & timestamp_micros < {}'.format(start_micros, end_micros)
-            elif k == 'hf':
-                df = pd.DataFrame.from_dict(json_store['hf']).astype({
-                                                              'type_id': int,
-                                                              'start_micros': int,
-                                                              'end_micros': int,
-                                                              'frequency': float,
-                                                              'values': list})
-                where = 'start_micros >= {} & end_micros < {}'.format(start_micros, end_micros)
-            else:
-                raise NotImplementedError()
-
-            for fn, fv in filters.items():
-                if fn != 'source_id':
-                    where += ' & {}=={}'.format(fn, fv)
-
-            df = df.query(where)
-
-            if k == 'lf':
-                df = df.sort_values('timestamp_micros')
-            elif k == 'hf':
-                df = df.sort_values('start_micros')
-            dff = df.transpose().to_dict('split')
-            result = {}
-            for m, col in enumerate(dff['index']):
-                result[col] = dff['data'][m]
-            return result
-
-        for source_id, block in blocks:
-            res = {}
-            t1 = datetime.datetime.now()
-            with open(block, 'rb') as b:
-                print(block)
-                json_store = msgpack.unpack(b, raw=False)
-            print('msgpack.unpack took {}'.format(datetime.datetime.now()-t1))
-            if lf:
-                res['lf'] = _subfun(json_store, 'lf')
-                res['lf']['source_id'] = [source_id for _ in range(len(res['lf']['type_id']))]
-            if hf:
-                res['hf'] = _subfun(json_store, 'hf')
-                res['hf']['source_id'] = [source_id for _ in range(len(res['hf']['type_id']))]
-            print('yield took {}'.format(datetime.datetime.now()-t0))
-            yield res
+        t0 = time.perf_counter()
+        trace = metrics.current_trace()
+        try:
+            blocks_found, in_memory = self._snapshot(start_micros, end_micros, source_id=source_id, memory=memory)
+            if trace is not None:
+                trace.step('snapshot', t0, blocks=len(blocks_found), memory_sources=len(in_memory))
+            args = (start_micros, end_micros, lf, hf, predicates, rollup, arrays)
+
+            yield from self._decode_blocks(blocks_found, args, parallel, trace)
+
+            for source_id, rows in sorted(in_memory.items(), key=lambda item: str(item[0])):
+                if any(rows.values()):
+                    started = time.perf_counter()
+                    res = _filter_memory(rows, str(source_id), *args)
+                    if trace is not None:
+                        trace.step('memory', started, source_id=str(source_id), rows=_result_rows(res))
+                    yield res
+        finally:
+            READ_SECONDS.observe(time.perf_counter() - t0, 'blocks')
+
+    def _decoded(self, source_id, block, res, started, trace):
+        rows = _result_rows(res)
+        BLOCKS_SCANNED.inc(1)
+        if rows:
+            BLOCKS_RETURNED.inc(1)
+        if trace is not None:
+            trace.step('block', started, source_id=str(source_id), path=os.path.relpath(block, self.location),
+                       rows=rows)
+
+    def _decode_blocks(self, blocks_found, args, parallel, trace=None):
+        """
+        Yields the results of blocks_found, decoded in the read pool if parallel. Trace steps measure the decoding
+        of a block, or the wait for it in the read pool.
+        """
+        if parallel is None:
+            parallel = self.read_workers > 0
+        if not parallel or len(blocks_found) < 2:
+            for source_id, block in blocks_found:
+                started = time.perf_counter()
+                res = decode_block(block, source_id, *args)
+                self._decoded(source_id, block, res, started, trace)
+                yield res
+            return
 
-    def read_all_blocks(self, start_micros, end_micros, lf=True, hf=True, **filters):
+        pool = self._read_pool()
+        remaining = iter(blocks_found)
+        pending = collections.deque((source_id, block, pool.submit(decode_block, block, source_id, *args))
+                                    for source_id, block in itertools.islice(remaining, self.read_prefetch))
+        try:
+            while pending:
+                source_id, block, future = pending.popleft()
+                for next_source_id, next_block in itertools.islice(remaining, 1):
+                    pending.append((next_source_id, next_block,
+                                    pool.submit(decode_block, next_block, next_source_id, *args)))
+                started = time.perf_counter()
+                res = future.result()
+                self._decoded(source_id, block, res, started, trace)
+                yield res
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+
+    def read_all_blocks(self, start_micros, end_micros, lf=True, hf=True, parallel=None, memory=True,
+                        resolution=None, max_points=None, **filters):
+        rollup = self.rollup_level(start_micros, end_micros, resolution, max_points) if hf else None
         dd = {
             'lf': {
                 'source_id': [],
@@ -289,7 +1429,10 @@ class ImmutableStore:
                 'values': [],
             }
         }
-        for d in self.read_blocks(start_micros, end_micros, lf=lf, hf=hf, **filters):
+        if rollup is not None:
+            dd['hf'] = {k: [] for k in ['source_id'] + ROLLUP_COLUMNS}
+        for d in self.read_blocks(start_micros, end_micros, lf=lf, hf=hf, parallel=parallel, memory=memory,
+                                  resolution=rollup, **filters):
             ff = []
             if lf:
                 ff.append('lf')
@@ -298,16 +1441,172 @@ class ImmutableStore:
             for k in ff:
                 for kk, vv in d[k].items():
                     dd[k][kk] += vv
+        if rollup is not None:
+            dd['hf'] = merge_rollups(dd['hf'])
         return dd
 
+    def read_intervals(self, intervals, lf=True, hf=True, parallel=None, memory=True, arrays=False, **filters):
+        """
+        Returns an iterator of one result per block, then per source_id in memory, holding only the values inside
+        intervals: {source_id: (starts, ends)} of [start, end) intervals, overlapping ones being merged. hf rows
+        are cut into one row per interval they cross.
+        Blocks are read once, over the span of the intervals of their source_id. filters are the row filters of
+        read_blocks (the source_ids are the ones of intervals).
+        """
+        predicates = compile_filters(filters)
+        coalesced = {}
+        for source_id, (starts, ends) in intervals.items():
+            starts, ends = coalesce_intervals(starts, ends)
+            if len(starts):
+                coalesced[str(source_id)] = (starts, ends)
+        return self._read_intervals(coalesced, lf, hf, parallel, memory, arrays, predicates)
+
+    def _read_intervals(self, intervals, lf, hf, parallel, memory, arrays, predicates):
+        if not intervals or (not lf and not hf):
+            return
+
+        t0 = time.perf_counter()
+        trace = metrics.current_trace()
+        try:
+            # One view of every source_id, each over the span of its intervals
+            blocks_found, in_memory = [], {}
+            with self._view_lock:
+                for source_id, (starts, ends) in sorted(intervals.items()):
+                    found, rows = self._snapshot_locked(int(starts[0]), int(ends[-1]), source_id, memory)
+                    blocks_found += found
+                    in_memory.update(rows)
+            if trace is not None:
+                trace.step('snapshot', t0, blocks=len(blocks_found), memory_sources=len(in_memory))
+            start_micros = min(int(starts[0]) for starts, _ in intervals.values())
+            end_micros = max(int(ends[-1]) for _, ends in intervals.values())
+            args = (start_micros, end_micros, lf, hf, predicates, None, True)
+
+            def clip(res, source_id):
+                res = _clip_intervals(res, *intervals[str(source_id)])
+                return res if arrays else {k: _section_lists(k, section) for k, section in res.items()}
+
+            for source_id, res in zip((sid for sid, _ in blocks_found),
+                                      self._decode_blocks(blocks_found, args, parallel, trace)):
+                yield clip(res, source_id)
+
+            for source_id, rows in sorted(in_memory.items(), key=lambda item: str(item[0])):
+                if any(rows.values()):
+                    started = time.perf_counter()
+                    res = clip(_filter_memory(rows, str(source_id), *args), source_id)
+                    if trace is not None:
+                        trace.step('memory', started, source_id=str(source_id), rows=_result_rows(res))
+                    yield res
+        finally:
+            READ_SECONDS.observe(time.perf_counter() - t0, 'intervals')
+
+    def read_all_intervals(self, intervals, lf=True, hf=True, parallel=None, memory=True, **filters):
+        """
+        read_intervals results concatenated, as read_all_blocks returns them.
+        """
+        dd = {k: {col: [] for col in ['source_id'] + DATATYPES[k]} for k, wanted in (('lf', lf), ('hf', hf))
+              if wanted}
+        for d in self.read_intervals(intervals, lf=lf, hf=hf, parallel=parallel, memory=memory, **filters):
+            for k in dd:
+                for kk, vv in d[k].items():
+                    dd[k][kk] += vv
+        return dd
+
+    def aggregate(self, start_micros, end_micros, bucket_micros, lf=True, hf=True, percentiles=(),
+                  relative_accuracy=0.01, parallel=None, memory=True, **filters):
+        """
+        Returns {'lf': columns, 'hf': columns} of count/min/max/mean/std (and percentiles) per source_id, type_id
+        and bucket of bucket_micros (aligned on the epoch), hf samples being aggregated one by one.
+        See aggregation.Aggregator, filters are the ones of read_blocks.
+        """
+        results = self.read_blocks(start_micros, end_micros, lf=lf, hf=hf, parallel=parallel, memory=memory,
+                                   arrays=True, **filters)
+        aggregated = {k: aggregation.Aggregator(bucket_micros, percentiles, relative_accuracy)
+                      for k, wanted in (('lf', lf), ('hf', hf)) if wanted}
+        for res in results:
+            for k, section in res.items():
+                aggregated[k].add_section(k, section)
+        return {k: a.result() for k, a in aggregated.items()}
+
+
+def time_range_clauses(model, start_micros=None, end_micros=None):
+    """
+    Returns the clauses selecting the annotations of model in [start_micros, end_micros) (either bound optional):
+    timestamps inside it, time ranges overlapping it.
+    """
+    clauses = []
+    if start_micros is None and end_micros is None:
+        return clauses
+    if hasattr(model, 'timestamp_micros'):
+        if start_micros is not None:
+            clauses.append(model.timestamp_micros >= int(start_micros))
+        if end_micros is not None:
+            clauses.append(model.timestamp_micros < int(end_micros))
+    elif hasattr(model, 'start_micros'):
+        if end_micros is not None:
+            clauses.append(model.start_micros < int(end_micros))
+        if start_micros is not None:
+            clauses.append(model.end_micros > int(start_micros))
+    else:
+        raise ValueError('{} has no time range'.format(model.__tablename__))
+    return clauses
+
 
 class MutableStore:
-    def __init__(self, url="sqlite:///pancarte.sqlite3"):
-        self._engine = create_engine(url)
+    # Bound parameters per statement are limited (999 for older SQLite), id lists are deleted in chunks
+    DELETE_CHUNK = 500
+
+    def __init__(self, url="sqlite:///pancarte.sqlite3", pool_size=5, max_overflow=10, pool_recycle=3600,
+                 read_pool_size=None, annotation_type_ttl=60.0):
+        """
+        pool_size, max_overflow, pool_recycle: connection pool of the database (see sqlalchemy.create_engine)
+        read_pool_size: SQLite connections used by reads (pool_size if None). SQLite databases are opened in WAL
+                        journal mode, reads going through their own pool while writes share one connection.
+        annotation_type_ttl: seconds the annotation types are cached for; the cache is invalidated by the
+                             writes of this store, the ttl bounds the staleness after writes of other processes
+        """
+        if url.startswith('sqlite') and ':memory:' not in url and url.rstrip('/') != 'sqlite:':
+            # One writer at a time in SQLite: a single write connection queues writers instead of failing them
+            # with 'database is locked'
+            self._engine = create_engine(url, poolclass=QueuePool, pool_size=1, max_overflow=0,
+                                         connect_args={'check_same_thread': False})
+            self._read_engine = create_engine(url, poolclass=QueuePool, pool_size=read_pool_size or pool_size,
+                                              max_overflow=max_overflow, connect_args={'check_same_thread': False})
+            for engine in (self._engine, self._read_engine):
+                event.listen(engine, 'connect', sqlite_on_connect)
+        else:
+            kwargs = {}
+            if not url.startswith('sqlite'):
+                kwargs = dict(pool_size=pool_size, max_overflow=max_overflow, pool_recycle=pool_recycle,
+                              pool_pre_ping=True)
+            self._engine = self._read_engine = create_engine(url, **kwargs)
+        for engine in {self._engine, self._read_engine}:
+            instrument_engine(engine, 'annotations')
         self._session_class = sessionmaker(bind=self._engine)
-        self.get_session = self._session_class()
+        # One session per thread (per request under Flask, see remove_session)
+        self.get_session = scoped_session(sessionmaker(bind=self._read_engine))
+
+        self.annotation_type_ttl = annotation_type_ttl
+        self._annotation_types = None
+        self._annotation_types_expiry = 0.
+        self._annotation_types_lock = threading.Lock()
 
         Base.metadata.create_all(self._engine)
+        self._create_missing_indexes()
+
+    def remove_session(self):
+        """
+        Closes the session of the current thread, to be called at the end of every request.
+        """
+        self.get_session.remove()
+
+    def _create_missing_indexes(self):
+        # create_all skips the tables that exist, indexes added since they were created are created here
+        inspector = inspect(self._engine)
+        for table in Base.metadata.sorted_tables:
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(self._engine)
 
     def create(self, model, **kwargs):
         o = model(**kwargs)
@@ -323,13 +1622,95 @@ class MutableStore:
         finally:
             session.close()
 
+        self._written(model)
         return self.get(model, id=id)
 
+    def _written(self, model):
+        # Objects of the session of this thread may predate the write
+        self.get_session.expire_all()
+        if model is AnnotationType:
+            with self._annotation_types_lock:
+                self._annotation_types = None
+
+    def _cached_annotation_types(self):
+        """
+        Returns the [(id, name), ...] of the annotation types, read again once the cache is invalidated or
+        expired.
+        """
+        with self._annotation_types_lock:
+            if self._annotation_types is None or time.monotonic() > self._annotation_types_expiry:
+                t = AnnotationType.__table__
+                with self._read_engine.connect() as conn:
+                    self._annotation_types = [tuple(row) for row in
+                                              conn.execute(select([t.c.id, t.c.name]).order_by(t.c.id))]
+                self._annotation_types_expiry = time.monotonic() + self.annotation_type_ttl
+            return self._annotation_types
+
+    def _annotation_types_matching(self, kwargs):
+        # Detached copies: cached rows are shared by every thread
+        types = [AnnotationType(id=id, name=name) for id, name in self._cached_annotation_types()]
+        for k, v in kwargs.items():
+            if k == 'id':
+                try:
+                    v = int(v)
+                except (TypeError, ValueError):
+                    return []
+            types = [o for o in types if getattr(o, k) == v]
+        return types
+
     def get(self, model, **kwargs):
+        if model is AnnotationType and set(kwargs) <= {'id', 'name'}:
+            types = self._annotation_types_matching(kwargs)
+            return types[0] if types else None
         return self.get_session.query(model).filter_by(**kwargs).first()
 
-    def get_all(self, model, **kwargs):
-        return self.get_session.query(model).filter_by(**kwargs).all()
+    def get_all(self, model, start_micros=None, end_micros=None, **kwargs):
+        """
+        Returns the objects matching kwargs (equality) and, for annotations, in [start_micros, end_micros)
+        (see time_range_clauses), in time order then.
+        """
+        if model is AnnotationType and set(kwargs) <= {'id', 'name'} and start_micros is end_micros is None:
+            return self._annotation_types_matching(kwargs)
+        q = self.get_session.query(model).filter_by(**kwargs)
+        clauses = time_range_clauses(model, start_micros, end_micros)
+        if clauses:
+            q = q.filter(*clauses).order_by(
+                model.timestamp_micros if hasattr(model, 'timestamp_micros') else model.start_micros)
+        return q.all()
+
+    def create_many(self, model, rows):
+        """
+        Inserts rows (dicts having the same keys) in one transaction with a single executemany, returns their
+        number. Nothing is inserted if one of them fails (IntegrityError).
+        """
+        rows = list(rows)
+        if rows:
+            with self._engine.begin() as conn:
+                conn.execute(model.__table__.insert(), rows)
+            self._written(model)
+        return len(rows)
+
+    def delete_many(self, model, ids=None, start_micros=None, end_micros=None, **kwargs):
+        """
+        Deletes in one transaction the objects of ids (if given) matching kwargs (equality) and the time range
+        (see time_range_clauses), returns their number. Raises ValueError rather than deleting every object.
+        """
+        t = model.__table__
+        clauses = [t.c[k] == v for k, v in kwargs.items()] + time_range_clauses(model, start_micros, end_micros)
+        if ids is None and not clauses:
+            raise ValueError('no criteria to delete {} objects'.format(model.__tablename__))
+
+        deleted = 0
+        with self._engine.begin() as conn:
+            if ids is None:
+                deleted = conn.execute(t.delete().where(and_(*clauses))).rowcount
+            else:
+                ids = [int(i) for i in ids]
+                for i in range(0, len(ids), self.DELETE_CHUNK):
+                    where = clauses + [t.c.id.in_(ids[i:i + self.DELETE_CHUNK])]
+                    deleted += conn.execute(t.delete().where(and_(*where))).rowcount
+        self._written(model)
+        return deleted
 
     def update(self, model, id, **kwargs):
         session = self._session_class()
@@ -343,14 +1724,55 @@ class MutableStore:
         finally:
             session.close()
 
+        self._written(model)
         return self.get(model, id=id)
 
-    def delete(self, model, id):
-        o = model(id=id)
+    def annotation_type_id(self, annotation_type):
+        """
+        Returns the id of an annotation type given by id or name, None if there is no such type.
+        """
+        try:
+            return int(annotation_type)
+        except ValueError:
+            o = self.get(AnnotationType, name=annotation_type)
+            return o.id if o is not None else None
+
+    def annotation_intervals(self, type_id, start_micros, end_micros, source_id=None, padding_micros=0):
+        """
+        Returns {source_id: (starts, ends)}: the [start, end) intervals of the annotations of type_id overlapping
+        [start_micros, end_micros), cut to it. Timerange annotations give their range, timestamp annotations
+        [timestamp_micros - padding_micros, timestamp_micros + padding_micros] (the annotated instant itself
+        without padding). source_id: one or a list of them, all sources if None.
+        """
+        sources = source_set(source_id)
+        r, t = TimerangeAnnotation.__table__, TimestampAnnotation.__table__
+        ranges = select([r.c.source_id, r.c.start_micros, r.c.end_micros]).where(and_(
+            r.c.type_id == type_id, r.c.start_micros < end_micros, r.c.end_micros > start_micros))
+        instants = select([t.c.source_id, t.c.timestamp_micros - padding_micros,
+                           t.c.timestamp_micros + padding_micros + 1]).where(and_(
+            t.c.type_id == type_id, t.c.timestamp_micros >= start_micros - padding_micros,
+            t.c.timestamp_micros < end_micros + padding_micros))
+        if sources is not None:
+            ranges = ranges.where(r.c.source_id.in_(sorted(int(s) for s in sources)))
+            instants = instants.where(t.c.source_id.in_(sorted(int(s) for s in sources)))
+
+        intervals = {}
+        with self._read_engine.connect() as conn:
+            for q in (ranges, instants):
+                for sid, start, end in conn.execute(q):
+                    starts, ends = intervals.setdefault(str(sid), ([], []))
+                    starts.append(max(start, start_micros))
+                    ends.append(min(end, end_micros))
+        return {sid: (np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64))
+                for sid, (starts, ends) in intervals.items()}
 
+    def delete(self, model, id):
+        """
+        Returns the number of deleted objects (0 if there was none with this id).
+        """
         session = self._session_class()
         try:
-            session.add(o)
+            deleted = session.query(model).filter(model.id == id).delete()
             session.commit()
         except IntegrityError:
             session.rollback()
@@ -358,4 +1780,5 @@ class MutableStore:
         finally:
             session.close()
 
-        return self.get(model, id=id)
+        self._written(model)
+        return deleted
@@ -0,0 +1,84 @@
+import datetime
+
+import numpy as np
+import pytest
+
+from aggregation import Aggregator
+from storage import ImmutableStore
+
+START_MICROS = 1525255489000000
+
+
+def _expected(source_ids, type_ids, timestamps, values, bucket_micros):
+    buckets = timestamps // bucket_micros * bucket_micros
+    groups = {}
+    for key in sorted(set(zip(source_ids.tolist(), type_ids.tolist(), buckets.tolist()))):
+        mask = (source_ids == key[0]) & (type_ids == key[1]) & (buckets == key[2])
+        groups[key] = values[mask]
+    return groups
+
+
+def _assert_aggregates(res, groups, percentiles, relative_accuracy):
+    assert list(zip(res['source_id'], res['type_id'], res['bucket_micros'])) == list(groups)
+    for i, group in enumerate(groups.values()):
+        assert res['count'][i] == len(group)
+        assert res['min'][i] == group.min()
+        assert res['max'][i] == group.max()
+        assert res['mean'][i] == pytest.approx(group.mean())
+        assert res['std'][i] == pytest.approx(group.std())
+        ordered = np.sort(group)
+        for p in percentiles:
+            actual = ordered[int(np.floor(p / 100. * (len(group) - 1)))]
+            assert abs(res['p{:g}'.format(p)][i] - actual) <= relative_accuracy * abs(actual) + 1e-12
+
+
+@pytest.mark.parametrize('relative_accuracy', [0.01, 0.05])
+def test_aggregator_matches_numpy(relative_accuracy):
+    rng = np.random.RandomState(0)
+    n = 5000
+    source_ids = rng.choice(['1', '2'], size=n)
+    type_ids = rng.randint(1, 3, size=n)
+    timestamps = START_MICROS + rng.randint(0, 5 * 10 ** 6, size=n)
+    # Positive, negative and zero values, over several orders of magnitude
+    values = rng.lognormal(0, 3, size=n) * rng.choice([-1, 1], size=n)
+    values[::50] = 0.
+    percentiles = (0, 1, 50, 95, 100)
+
+    aggregator = Aggregator(10 ** 6, percentiles, relative_accuracy)
+    # Added in chunks, partial aggregates being merged
+    for chunk in np.array_split(np.arange(n), 7):
+        for source_id in ('1', '2'):
+            index = chunk[source_ids[chunk] == source_id]
+            aggregator.add(source_id, type_ids[index], timestamps[index], values[index])
+    _assert_aggregates(aggregator.result(), _expected(source_ids, type_ids, timestamps, values, 10 ** 6),
+                       percentiles, relative_accuracy)
+
+
+def test_aggregator_arguments():
+    for args in ((0,), (10, (101,)), (10, (50,), 1.)):
+        with pytest.raises(ValueError):
+            Aggregator(*args)
+    aggregator = Aggregator(10, (50,))
+    aggregator.add('1', np.array([1]), np.array([START_MICROS]), np.array([np.nan]))
+    assert aggregator.result() == {c: [] for c in ['source_id', 'type_id', 'bucket_micros', 'count', 'min', 'max',
+                                                   'mean', 'std', 'p50']}
+
+
+def test_store_aggregate(tmp_path):
+    store = ImmutableStore(location=str(tmp_path), time_margin=datetime.timedelta(0), background_flush=False)
+    rng = np.random.RandomState(1)
+    hf_values = rng.normal(size=(4, 150))
+    for i in range(4):
+        store.write_hf(1, 1, START_MICROS + i * 1500000, 100., hf_values[i])
+        store.write_lf(2, 3, START_MICROS + i * 1500000, float(i))
+        if i < 3:
+            store.flush_all()
+
+    res = store.aggregate(START_MICROS, START_MICROS + 10 ** 7, 10 ** 6, percentiles=(50, 90))
+    timestamps = START_MICROS + (np.arange(4)[:, None] * 1500000 + np.arange(150) * 10000).ravel()
+    groups = _expected(np.full(600, '1'), np.ones(600, dtype=np.int64), timestamps, hf_values.ravel(), 10 ** 6)
+    _assert_aggregates(res['hf'], groups, (50, 90), 0.01)
+    assert res['lf']['bucket_micros'] == [START_MICROS, START_MICROS + 10 ** 6, START_MICROS + 3 * 10 ** 6,
+                                          START_MICROS + 4 * 10 ** 6]
+    assert res['lf']['mean'] == [0., 1., 2., 3.]
+    store.close()
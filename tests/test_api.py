@@ -0,0 +1,123 @@
+import json
+import os
+import struct
+
+import msgpack
+import numpy as np
+import pytest
+
+START_MICROS = 1525255489000000
+
+
+@pytest.fixture(scope='module')
+def client(tmp_path_factory):
+    # api opens its stores in the working directory when imported
+    cwd = os.getcwd()
+    os.chdir(str(tmp_path_factory.mktemp('api')))
+    try:
+        import api
+        yield api.app.app.test_client()
+        # Written here rather than when the store is closed at exit, in the working directory of then
+        api.immutable_store.flush_all()
+    finally:
+        os.chdir(cwd)
+
+
+def raw(array):
+    return {'dtype': array.dtype.str, 'data': array.tobytes()}
+
+
+def test_annotation_bulk_raw_columns(client):
+    client.post('/annotations/types', data={'name': 'raw-bulk'})
+    body = msgpack.packb({
+        'source_id': raw(np.array([1, 1, 2], dtype='<i8')),
+        'type_id': raw(np.array([1, 1, 1], dtype='<i8')),
+        'timestamp_micros': raw(START_MICROS + np.arange(3, dtype='<i8')),
+        'value': raw(np.array([.5, 1., 1.5], dtype='<f8')),
+    }, use_bin_type=True)
+    r = client.post('/annotations/timestamp/bulk', data=body, content_type='application/msgpack')
+    assert r.status_code == 201
+    assert r.json == {'count': 3}
+
+
+def test_annotated_waveforms_bad_source_id(client):
+    client.post('/annotations/types', data={'name': 'bad-source'})
+    r = client.get('/waveforms', query_string={'lf': 'true', 'hf': 'true', 'start_micros': START_MICROS,
+                                               'end_micros': START_MICROS + 10 ** 6, 'annotation_type': 'bad-source',
+                                               'source_id': 'abc'})
+    assert r.status_code == 400
+
+
+def test_waveform_invalid_frequency(client):
+    r = client.post('/waveforms', data={'hf_source_id': 1, 'hf_type_id': 1, 'hf_start_micros': START_MICROS,
+                                        'hf_frequency': 0, 'hf_values': '[1, 2, 3]'})
+    assert r.status_code == 400
+
+
+def test_waveform_bulk_invalid_offsets(client):
+    body = msgpack.packb({'hf': {'source_id': 1, 'type_id': 1, 'start_micros': [START_MICROS], 'frequency': 10.,
+                                 'offsets': [0, 100], 'values': raw(np.arange(10, dtype='<f8'))}}, use_bin_type=True)
+    r = client.post('/waveforms/bulk', data=body, content_type='application/msgpack')
+    assert r.status_code == 400
+
+
+def _stream_frames(data, stream):
+    if stream == 'ndjson':
+        return [json.loads(line) for line in data.splitlines()]
+    frames = []
+    while data:
+        size, = struct.unpack('>I', data[:4])
+        frames.append(msgpack.unpackb(data[4:4 + size], raw=False))
+        data = data[4 + size:]
+    return frames
+
+
+@pytest.mark.parametrize('stream', ['ndjson', 'msgpack'])
+def test_streamed_waveforms(client, stream):
+    import api
+
+    source_id = {'ndjson': 61, 'msgpack': 62}[stream]
+    for i in range(3):
+        client.post('/waveforms', data={'lf_source_id': source_id, 'lf_type_id': 1,
+                                        'lf_timestamp_micros': START_MICROS + i, 'lf_value': i})
+        client.post('/waveforms', data={'hf_source_id': source_id, 'hf_type_id': 2,
+                                        'hf_start_micros': START_MICROS + i * 10 ** 6, 'hf_frequency': 10.,
+                                        'hf_values': '[1, 2]'})
+        if i == 1:
+            api.immutable_store.flush_all()
+    query = {'lf': 'true', 'hf': 'true', 'start_micros': START_MICROS, 'end_micros': START_MICROS + 10 ** 7,
+             'source_id': source_id}
+
+    r = client.get('/waveforms', query_string=dict(query, stream=stream))
+    assert r.status_code == 200
+    assert r.mimetype == api.STREAM_FORMATS[stream][0]
+    # One frame per block or memory cache holding values, same values as the whole result
+    frames = _stream_frames(r.data, stream)
+    assert len(frames) == 2
+    whole = client.get('/waveforms', query_string=query).json
+    for k in ('lf', 'hf'):
+        assert {col: [v for f in frames for v in f[k][col]] for col in whole[k]} == whole[k]
+    assert whole['lf']['value'] == [0., 1., 2.]
+
+
+def test_streamed_waveforms_bad_request(client):
+    query = {'lf': 'true', 'hf': 'true', 'start_micros': START_MICROS, 'end_micros': START_MICROS + 10 ** 6}
+    assert client.get('/waveforms', query_string=dict(query, stream='csv')).status_code == 400
+    assert client.get('/waveforms', query_string=dict(query, stream='ndjson', trace='true')).status_code == 400
+
+
+def test_metrics_and_traces(client):
+    client.post('/waveforms', data={'lf_source_id': 63, 'lf_type_id': 1, 'lf_timestamp_micros': START_MICROS,
+                                    'lf_value': 1})
+    r = client.get('/waveforms', query_string={'lf': 'true', 'hf': 'false', 'start_micros': START_MICROS,
+                                               'end_micros': START_MICROS + 1, 'source_id': 63, 'trace': 'true'})
+    assert r.json['lf']['value'] == [1.]
+    assert 'snapshot' in [s['step'] for s in r.json['trace']['steps']]
+
+    r = client.get('/metrics')
+    assert r.status_code == 200
+    assert r.content_type.startswith('text/plain; version=0.0.4')
+    text = r.data.decode()
+    for family in ('pancarte_http_request_seconds', 'pancarte_read_seconds', 'pancarte_cache_values',
+                   'pancarte_block_cache_hits'):
+        assert '# TYPE {} '.format(family) in text
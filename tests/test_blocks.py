@@ -0,0 +1,163 @@
+import os
+
+import msgpack
+import numpy as np
+import pytest
+
+import blocks
+import compression
+
+START_MICROS = 1525255489000000
+
+
+def _sections():
+    return {
+        'lf': {
+            'type_id': np.array([2, 1, 2], dtype=np.int32),
+            'timestamp_micros': START_MICROS + np.arange(3, dtype=np.int64),
+            'value': np.array([1.5, -2., 3.25]),
+        },
+        'hf': {
+            'type_id': np.array([1, 1], dtype=np.int32),
+            'start_micros': np.array([START_MICROS, START_MICROS + 10 ** 6], dtype=np.int64),
+            'end_micros': np.array([START_MICROS + 3 * 10 ** 5, START_MICROS + 12 * 10 ** 5], dtype=np.int64),
+            'frequency': np.array([10., 10.]),
+            'offsets': np.array([0, 3, 5], dtype=np.int64),
+            'values': np.arange(5.),
+        },
+    }
+
+
+def _sorted_rows(section, columns):
+    order = np.argsort(columns['type_id'], kind='stable')
+    return blocks.take_rows(section, columns, order)
+
+
+def assert_sections_equal(actual, expected):
+    assert set(actual) == set(expected)
+    for section, columns in expected.items():
+        assert set(actual[section]) == set(columns)
+        for name, array in columns.items():
+            assert actual[section][name].dtype == np.dtype(blocks.section_schema(section)[name])
+            np.testing.assert_array_equal(actual[section][name], array)
+
+
+def test_block_round_trip(tmp_path):
+    sections = _sections()
+    path, byte_size = blocks.write_block(str(tmp_path / 'b.pcb'), sections, source_id='1')
+
+    assert byte_size == (tmp_path / 'b.pcb').stat().st_size
+    header = blocks.read_header(path)
+    assert header['source_id'] == '1'
+    assert header['data_start'] % 8 == 0
+    data = blocks.read_block(path, cache=False)
+    # Raw columns are memory-mapped, rows come back sorted by type_id
+    assert not data['lf']['value'].flags.owndata
+    assert_sections_equal(data, {k: _sorted_rows(k, v) for k, v in sections.items()})
+
+
+def test_empty_sections_round_trip(tmp_path):
+    path, _ = blocks.write_block(str(tmp_path / 'b.pcb'), {k: blocks.empty_section(k) for k in ('lf', 'hf')})
+    data = blocks.read_block(path, cache=False)
+    assert len(data['lf']['type_id']) == 0
+    assert data['hf']['offsets'].tolist() == [0]
+
+
+def test_legacy_block_read(tmp_path):
+    path = tmp_path / '{}-{}.msgpck'.format(START_MICROS, START_MICROS + 1)
+    sections = _sections()
+    legacy = {
+        'lf': {k: v.tolist() for k, v in sections['lf'].items()},
+        'hf': {k: v.tolist() for k, v in sections['hf'].items() if k not in ('offsets', 'values')},
+    }
+    legacy['hf']['values'] = [[0., 1., 2.], [3., 4.]]
+    path.write_bytes(msgpack.packb(legacy, use_bin_type=True))
+
+    assert_sections_equal(blocks.read_block(str(path), cache=False), sections)
+    assert blocks.parse_block_name(path.name) == (START_MICROS, START_MICROS + 1)
+
+
+def test_not_a_block(tmp_path):
+    path = tmp_path / 'b.pcb'
+    path.write_bytes(b'\0' * 64)
+    with pytest.raises(ValueError):
+        blocks.read_header(str(path))
+
+
+def test_exclusive_write_never_replaces(tmp_path):
+    path = str(tmp_path / '{}-{}.pcb'.format(START_MICROS, START_MICROS + 1))
+    first, _ = blocks.write_block(path, _sections(), exclusive=True)
+    second, _ = blocks.write_block(path, _sections(), exclusive=True)
+
+    assert first == path
+    assert second == str(tmp_path / '{}-{}.1.pcb'.format(START_MICROS, START_MICROS + 1))
+    assert blocks.parse_block_name('{}-{}.1.pcb'.format(START_MICROS, START_MICROS + 1)) == \
+        (START_MICROS, START_MICROS + 1)
+    assert sorted(os.listdir(str(tmp_path))) == sorted(os.path.basename(p) for p in (first, second))
+    assert blocks.block_stats(second)['type_ids'] == [1, 2]
+
+
+def _columns(n):
+    return {'value': np.zeros(n)}
+
+
+def test_block_cache_lru_budget():
+    cache = blocks.BlockCache(max_bytes=3 * 80)
+    for name in 'abc':
+        cache.put(name, 'lf', 1, _columns(10))
+    assert cache.get('a', 'lf', 1) is not None
+    cache.put('d', 'lf', 1, _columns(10))
+
+    # b was the least recently used
+    assert cache.get('b', 'lf', 1) is None
+    assert all(cache.get(name, 'lf', 1) is not None for name in 'acd')
+    # Entries larger than the budget are not kept
+    cache.put('e', 'lf', 1, _columns(100))
+    assert cache.get('e', 'lf', 1) is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (4, 2, 1)
+    assert (stats['entries'], stats['bytes']) == (3, 240)
+
+    cache.resize(80)
+    assert cache.stats()['entries'] == 1
+    cache.invalidate('d')
+    assert cache.stats()['entries'] == 0
+
+
+def test_block_cache_stale_entries(tmp_path):
+    path = str(tmp_path / 'b.pcb')
+    blocks.write_block(path, _sections())
+    previous = blocks.block_cache.max_bytes
+    blocks.block_cache.resize(2 ** 20)
+    try:
+        first = blocks.read_block(path)
+        assert blocks.read_block(path)['lf']['value'] is first['lf']['value']
+
+        # A block replaced under the same name is read again
+        sections = _sections()
+        sections['lf']['value'] = sections['lf']['value'] * 2
+        blocks.write_block(path, sections)
+        os.utime(path, ns=(0, 1))
+        np.testing.assert_array_equal(blocks.read_block(path)['lf']['value'], [-4., 3., 6.5])
+    finally:
+        blocks.block_cache.clear()
+        blocks.block_cache.resize(previous)
+
+
+@pytest.mark.parametrize('codecs', [None, compression.PRESETS['fast']])
+def test_type_id_runs(tmp_path, codecs):
+    sections = _sections()
+    sections['hf']['type_id'] = np.array([3, 1], dtype=np.int32)
+    path, _ = blocks.write_block(str(tmp_path / 'b.pcb'), sections, codecs=codecs)
+
+    header = blocks.read_header(path)
+    assert header['version'] == 3
+    assert header['sections']['lf']['runs'] == [[1, 0, 1], [2, 1, 3]]
+    assert header['sections']['hf']['runs'] == [[1, 0, 1], [3, 1, 2]]
+    for type_ids in ([1], [2, 3], [4], []):
+        data = blocks.read_block(path, cache=False, type_ids=type_ids)
+        for section, columns in sections.items():
+            expected = _sorted_rows(section, columns)
+            expected = blocks.take_rows(section, expected, np.isin(expected['type_id'], type_ids))
+            for name, array in expected.items():
+                np.testing.assert_array_equal(data[section][name], array)
@@ -0,0 +1,77 @@
+import datetime
+
+import numpy as np
+
+import blocks
+from buffers import ColumnBuffer
+from storage import ImmutableStore
+
+START_MICROS = 1525255489000000
+
+
+def test_lf_buffer_growth_and_order():
+    buffer = ColumnBuffer('lf')
+    n = ColumnBuffer.INITIAL_CAPACITY * 3
+    order = np.arange(n)
+    order[10], order[20] = order[20], order[10]
+    for i in order:
+        buffer.append((int(i % 3), float(i), START_MICROS + int(i)))
+
+    assert len(buffer) == buffer.value_count == n
+    assert not buffer.is_sorted
+    columns = buffer.columns()
+    assert buffer.is_sorted
+    for name, dtype in blocks.SCHEMA['lf'].items():
+        assert columns[name].dtype == np.dtype(dtype)
+    np.testing.assert_array_equal(columns['timestamp_micros'], START_MICROS + np.arange(n))
+    np.testing.assert_array_equal(columns['value'], np.arange(n, dtype=np.float64))
+    assert buffer.max_key == START_MICROS + n - 1
+
+
+def test_hf_buffer_extend_and_range():
+    buffer = ColumnBuffer('hf')
+    buffer.append((1, [1., 2.], START_MICROS, START_MICROS + 2, 1E6))
+    values = np.arange(10.)
+    # offsets may start anywhere in values
+    buffer.extend({'type_id': np.array([2, 3]), 'start_micros': np.array([START_MICROS + 10, START_MICROS + 5]),
+                   'end_micros': np.array([START_MICROS + 13, START_MICROS + 9]), 'frequency': np.full(2, 1E6),
+                   'offsets': np.array([3, 6, 10]), 'values': values})
+    assert buffer.value_count == 9
+    assert buffer.max_end == START_MICROS + 13
+    assert not buffer.is_sorted
+
+    columns = buffer.columns()
+    assert columns['type_id'].tolist() == [1, 3, 2]
+    assert columns['offsets'].tolist() == [0, 2, 6, 9]
+    assert columns['values'].tolist() == [1., 2., 6., 7., 8., 9., 3., 4., 5.]
+
+    rows = buffer.range(START_MICROS + 5, START_MICROS + 11)
+    assert rows['type_id'].tolist() == [3, 2]
+    lo, hi = rows['offsets'][0], rows['offsets'][-1]
+    assert rows['values'][lo:hi].tolist() == [6., 7., 8., 9., 3., 4., 5.]
+    assert buffer.range(START_MICROS + 20, START_MICROS + 30) is None
+
+    # Returned columns stay valid while the buffer grows
+    for i in range(ColumnBuffer.INITIAL_CAPACITY * 2):
+        buffer.append((4, [0.] * 5, START_MICROS + 100 + i, START_MICROS + 105 + i, 1E6))
+    assert columns['values'].tolist() == [1., 2., 6., 7., 8., 9., 3., 4., 5.]
+    assert len(buffer.columns()['offsets']) == len(buffer) + 1
+
+
+def test_sealed_buffers_written_sorted(tmp_path):
+    store = ImmutableStore(location=str(tmp_path), time_margin=datetime.timedelta(0), background_flush=False)
+    for i in (3, 1, 2, 0):
+        store.write_lf(1, 1, START_MICROS + i, float(i))
+        store.write_hf(1, 2, START_MICROS + i * 10 ** 6, 10., [float(i)] * (i + 1))
+    store.flush_all()
+
+    path = store.manifest.entries(1)[0]['path']
+    data = blocks.read_block(path, cache=False)
+    assert data['lf']['timestamp_micros'].tolist() == [START_MICROS + i for i in range(4)]
+    assert data['lf']['value'].tolist() == [0., 1., 2., 3.]
+    assert data['hf']['offsets'].tolist() == [0, 1, 3, 6, 10]
+    assert data['hf']['values'].tolist() == [0.] + [1.] * 2 + [2.] * 3 + [3.] * 4
+    for section in ('lf', 'hf'):
+        for name, dtype in blocks.SCHEMA[section].items():
+            assert data[section][name].dtype == np.dtype(dtype)
+    store.close()
@@ -0,0 +1,100 @@
+import datetime
+import os
+import threading
+import time
+
+import numpy as np
+
+from compaction import TokenBucket
+from storage import ImmutableStore
+
+START_MICROS = 1525255489000000
+
+
+def _store(tmp_path, **kwargs):
+    return ImmutableStore(location=str(tmp_path), time_margin=datetime.timedelta(0), background_flush=False,
+                          **kwargs)
+
+
+def _write_blocks(store, first, count):
+    for i in range(first, first + count):
+        store.write_lf(1, 1, START_MICROS + i * 10 ** 5, float(i))
+        store.write_hf(1, 2, START_MICROS + i * 10 ** 5, 100., np.full(10, float(i)))
+        store.flush_all()
+
+
+def test_compaction_merges_small_blocks(tmp_path):
+    store = _store(tmp_path, compaction_grace_period=3600)
+    _write_blocks(store, 0, 6)
+    end_micros = START_MICROS + 10 ** 7
+    before = store.read_all_blocks(START_MICROS, end_micros)
+    sources = [e['path'] for e in store.manifest.entries(1)]
+
+    assert store.compact(1) == 1
+    entries = store.manifest.entries(1)
+    assert len(entries) == 1
+    assert store.read_all_blocks(START_MICROS, end_micros) == before
+    # Sources stay until the grace period is over, a rebuilt manifest ignores them
+    assert all(os.path.exists(p) for p in sources)
+    assert store.rebuild_manifest() == 1
+    assert store.compact(1) == 0
+
+    store.compactor.collect(force=True)
+    assert not any(os.path.exists(p) for p in sources)
+    assert store.read_all_blocks(START_MICROS, end_micros) == before
+    store.close()
+
+
+def test_merged_block_synced(tmp_path, monkeypatch):
+    store = _store(tmp_path)
+    _write_blocks(store, 0, 3)
+    synced = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, 'fsync', lambda fd: synced.append(fd) or fsync(fd))
+    assert store.compact(1) == 1
+    assert synced
+    store.close()
+
+
+def test_compaction_with_concurrent_reader(tmp_path):
+    store = _store(tmp_path, compaction_grace_period=0.05)
+    end_micros = START_MICROS + 10 ** 8
+    expected = [0]
+    errors = []
+    done = threading.Event()
+
+    def read():
+        while not done.is_set():
+            count = expected[0]
+            data = store.read_all_blocks(START_MICROS, end_micros, memory=False)
+            values = sorted(data['lf']['value'])
+            # Blocks are only added meanwhile: every value once, none missing
+            if len(set(values)) != len(values) or len(values) < count or \
+                    values[:count] != [float(i) for i in range(count)]:
+                errors.append(values)
+            if sorted(v[0] for v in data['hf']['values']) != values:
+                errors.append(data['hf']['values'])
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    try:
+        for i in range(5):
+            _write_blocks(store, i * 4, 4)
+            expected[0] = (i + 1) * 4
+            store.compact(1)
+            time.sleep(0.06)
+    finally:
+        done.set()
+        reader.join()
+    assert not errors
+    assert len(store.manifest.entries(1)) == 1
+    store.close()
+
+
+def test_token_bucket():
+    bucket = TokenBucket(10000, burst=10000)
+    started = time.monotonic()
+    bucket.consume(5000)
+    assert time.monotonic() - started < 0.1
+    bucket.consume(7000)
+    assert time.monotonic() - started >= 0.15
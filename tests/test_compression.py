@@ -0,0 +1,85 @@
+import datetime
+
+import numpy as np
+import pytest
+
+import blocks
+import compression
+from storage import ImmutableStore
+
+START_MICROS = 1525255489000000
+
+
+@pytest.mark.parametrize('codec, array', [
+    (['delta'], START_MICROS + np.cumsum(np.arange(100, dtype=np.int64))),
+    (['dod', 'shuffle', 'zlib'], START_MICROS + np.arange(100, dtype=np.int64) * 1000),
+    (['xor', 'lzma'], np.random.RandomState(0).normal(size=100)),
+    (['shuffle', 'zlib:1'], np.arange(100, dtype=np.int32)),
+    (['xor', 'shuffle', 'lzma:1'], np.array([], dtype=np.float64)),
+])
+def test_lossless_codecs(codec, array):
+    payload, dtypes = compression.encode(array, codec)
+    decoded = compression.decode(payload, codec, dtypes, len(array))
+    assert decoded.dtype == array.dtype
+    np.testing.assert_array_equal(decoded, array)
+
+
+def test_quantize_error():
+    array = np.random.RandomState(0).uniform(-10, 10, size=1000)
+    codec = ['quantize:0.01', 'delta', 'zlib']
+    payload, dtypes = compression.encode(array, codec)
+    decoded = compression.decode(payload, codec, dtypes, len(array))
+    assert np.abs(decoded - array).max() <= 0.005 + 1e-12
+
+
+def test_invalid_codecs():
+    with pytest.raises(ValueError):
+        compression.encode(np.arange(10.), ['zlib', 'xor'])
+    with pytest.raises(ValueError):
+        compression.encode(np.arange(10.), ['unknown'])
+
+
+def _sections(rng):
+    lengths = rng.randint(1, 50, size=20)
+    offsets = np.zeros(21, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    starts = START_MICROS + np.arange(20, dtype=np.int64) * 10 ** 6
+    return {
+        'lf': {
+            'type_id': rng.randint(1, 4, size=100).astype(np.int32),
+            'timestamp_micros': START_MICROS + np.arange(100, dtype=np.int64) * 1000,
+            'value': rng.normal(size=100),
+        },
+        'hf': {
+            'type_id': rng.randint(1, 4, size=20).astype(np.int32),
+            'start_micros': starts,
+            'end_micros': starts + lengths * 10 ** 4,
+            'frequency': np.full(20, 100.),
+            'offsets': offsets,
+            'values': rng.normal(size=offsets[-1]),
+        },
+    }
+
+
+@pytest.mark.parametrize('preset', sorted(compression.PRESETS))
+def test_preset_block_round_trip(tmp_path, preset):
+    sections = _sections(np.random.RandomState(0))
+    path, _ = blocks.write_block(str(tmp_path / 'b.pcb'), sections, codecs=compression.PRESETS[preset])
+    data = blocks.read_block(path, cache=False)
+    for section, columns in sections.items():
+        expected = blocks.take_rows(section, columns, np.argsort(columns['type_id'], kind='stable'))
+        for name, array in expected.items():
+            np.testing.assert_array_equal(data[section][name], array)
+
+
+@pytest.mark.parametrize('preset', sorted(compression.PRESETS))
+def test_store_codecs(tmp_path, preset):
+    store = ImmutableStore(location=str(tmp_path), time_margin=datetime.timedelta(0), background_flush=False,
+                           codecs=preset)
+    store.write_lf(1, 1, START_MICROS, .1)
+    store.write_hf(1, 2, START_MICROS, 10., [.5, 1.5, -2.])
+    store.flush_all()
+    data = store.read_all_blocks(START_MICROS, START_MICROS + 10 ** 7, memory=False)
+    assert data['lf']['value'] == [.1]
+    assert data['hf']['values'] == [[.5, 1.5, -2.]]
+    store.close()
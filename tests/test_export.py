@@ -0,0 +1,42 @@
+import csv
+import datetime
+import gzip
+
+import export
+from storage import ImmutableStore
+
+START_MICROS = 1525255489000000
+
+
+def read_rows(path):
+    with gzip.open(path, 'rt') as f:
+        return [(int(type_id), int(timestamp), float(value)) for type_id, timestamp, value in csv.reader(f)]
+
+
+def test_block_landing_in_exported_hour(tmp_path):
+    store = ImmutableStore(location=str(tmp_path / 'db'), time_margin=datetime.timedelta(0), background_flush=False)
+    exporter = export.Exporter(store, str(tmp_path / 'export'), fmt='csv')
+    hour = START_MICROS // export.HOUR_MICROS * export.HOUR_MICROS
+    path = exporter.path('lf', 1, hour)
+
+    store.write_lf(1, 1, START_MICROS, 1.)
+    store.flush_all()
+    assert exporter.export() == {'1': {'hours': 1, 'lf': 1, 'hf': 0}}
+    assert read_rows(path) == [(1, START_MICROS, 1.)]
+
+    # Written late, after its hour was exported
+    store.write_lf(1, 1, START_MICROS + 10 ** 6, 2.)
+    store.flush_all()
+    assert exporter.export()['1']['lf'] == 2
+    assert read_rows(path) == [(1, START_MICROS, 1.), (1, START_MICROS + 10 ** 6, 2.)]
+    store.close()
+
+
+def test_open_hours_wait_for_the_caches(tmp_path):
+    store = ImmutableStore(location=str(tmp_path / 'db'), time_margin=datetime.timedelta(minutes=5),
+                           max_cache_age=datetime.timedelta(minutes=10))
+    exporter = export.Exporter(store, str(tmp_path / 'export'), fmt='csv')
+    assert exporter.delay == datetime.timedelta(minutes=16)
+    now_micros = int(datetime.datetime.now().timestamp() * 1E6)
+    assert exporter.watermark() <= now_micros - 16 * 60 * 10 ** 6
+    store.close()
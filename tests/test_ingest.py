@@ -0,0 +1,42 @@
+import datetime
+import socket
+import struct
+
+import numpy as np
+import pytest
+
+import ingest
+from storage import ImmutableStore
+
+START_MICROS = 1525255489000000
+
+
+@pytest.mark.parametrize('frequency', [0., -250., float('nan'), float('inf')])
+def test_invalid_frequency_rejected(tmp_path, frequency):
+    store = ImmutableStore(location=str(tmp_path), time_margin=datetime.timedelta(0))
+    server = ingest.IngestServer(store, host='127.0.0.1', port=0)
+    server.start_in_thread()
+    try:
+        with socket.create_connection(('127.0.0.1', server.port)) as s:
+            s.sendall(ingest.pack_hf(1, 1, START_MICROS, frequency, np.arange(10.)))
+            s.settimeout(5)
+            length, = struct.unpack('>I', s.recv(4))
+            body = s.recv(length)
+        assert body[0] == ingest.ERROR
+        assert b'frequencies' in body
+    finally:
+        server.close()
+        store.close()
+    assert store.manifest.sources() == []
+
+
+def test_start_in_thread_port_in_use(tmp_path):
+    store = ImmutableStore(location=str(tmp_path))
+    with socket.socket() as taken:
+        taken.bind(('127.0.0.1', 0))
+        taken.listen()
+        server = ingest.IngestServer(store, host='127.0.0.1', port=taken.getsockname()[1])
+        with pytest.raises(OSError):
+            server.start_in_thread()
+    server.close()
+    store.close()
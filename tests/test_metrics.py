@@ -0,0 +1,88 @@
+import gc
+import time
+
+import pytest
+
+import metrics
+
+
+def test_render_counters_and_histograms():
+    registry = metrics.Registry()
+    requests = registry.counter('requests', 'Requests\nserved', ['method'])
+    requests.inc(1, 'GET')
+    requests.inc(2, 'GET')
+    requests.inc(1, 'a"b\\')
+    latency = registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        latency.observe(value)
+
+    assert requests.value('GET') == 3
+    assert latency.count() == 3
+    assert registry.render().splitlines() == [
+        '# HELP latency_seconds Latency',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1"} 2',
+        'latency_seconds_bucket{le="+Inf"} 3',
+        'latency_seconds_sum 5.55',
+        'latency_seconds_count 3',
+        r'# HELP requests Requests\nserved',
+        '# TYPE requests counter',
+        'requests_total{method="GET"} 3',
+        r'requests_total{method="a\"b\\"} 1',
+    ]
+
+
+def test_registration():
+    registry = metrics.Registry()
+    counter = registry.counter('c', 'help', ['label'])
+    assert registry.counter('c', 'other help', ['label']) is counter
+    with pytest.raises(ValueError):
+        registry.histogram('c', 'help', ['label'])
+    with pytest.raises(ValueError):
+        registry.counter('c', 'help')
+    with pytest.raises(ValueError):
+        counter.inc(1)
+
+
+class _Owner:
+    def __init__(self, value):
+        self.value = value
+
+    def collect(self):
+        return [metrics.gauge_family('owned', 'Owned values', [((('owner', str(self.value)),), self.value)])]
+
+
+def test_collectors():
+    registry = metrics.Registry()
+    owners = [_Owner(1), _Owner(2)]
+    for owner in owners:
+        registry.add_collector(_Owner.collect, owner=owner)
+    registry.add_collector(lambda: metrics.with_labels(
+        [metrics.counter_family('kept', 'Kept values', [((), 4)])], shard=0))
+
+    families = {f['name']: f for f in registry.collect()}
+    # Families of the same name are merged
+    assert families['owned']['samples'] == [('owned', (('owner', '1'),), 1), ('owned', (('owner', '2'),), 2)]
+    assert families['kept']['samples'] == [('kept_total', (('shard', 0),), 4)]
+
+    # Collectors of owners that are gone return nothing
+    del owners[0]
+    gc.collect()
+    assert [s[2] for s in {f['name']: f for f in registry.collect()}['owned']['samples']] == [2]
+
+
+def test_tracing():
+    assert metrics.current_trace() is None
+    with metrics.tracing(False) as trace:
+        assert trace is None and metrics.current_trace() is None
+    with metrics.tracing() as outer:
+        with metrics.tracing() as inner:
+            assert metrics.current_trace() is inner
+            inner.step('read', time.perf_counter(), rows=3)
+        assert metrics.current_trace() is outer
+    assert metrics.current_trace() is None
+
+    steps = inner.to_json()['steps']
+    assert [(s['step'], s['rows']) for s in steps] == [('read', 3)]
+    assert outer.to_json()['steps'] == []
@@ -0,0 +1,30 @@
+import datetime
+
+import numpy as np
+import pytest
+
+from sharding import ShardedStore
+
+START_MICROS = 1525255489000000
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ShardedStore(str(tmp_path), shards=2, time_margin=datetime.timedelta(0))
+    for source_id in range(4):
+        store.write_hf_batch(source_id, 1, START_MICROS + np.arange(60) * 10 ** 6, 100., np.arange(6000.),
+                             np.arange(0, 6001, 100))
+    store.flush_all()
+    yield store
+    store.close()
+
+
+def test_sharded_rollups(store):
+    results = list(store.read_blocks(START_MICROS, START_MICROS + 60 * 10 ** 6, lf=False, max_points=10))
+    assert sum(sum(res['hf']['count']) for res in results) == 4 * 6000
+    assert {s for res in results for s in res['hf']['source_id']} == {'0', '1', '2', '3'}
+    assert all(isinstance(res['hf']['mean'], list) for res in results)
+
+    hf = store.read_all_blocks(START_MICROS, START_MICROS + 60 * 10 ** 6, lf=False, max_points=10)['hf']
+    assert sum(hf['count']) == 4 * 6000
+    assert min(hf['min']) == 0. and max(hf['max']) == 5999.
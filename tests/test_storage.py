@@ -0,0 +1,348 @@
+import datetime
+import threading
+import time
+
+import numpy as np
+import pytest
+from sqlalchemy import text
+
+import blocks
+import metrics
+from db.tables import AnnotationType, TimestampAnnotation
+from storage import ImmutableStore, Flusher, MutableStore
+
+START_MICROS = 1525255489000000
+
+
+def test_same_time_range_flushed_twice(tmp_path):
+    store = ImmutableStore(location=str(tmp_path), time_margin=datetime.timedelta(0), background_flush=False)
+    for value in (1., 2.):
+        store.write_hf(1, 1, START_MICROS, 10., [value] * 10)
+        store.write_lf(1, 2, START_MICROS, value)
+        store.flush_all()
+
+    entries = store.manifest.entries(1)
+    assert len(entries) == 2
+    assert len({e['path'] for e in entries}) == 2
+    assert not store._pending
+    data = store.read_all_blocks(START_MICROS, START_MICROS + 10 ** 7)
+    assert sorted(data['lf']['value']) == [1., 2.]
+    assert sorted(v[0] for v in data['hf']['values']) == [1., 2.]
+    store.close()
+
+    assert store.rebuild_manifest() == 2
+
+
+@pytest.mark.parametrize('offsets, frequency', [
+    ([0, 100], 10.),
+    ([1, 10], 10.),
+    ([0, 5, 3, 10], 10.),
+    ([0, 10], 0.),
+    ([0, 10], -10.),
+    ([0, 10], float('nan')),
+])
+def test_invalid_hf_batch_rejected(tmp_path, offsets, frequency):
+    store = ImmutableStore(location=str(tmp_path), time_margin=datetime.timedelta(0), background_flush=False,
+                           wal=True)
+    starts = START_MICROS + np.arange(len(offsets) - 1) * 10 ** 6
+    with pytest.raises(ValueError):
+        store.write_hf_batch(1, 1, starts, frequency, np.arange(10.), offsets)
+    store.write_hf(1, 1, START_MICROS, 10., np.arange(10.))
+    store.flush_all()
+    data = store.read_all_blocks(START_MICROS, START_MICROS + 10 ** 8)
+    assert data['hf']['values'] == [list(np.arange(10.))]
+    store.close()
+
+
+@pytest.mark.parametrize('frequency', [0., -1., float('nan'), float('inf')])
+def test_invalid_hf_frequency_rejected(tmp_path, frequency):
+    store = ImmutableStore(location=str(tmp_path), background_flush=False)
+    with pytest.raises(ValueError):
+        store.write_hf(1, 1, START_MICROS, frequency, [1., 2.])
+    assert not store.caches
+    store.close()
+
+
+def _timestamps(results):
+    return np.concatenate([blocks.sample_timestamps(res['hf'])[1] for res in results])
+
+
+def test_trimmed_hf_timestamps_do_not_drift(tmp_path):
+    store = ImmutableStore(location=str(tmp_path), time_margin=datetime.timedelta(0), background_flush=False)
+    store.write_hf(1, 1, START_MICROS, 128., np.arange(255.))
+    store.flush_all()
+    end_micros = START_MICROS + 10 ** 7
+    full = _timestamps(store.read_blocks(START_MICROS, end_micros, lf=False, arrays=True)).tolist()
+    assert len(full) == 255
+
+    trimmed = _timestamps(store.read_blocks(full[1], end_micros, lf=False, arrays=True))
+    assert trimmed.tolist() == full[1:]
+    clipped = _timestamps(store.read_intervals({1: ([full[1], full[100]], [full[50], full[200]])}, lf=False,
+                                               arrays=True))
+    assert clipped.tolist() == full[1:50] + full[100:200]
+    data = store.read_all_blocks(full[1], end_micros, lf=False)
+    assert data['hf']['start_micros'] == [full[1]]
+    store.close()
+
+
+def _metric(name):
+    return {sample_name: value for family in metrics.registry.collect()
+            for sample_name, labels, value in family['samples']}.get(name, 0)
+
+
+def test_block_cache_metrics(tmp_path):
+    store = ImmutableStore(location=str(tmp_path), time_margin=datetime.timedelta(0), background_flush=False,
+                           block_cache_bytes=2 ** 20)
+    store.write_hf(1, 1, START_MICROS, 10., np.arange(10.))
+    store.flush_all()
+    hits, misses = _metric('pancarte_block_cache_hits_total'), _metric('pancarte_block_cache_misses_total')
+    for _ in range(2):
+        store.read_all_blocks(START_MICROS, START_MICROS + 10 ** 7, lf=False)
+    assert _metric('pancarte_block_cache_misses_total') == misses + 1
+    assert _metric('pancarte_block_cache_hits_total') == hits + 1
+    assert '# TYPE pancarte_block_cache_evictions counter' in metrics.registry.render()
+    store.close()
+
+
+def test_flusher_backpressure():
+    release = threading.Event()
+    written = []
+
+    def write(cache, source_id, wal_state):
+        release.wait(5)
+        if source_id == 'bad':
+            raise IOError('disk full')
+        written.append(source_id)
+
+    flusher = Flusher(write, lambda: [], workers=1, queue_size=1)
+    flusher.submit(None, 'bad')
+    flusher.submit(None, 1)
+    # One cache being written, one queued: the next writer waits for the disk
+    blocked = threading.Thread(target=flusher.submit, args=(None, 2))
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive()
+    release.set()
+    blocked.join(5)
+    assert not blocked.is_alive()
+    flusher.close()
+    # A failed write does not stop the worker
+    assert written == [1, 2]
+
+
+def test_background_flush_of_old_caches(tmp_path):
+    store = ImmutableStore(location=str(tmp_path), time_margin=datetime.timedelta(0),
+                           max_cache_age=datetime.timedelta(milliseconds=10))
+    store.write_lf(1, 1, START_MICROS, 1.)
+    store.write_hf(1, 2, START_MICROS, 10., [1., 2.])
+    deadline = time.monotonic() + 10
+    while not store.manifest.entries(1) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    # Written by the timer without flush_all() nor new values
+    assert len(store.manifest.entries(1)) == 1
+    data = store.read_all_blocks(START_MICROS, START_MICROS + 10 ** 7, memory=False)
+    assert data['lf']['value'] == [1.]
+    assert data['hf']['values'] == [[1., 2.]]
+    store.close()
+
+
+def _write_blocks(store, blocks_count, source_ids=(1,)):
+    for i in range(blocks_count):
+        for source_id in source_ids:
+            start = START_MICROS + i * 10 ** 6
+            store.write_lf(source_id, 1, start, float(i))
+            store.write_hf(source_id, 2, start, 100., np.arange(50.) + i)
+        store.flush_all()
+
+
+@pytest.mark.parametrize('read_pool', ['thread', 'process'])
+def test_parallel_reads_match_serial(tmp_path, read_pool):
+    store = ImmutableStore(location=str(tmp_path), time_margin=datetime.timedelta(0), background_flush=False,
+                           read_workers=2, read_pool=read_pool, read_prefetch=3)
+    _write_blocks(store, 6, source_ids=(1, 2))
+    store.write_lf(1, 1, START_MICROS + 10 ** 7, 10.)
+    end_micros = START_MICROS + 10 ** 8
+
+    serial = list(store.read_blocks(START_MICROS, end_micros, parallel=False))
+    parallel = list(store.read_blocks(START_MICROS, end_micros, parallel=True))
+    # Same results in the same order: blocks then memory caches
+    assert parallel == serial
+    assert len(serial) == 13
+    assert serial[-1]['lf']['value'] == [10.]
+
+    # Closing a result iterator early does not break later reads
+    results = store.read_blocks(START_MICROS, end_micros, parallel=True)
+    assert next(results) == serial[0]
+    results.close()
+    assert store.read_all_blocks(START_MICROS, end_micros, parallel=True) == \
+        store.read_all_blocks(START_MICROS, end_micros, parallel=False)
+    store.close()
+
+
+def test_read_through_memory_caches(tmp_path):
+    store = ImmutableStore(location=str(tmp_path), time_margin=datetime.timedelta(0), background_flush=False)
+    store.write_lf(1, 1, START_MICROS, 1.)
+    store.write_hf(1, 2, START_MICROS, 10., [1., 2., 3.])
+    end_micros = START_MICROS + 10 ** 7
+
+    data = store.read_all_blocks(START_MICROS, end_micros)
+    assert data['lf']['value'] == [1.]
+    assert data['hf']['values'] == [[1., 2., 3.]]
+    assert store.read_all_blocks(START_MICROS, end_micros, memory=False)['lf']['value'] == []
+    # Trimmed to the query range like the blocks
+    assert store.read_all_blocks(START_MICROS + 10 ** 5, end_micros)['hf']['values'] == [[2., 3.]]
+    store.flush_all()
+    assert store.read_all_blocks(START_MICROS, end_micros) == data
+    store.close()
+
+
+def test_values_read_once_while_flushing(tmp_path):
+    store = ImmutableStore(location=str(tmp_path), time_margin=datetime.timedelta(0), cache_size=20,
+                           flush_workers=2)
+    count = 2000
+    errors = []
+
+    def write():
+        for i in range(count):
+            store.write_lf(1, 1, START_MICROS + i, float(i))
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    while writer.is_alive():
+        timestamps = store.read_all_blocks(START_MICROS, START_MICROS + count, hf=False)['lf']['timestamp_micros']
+        if len(set(timestamps)) != len(timestamps):
+            errors.append(len(timestamps) - len(set(timestamps)))
+    writer.join()
+    assert not errors
+    assert len(store.manifest.entries(1)) > 1
+    assert sorted(store.read_all_blocks(START_MICROS, START_MICROS + count, hf=False)['lf']['value']) == \
+        [float(i) for i in range(count)]
+    store.close()
+
+
+def test_rollups_match_raw_samples(tmp_path):
+    store = ImmutableStore(location=str(tmp_path), time_margin=datetime.timedelta(0), background_flush=False)
+    rng = np.random.RandomState(0)
+    for i in range(4):
+        store.write_hf(1, 1, START_MICROS + i * 2500000 + 3000, 100., rng.normal(size=250))
+        store.write_hf(1, 2, START_MICROS + i * 2500000, 33., rng.normal(size=80))
+        if i < 3:
+            store.flush_all()
+    end_micros = START_MICROS + 20 * 10 ** 6
+
+    raw = [res['hf'] for res in store.read_blocks(START_MICROS, end_micros, lf=False, arrays=True)]
+    rows, timestamps, values = zip(*[blocks.sample_timestamps(hf) for hf in raw])
+    type_ids = np.concatenate([hf['type_id'][r] for hf, r in zip(raw, rows)])
+    timestamps, values = np.concatenate(timestamps), np.concatenate(values)
+
+    assert store.rollup_level(START_MICROS, end_micros, resolution=5 * 10 ** 6) == 10 ** 6
+    assert store.rollup_level(START_MICROS, end_micros, max_points=10) == 10 ** 7
+    assert store.rollup_level(START_MICROS, end_micros, max_points=10 ** 5) is None
+    for resolution in (10 ** 6, 10 ** 7):
+        rollup = store.read_all_blocks(START_MICROS, end_micros, lf=False, resolution=resolution)['hf']
+        assert set(rollup['resolution_micros']) == {resolution}
+        assert sum(rollup['count']) == len(values)
+        for j, (type_id, bucket) in enumerate(zip(rollup['type_id'], rollup['bucket_micros'])):
+            mask = (type_ids == type_id) & (timestamps // resolution * resolution == bucket)
+            assert rollup['count'][j] == mask.sum()
+            assert rollup['min'][j] == values[mask].min()
+            assert rollup['max'][j] == values[mask].max()
+            assert rollup['mean'][j] == pytest.approx(values[mask].mean())
+    # Read from the rollup sections written with the blocks
+    header = blocks.read_header(store.manifest.entries(1)[0]['path'])
+    assert {blocks.rollup_section(r) for r in blocks.ROLLUP_RESOLUTIONS} <= set(header['sections'])
+    store.close()
+
+
+def _rows(section):
+    return sorted(zip(*[section[col] for col in sorted(section) if col != 'values']))
+
+
+@pytest.mark.parametrize('filters, lf_keep, hf_keep', [
+    ({'type_id': 2}, lambda r: r['type_id'] == 2, lambda r: r['type_id'] == 2),
+    ({'type_id': [1, '3']}, lambda r: r['type_id'] in (1, 3), lambda r: r['type_id'] in (1, 3)),
+    ({'source_id': 2}, lambda r: r['source_id'] == '2', lambda r: r['source_id'] == '2'),
+    ({'value__min': 2, 'value__max': 4.5}, lambda r: 2 <= r['value'] <= 4.5, lambda r: True),
+    ({'frequency': 20., 'type_id': [2, 3]}, lambda r: r['type_id'] in (2, 3),
+     lambda r: r['frequency'] == 20. and r['type_id'] in (2, 3)),
+])
+def test_read_filters(tmp_path, filters, lf_keep, hf_keep):
+    store = ImmutableStore(location=str(tmp_path), time_margin=datetime.timedelta(0), background_flush=False)
+    for i in range(12):
+        source_id, type_id = i % 2 + 1, i % 3 + 1
+        store.write_lf(source_id, type_id, START_MICROS + i, float(i))
+        store.write_hf(source_id, type_id, START_MICROS + i * 10 ** 6, 10. * (i % 2 + 1), [float(i)] * 5)
+        if i == 7:
+            store.flush_all()
+    end_micros = START_MICROS + 10 ** 8
+
+    everything = store.read_all_blocks(START_MICROS, end_micros)
+    filtered = store.read_all_blocks(START_MICROS, end_micros, **filters)
+    for k, keep in (('lf', lf_keep), ('hf', hf_keep)):
+        section = everything[k]
+        rows = [{col: section[col][i] for col in section} for i in range(len(section['type_id']))]
+        expected = [r for r in rows if keep(r)]
+        assert _rows(filtered[k]) == _rows({col: [r[col] for r in expected] for col in section})
+        assert 0 < len(expected) <= len(rows)
+    store.close()
+
+
+def test_invalid_filters(tmp_path):
+    store = ImmutableStore(location=str(tmp_path), background_flush=False)
+    for filters in ({'bogus': 1}, {'value__avg': 1}, {'type_id': 'abc'}):
+        with pytest.raises(ValueError):
+            store.read_blocks(START_MICROS, START_MICROS + 1, **filters)
+    store.close()
+
+
+def _mutable_store(tmp_path, **kwargs):
+    return MutableStore(url='sqlite:///{}'.format(tmp_path / 'annotations.sqlite3'), **kwargs)
+
+
+def test_annotation_type_cache(tmp_path):
+    store = _mutable_store(tmp_path, annotation_type_ttl=0.2)
+    other = _mutable_store(tmp_path)
+    first = store.create(AnnotationType, name='first')
+    assert store.get(AnnotationType, name='first').id == first.id
+
+    # Writes of another store are only seen once the cache expires
+    other.create(AnnotationType, name='second')
+    assert store.get(AnnotationType, name='second') is None
+    time.sleep(0.3)
+    assert store.get(AnnotationType, name='second') is not None
+    # Writes of this store invalidate it at once
+    store.update(AnnotationType, first.id, name='renamed')
+    assert store.get(AnnotationType, id=first.id).name == 'renamed'
+    assert sorted(o.name for o in store.get_all(AnnotationType)) == ['renamed', 'second']
+    assert store.annotation_type_id('second') == store.get(AnnotationType, name='second').id
+
+
+def test_mutable_store_concurrent_writers(tmp_path):
+    store = _mutable_store(tmp_path, pool_size=2)
+    assert store._engine is not store._read_engine
+    with store._read_engine.connect() as conn:
+        assert conn.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+    type_id = store.create(AnnotationType, name='concurrent').id
+    errors = []
+    sessions = []
+
+    def write(source_id):
+        try:
+            for i in range(20):
+                store.create(TimestampAnnotation, source_id=source_id, type_id=type_id, timestamp_micros=i)
+                assert len(store.get_all(TimestampAnnotation, source_id=source_id)) == i + 1
+            sessions.append(store.get_session())
+            store.remove_session()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(source_id,)) for source_id in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # Writers queue on the single write connection instead of failing with 'database is locked'
+    assert not errors
+    assert len(store.get_all(TimestampAnnotation, type_id=type_id)) == 160
+    # One session per thread
+    assert len({id(s) for s in sessions}) == 8
@@ -0,0 +1,84 @@
+import datetime
+
+import pytest
+
+import blocks
+from storage import ImmutableStore
+
+START_MICROS = 1525255489000000
+
+
+def open_store(location):
+    return ImmutableStore(location=location, time_margin=datetime.timedelta(0), background_flush=False, wal=True)
+
+
+def crash(store):
+    # The process dies: nothing buffered by the log is written anymore
+    store.wal._stopped.set()
+    store.wal._thread.join()
+
+
+def lf_values(store):
+    return sorted(store.read_all_blocks(START_MICROS, START_MICROS + 10 ** 8, hf=False)['lf']['value'])
+
+
+def test_reopen_after_flush(tmp_path):
+    location = str(tmp_path)
+    store = open_store(location)
+    for i in range(53):
+        store.write_lf(1, 1, START_MICROS + i, float(i))
+    # Written by the interval fsync
+    store.wal.sync()
+    store.flush_all()
+    crash(store)
+
+    store = open_store(location)
+    assert lf_values(store) == [float(i) for i in range(53)]
+    store.close()
+
+
+def test_epochs_continue_across_restarts(tmp_path):
+    location = str(tmp_path)
+    store = open_store(location)
+    store.write_lf(1, 1, START_MICROS, 1.)
+    store.flush_all()
+    store.write_lf(1, 1, START_MICROS + 1, 2.)
+    flushed_epoch = store.caches[1].epoch - 1
+    store.wal.sync()
+    crash(store)
+
+    store = open_store(location)
+    assert store.caches[1].epoch > flushed_epoch + 1
+    assert lf_values(store) == [1., 2.]
+    store.flush_all()
+    crash(store)
+
+    store = open_store(location)
+    assert lf_values(store) == [1., 2.]
+    store.close()
+
+
+@pytest.mark.parametrize('background_flush', [False, True])
+def test_failed_block_write_kept_in_wal(tmp_path, monkeypatch, background_flush):
+    location = str(tmp_path)
+    store = ImmutableStore(location=location, time_margin=datetime.timedelta(0), background_flush=background_flush,
+                           wal=True)
+    store.write_lf(1, 1, START_MICROS, 1.)
+
+    def fail(*args, **kwargs):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(blocks, 'write_block', fail)
+    with pytest.raises(IOError):
+        store.close()
+    assert not store._pending
+    assert not store._wal_pending
+    monkeypatch.undo()
+
+    store = open_store(location)
+    assert lf_values(store) == [1.]
+    store.flush_all()
+    store.close()
+    store = open_store(location)
+    assert lf_values(store) == [1.]
+    store.close()
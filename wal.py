@@ -0,0 +1,317 @@
+import os
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+LF = 1
+HF = 2
+FLUSHED = 3
+LF_BATCH = 4
+HF_BATCH = 5
+
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+# payload length, crc32 of the payload, record kind
+_RECORD = struct.Struct('<IIB')
+_SOURCE_INT = struct.Struct('<Bq')
+_SOURCE_STR = struct.Struct('<BH')
+# epoch, type_id, value, timestamp_micros
+_LF = struct.Struct('<Iqdq')
+# epoch, type_id, start_micros, end_micros, frequency, number of values
+_HF = struct.Struct('<IqqqdI')
+# epoch, number of rows
+_BATCH = struct.Struct('<II')
+_EPOCH = struct.Struct('<I')
+
+# Batch records store these columns one after the other (hf values last, delimited by offsets)
+_BATCH_COLUMNS = {
+    'lf': [('type_id', '<i8'), ('timestamp_micros', '<i8'), ('value', '<f8')],
+    'hf': [('type_id', '<i8'), ('start_micros', '<i8'), ('end_micros', '<i8'), ('frequency', '<f8'),
+           ('offsets', '<i8')],
+}
+
+_SEGMENT_SUFFIX = '.wal'
+
+
+def pack_source(source_id):
+    if isinstance(source_id, (int, np.integer)):
+        return _SOURCE_INT.pack(0, source_id)
+    b = str(source_id).encode('utf-8')
+    return _SOURCE_STR.pack(1, len(b)) + b
+
+
+def _unpack_source(payload):
+    tag = payload[0]
+    if tag == 0:
+        return _SOURCE_INT.unpack_from(payload)[1], _SOURCE_INT.size
+    n = _SOURCE_STR.unpack_from(payload)[1]
+    return bytes(payload[_SOURCE_STR.size:_SOURCE_STR.size + n]).decode('utf-8'), _SOURCE_STR.size + n
+
+
+def _frame(kind, payload):
+    return _RECORD.pack(len(payload), zlib.crc32(payload), kind) + payload
+
+
+def encode(datatype, source, epoch, row):
+    """
+    Encodes one row of a memory cache, source being pack_source(source_id) and epoch the cache generation
+    the row belongs to. Rows are (type_id, value, timestamp_micros) for lf and
+    (type_id, values, start_micros, end_micros, frequency) for hf.
+    """
+    if datatype == 'lf':
+        type_id, value, timestamp_micros = row
+        return _frame(LF, source + _LF.pack(epoch, type_id, value, timestamp_micros))
+
+    type_id, values, start_micros, end_micros, frequency = row
+    return _frame(HF, source + _HF.pack(epoch, type_id, start_micros, end_micros, frequency, len(values)) +
+                  np.asarray(values, dtype='<f8').tobytes())
+
+
+def encode_batch(datatype, source, epoch, columns):
+    """
+    Encodes many rows given as block section columns (see blocks.SCHEMA) in one record.
+    """
+    n = len(columns['type_id'])
+    parts = [source, _BATCH.pack(epoch, n)]
+    for name, dtype in _BATCH_COLUMNS[datatype]:
+        parts.append(np.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+    if datatype == 'hf':
+        parts.append(np.ascontiguousarray(columns['values'], dtype='<f8').tobytes())
+    return _frame(LF_BATCH if datatype == 'lf' else HF_BATCH, b''.join(parts))
+
+
+def encode_flushed(source_id, epochs):
+    """
+    Marks the cache generations of source_id as written to blocks: replay skips their values.
+    """
+    return _frame(FLUSHED, pack_source(source_id) + b''.join(_EPOCH.pack(e) for e in epochs))
+
+
+def decode(kind, payload):
+    """
+    Returns (source_id, epoch, datatype, columns) for values, columns being block section columns,
+    and (source_id, epochs) for flush marks.
+    """
+    source_id, n = _unpack_source(payload)
+    if kind == FLUSHED:
+        return source_id, [e for (e,) in _EPOCH.iter_unpack(payload[n:])]
+
+    if kind == LF:
+        epoch, type_id, value, timestamp_micros = _LF.unpack_from(payload, n)
+        return source_id, epoch, 'lf', {'type_id': np.array([type_id]),
+                                        'timestamp_micros': np.array([timestamp_micros]),
+                                        'value': np.array([value])}
+    if kind == HF:
+        epoch, type_id, start_micros, end_micros, frequency, count = _HF.unpack_from(payload, n)
+        return source_id, epoch, 'hf', {'type_id': np.array([type_id]),
+                                        'start_micros': np.array([start_micros]),
+                                        'end_micros': np.array([end_micros]),
+                                        'frequency': np.array([frequency]),
+                                        'offsets': np.array([0, count]),
+                                        'values': np.frombuffer(payload, dtype='<f8', count=count,
+                                                                offset=n + _HF.size).copy()}
+
+    datatype = 'lf' if kind == LF_BATCH else 'hf'
+    epoch, rows = _BATCH.unpack_from(payload, n)
+    pos = n + _BATCH.size
+    columns = {}
+    for name, dtype in _BATCH_COLUMNS[datatype]:
+        count = rows + 1 if name == 'offsets' else rows
+        columns[name] = np.frombuffer(payload, dtype=dtype, count=count, offset=pos).copy()
+        pos += count * 8
+    if datatype == 'hf':
+        columns['values'] = np.frombuffer(payload, dtype='<f8', count=int(columns['offsets'][-1]), offset=pos).copy()
+    return source_id, epoch, datatype, columns
+
+
+class WriteAheadLog:
+    """
+    Segmented write-ahead log of the values waiting in the memory caches.
+
+    Records are appended to an in-memory buffer and written in groups (group commit):
+    - fsync='always': commit(seq) returns once the record is fsynced, concurrent committers share one fsync
+    - fsync='interval': a background thread writes and fsyncs the buffer every fsync_interval seconds
+    - fsync='never': same as interval without fsync, durability is left to the OS
+    Segments are rolled at segment_size bytes and removed by truncate_before() once their data is in blocks.
+    """
+    def __init__(self, directory, fsync='interval', fsync_interval=0.05, segment_size=64 * 2 ** 20,
+                 buffer_size=2 ** 20):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('fsync must be one of {}'.format(FSYNC_POLICIES))
+        self.directory = directory
+        self.fsync = fsync
+        self.segment_size = segment_size
+        self.buffer_size = buffer_size
+
+        os.makedirs(directory, exist_ok=True)
+        existing = self.segments()
+
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+
+        self.segment = existing[-1] + 1 if existing else 0
+        self.first_segment = self.segment
+        self._segment_fill = 0
+        self._buffers = [(self.segment, bytearray())]
+        self._buffered = 0
+        self._seq = 0
+        self._durable_seq = 0
+        # Cache generations start above the ones of the existing segments (see replay), so that their flush marks
+        # never match values logged by this process
+        self.first_epoch = 0
+
+        self._file = None
+        self._file_segment = None
+
+        self._stopped = threading.Event()
+        self._thread = None
+        if fsync != 'always':
+            self._thread = threading.Thread(target=self._background, args=(fsync_interval,),
+                                            name='pancarte-wal', daemon=True)
+            self._thread.start()
+
+    def _path(self, segment):
+        return os.path.join(self.directory, '{:016d}{}'.format(segment, _SEGMENT_SUFFIX))
+
+    def segments(self):
+        return sorted(int(f[:-len(_SEGMENT_SUFFIX)]) for f in os.listdir(self.directory)
+                      if f.endswith(_SEGMENT_SUFFIX))
+
+    def append(self, record):
+        """
+        Returns (segment, seq): the segment the record belongs to and the sequence number to commit().
+        """
+        with self._lock:
+            if self._segment_fill > 0 and self._segment_fill + len(record) > self.segment_size:
+                self.segment += 1
+                self._segment_fill = 0
+                self._buffers.append((self.segment, bytearray()))
+            self._buffers[-1][1].extend(record)
+            self._segment_fill += len(record)
+            self._buffered += len(record)
+            self._seq += 1
+            segment, seq, buffered = self.segment, self._seq, self._buffered
+
+        if self.fsync != 'always' and buffered >= self.buffer_size:
+            self._write_out(sync=False)
+        return segment, seq
+
+    def commit(self, seq, force=False):
+        """
+        Returns once the record of seq is durable (fsync='always' only, unless force).
+        force: write and fsync whatever the policy, for flush marks: replaying values already in blocks would
+               write them twice
+        """
+        if (self.fsync == 'always' or force) and self._durable_seq < seq:
+            self._write_out(sync=True, upto=seq)
+
+    def _write_out(self, sync, upto=None):
+        with self._io_lock:
+            if upto is not None and self._durable_seq >= upto:
+                # Written by another committer of the same group
+                return
+            with self._lock:
+                buffers = self._buffers
+                self._buffers = [(self.segment, bytearray())]
+                self._buffered = 0
+                last_seq = self._seq
+
+            for segment, data in buffers:
+                if not data:
+                    continue
+                if segment != self._file_segment:
+                    self._close_file(sync=self.fsync != 'never')
+                    self._file = open(self._path(segment), 'ab')
+                    self._file_segment = segment
+                self._file.write(data)
+            if self._file is not None:
+                self._file.flush()
+                if sync:
+                    os.fsync(self._file.fileno())
+            self._durable_seq = last_seq
+
+    def _close_file(self, sync):
+        if self._file is None:
+            return
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+        self._file_segment = None
+
+    def _background(self, interval):
+        while not self._stopped.wait(interval):
+            self._write_out(sync=self.fsync == 'interval')
+
+    def _records(self, segment):
+        with open(self._path(segment), 'rb') as f:
+            data = f.read()
+        pos = 0
+        while pos + _RECORD.size <= len(data):
+            length, crc, kind = _RECORD.unpack_from(data, pos)
+            payload = memoryview(data)[pos + _RECORD.size:pos + _RECORD.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            yield kind, payload
+            pos += _RECORD.size + length
+
+    def replay(self):
+        """
+        Yields (source_id, datatype, columns) for the values of the segments written before this log was opened
+        that are not marked as flushed. Reading a segment stops at its first torn or corrupted record.
+        Sets first_epoch above every epoch of these segments before yielding.
+        """
+        old_segments = [s for s in self.segments() if s < self.first_segment]
+
+        flushed = set()
+        last_epoch = -1
+        for segment in old_segments:
+            for kind, payload in self._records(segment):
+                if kind == FLUSHED:
+                    source_id, epochs = decode(kind, payload)
+                    flushed.update((source_id, e) for e in epochs)
+                    last_epoch = max([last_epoch] + epochs)
+                else:
+                    last_epoch = max(last_epoch, _EPOCH.unpack_from(payload, _unpack_source(payload)[1])[0])
+        self.first_epoch = max(self.first_epoch, last_epoch + 1)
+
+        for segment in old_segments:
+            for kind, payload in self._records(segment):
+                if kind == FLUSHED:
+                    continue
+                source_id, epoch, datatype, columns = decode(kind, payload)
+                if (source_id, epoch) not in flushed:
+                    yield source_id, datatype, columns
+
+    def sync(self):
+        self._write_out(sync=self.fsync != 'never')
+
+    def truncate_before(self, segment):
+        """
+        Removes the segments older than segment, never the ones still being written.
+        """
+        with self._io_lock:
+            limit = min(segment, self.segment)
+            if self._file_segment is not None:
+                limit = min(limit, self._file_segment)
+            for s in self.segments():
+                if s >= limit:
+                    break
+                os.remove(self._path(s))
+
+    def close(self, remove=False):
+        """
+        remove: delete every segment, to be used once all the logged values are flushed
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._write_out(sync=self.fsync != 'never')
+        with self._io_lock:
+            self._close_file(sync=self.fsync != 'never')
+            if remove:
+                for s in self.segments():
+                    os.remove(self._path(s))